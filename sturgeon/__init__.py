@@ -1,3 +1 @@
 __version__ = "0.4.3"
-
-import sturgeon.callmapping
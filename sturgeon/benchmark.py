@@ -0,0 +1,404 @@
+"""
+Benchmarks of each stage of the sturgeon pipeline
+
+Each stage is timed on its own with deterministic synthetic inputs at several
+probe coverages, and on the demo bed files if available. Results are saved as
+json so that they can be compared between versions.
+"""
+import os
+import sys
+import time
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Optional, List, Callable
+import logging
+
+import numpy as np
+import pandas as pd
+
+from sturgeon import __version__
+from sturgeon.utils import load_bed_file
+from sturgeon.prediction import (
+    load_model,
+    bed_to_numpy,
+    model_forward,
+    postprocess_scores,
+    class_aggregation_matrix,
+    scores_to_dataframe,
+    ProbeIndex,
+)
+from sturgeon.constants import NOMEASURE_VALUE
+from sturgeon.callmapping import (
+    map_methyl_calls_to_probes_chr,
+    merge_probes_methyl_calls,
+    probes_methyl_calls_to_bed,
+)
+
+BENCH_MODEL = os.path.join(
+    os.path.dirname(__file__), 'include/bench', 'bench_model.zip'
+)
+DEMO_BED_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'demo', 'bed'
+)
+
+
+def time_function(
+    func: Callable,
+    rounds: Optional[int] = 5,
+    warmup: Optional[int] = 1,
+) -> dict:
+    """Time a function call several times
+
+    Args:
+        func (callable): function without arguments to be timed
+        rounds (int): number of timed calls
+        warmup (int): number of calls before timing
+
+    Returns a dict with the timing statistics in seconds
+    """
+
+    for _ in range(warmup):
+        func()
+
+    timings = list()
+    for _ in range(rounds):
+        st = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - st)
+
+    timings = np.array(timings)
+    return {
+        'min': float(timings.min()),
+        'max': float(timings.max()),
+        'mean': float(timings.mean()),
+        'median': float(np.median(timings)),
+        'stddev': float(timings.std()),
+        'rounds': rounds,
+    }
+
+def synthetic_bed_df(
+    probe_ids: List[str],
+    coverage: float,
+    rng: np.random.Generator,
+) -> pd.DataFrame:
+    """Bed dataframe with a random methylation call for a fraction of the
+    probes
+    """
+
+    probe_ids = np.asarray(probe_ids)
+    num_measured = max(1, int(len(probe_ids) * coverage))
+    measured = np.sort(rng.choice(len(probe_ids), num_measured, replace = False))
+
+    return pd.DataFrame({
+        'chrom': 1,
+        'chromStart': measured * 100,
+        'chromEnd': measured * 100 + 1,
+        'methylation_call': rng.integers(0, 2, num_measured),
+        'probe_id': probe_ids[measured],
+    })
+
+def synthetic_probes_df(num_probes: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Probes dataframe of a single chromosome, with empty call counts"""
+
+    starts = np.sort(rng.choice(num_probes * 50, num_probes, replace = False))
+    starts = starts * 10 + 1000
+
+    return pd.DataFrame({
+        'chr': 1,
+        'start': starts,
+        'end': starts + 1,
+        'ID_REF': ['cg{:08d}'.format(i) for i in range(num_probes)],
+        'methylation_calls': 0,
+        'unmethylation_calls': 0,
+        'total_calls': 0,
+    })
+
+def synthetic_calls_per_read(
+    probes_df: pd.DataFrame,
+    coverage: float,
+    rng: np.random.Generator,
+    calls_per_probe: Optional[int] = 5,
+    margin: Optional[int] = 25,
+) -> pd.DataFrame:
+    """Methylation calls per read around a fraction of the probes"""
+
+    num_probes = len(probes_df)
+    num_measured = max(1, int(num_probes * coverage))
+    measured = rng.choice(num_probes, num_measured, replace = False)
+    positions = np.repeat(np.asarray(probes_df['start'])[measured], calls_per_probe)
+    positions += rng.integers(-margin, margin + 1, len(positions))
+
+    methylated = np.repeat(rng.random(num_measured) < 0.5, calls_per_probe)
+    scores = np.where(
+        methylated,
+        rng.beta(5, 1.5, len(positions)),
+        rng.beta(1.5, 5, len(positions)),
+    )
+
+    calls_df = pd.DataFrame({
+        'read_id': np.arange(len(positions)) // 20,
+        'chr': '1',
+        'reference_pos': positions,
+        'strand': rng.choice([1, -1], len(positions)),
+        'score': scores,
+    })
+    return calls_df.sort_values(['reference_pos'])
+
+def run_benchmarks(
+    model_files: Optional[List[str]] = None,
+    bed_path: Optional[str] = DEMO_BED_PATH,
+    coverages: Optional[List[float]] = (0.05, 0.25, 1.0),
+    num_probes: Optional[int] = 5000,
+    rounds: Optional[int] = 5,
+    seed: Optional[int] = 0,
+    plot: Optional[bool] = True,
+) -> dict:
+    """Time each stage of the pipeline
+
+    Args:
+        model_files (list): models to benchmark, the bundled benchmark model
+            if not given
+        bed_path (str): directory with bed files, also benchmarked if it exists
+        coverages (list): fractions of measured probes of the synthetic inputs
+        num_probes (int): number of probes of the synthetic call mapping inputs
+        rounds (int): number of timed calls of each stage
+        seed (int): seed of the synthetic inputs
+        plot (bool): whether to also benchmark plotting
+
+    Returns a dict with the benchmark settings, machine information and the
+    timings of each benchmark
+    """
+
+    if model_files is None or len(model_files) == 0:
+        model_files = [BENCH_MODEL]
+
+    benchmarks = list()
+
+    def bench(name, stage, params, func):
+        logging.info("Benchmarking: {}".format(name))
+        stats = time_function(func, rounds = rounds)
+        benchmarks.append({
+            'name': name,
+            'stage': stage,
+            'params': params,
+            'stats': stats,
+        })
+        logging.info("Median: {:.6f} seconds".format(stats['median']))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        # command line start up, imports included
+        bench(
+            'cli_startup', 'cli_startup', {},
+            lambda: subprocess.run(
+                [sys.executable, '-m', 'sturgeon.main', '--help'],
+                stdout = subprocess.DEVNULL,
+                stderr = subprocess.DEVNULL,
+                check = True,
+            ),
+        )
+
+        # prediction stages
+        for model_file in model_files:
+
+            model_name = Path(model_file).stem
+            (
+                inference_session,
+                probes_df,
+                decoding_dict,
+                temperatures,
+                merge_dict,
+            ) = load_model(model_file)
+            probe_index = ProbeIndex(probes_df['ID_REF'])
+            class_aggregation = class_aggregation_matrix(decoding_dict, merge_dict)
+
+            inputs = dict()
+            rng = np.random.default_rng(seed)
+            for coverage in coverages:
+                bed_file = os.path.join(
+                    tmp_dir, '{}_{}.bed'.format(model_name, coverage)
+                )
+                synthetic_bed_df(
+                    probes_df['ID_REF'], coverage, rng
+                ).to_csv(bed_file, sep = '\t', index = False)
+                inputs['coverage={}'.format(coverage)] = bed_file
+
+            if bed_path is not None and os.path.isdir(bed_path):
+                for f in sorted(os.listdir(bed_path)):
+                    if f.endswith('.bed'):
+                        inputs['demo={}'.format(Path(f).stem)] = os.path.join(
+                            bed_path, f
+                        )
+
+            for input_name, bed_file in inputs.items():
+
+                params = {'model': model_name, 'input': input_name}
+                suffix = '[{},{}]'.format(model_name, input_name)
+
+                bench(
+                    'load_bed_file' + suffix, 'load_bed_file', params,
+                    lambda: load_bed_file(bed_file),
+                )
+
+                bed_df = load_bed_file(bed_file)
+                bench(
+                    'bed_to_numpy' + suffix, 'bed_to_numpy', params,
+                    lambda: bed_to_numpy(bed_df, probe_index = probe_index),
+                )
+
+                x = bed_to_numpy(bed_df, probe_index = probe_index)
+                bench(
+                    'model_forward' + suffix, 'model_forward', params,
+                    lambda: model_forward(x, inference_session),
+                )
+
+                scores = model_forward(x, inference_session)[np.newaxis]
+                bench(
+                    'postprocess_scores' + suffix, 'postprocess_scores', params,
+                    lambda: postprocess_scores(
+                        scores = scores,
+                        decoding_dict = decoding_dict,
+                        temperatures = temperatures,
+                        merge_dict = merge_dict,
+                        class_aggregation = class_aggregation,
+                    ),
+                )
+
+            if plot:
+                from sturgeon.plot import plot_prediction
+
+                final_scores, class_names = postprocess_scores(
+                    scores = scores,
+                    decoding_dict = decoding_dict,
+                    temperatures = temperatures,
+                    merge_dict = merge_dict,
+                    class_aggregation = class_aggregation,
+                )
+                prediction_df = scores_to_dataframe(
+                    int(np.sum(x != NOMEASURE_VALUE)), final_scores[0], class_names
+                )
+                bench(
+                    'plot_prediction[{}]'.format(model_name),
+                    'plot_prediction',
+                    {'model': model_name},
+                    lambda: plot_prediction(
+                        prediction_df = prediction_df,
+                        output_file = os.path.join(tmp_dir, 'plot.pdf'),
+                    ),
+                )
+
+        # call mapping stages
+        rng = np.random.default_rng(seed)
+        probes_df = synthetic_probes_df(num_probes, rng)
+        for coverage in coverages:
+
+            params = {'num_probes': num_probes, 'coverage': coverage}
+            suffix = '[coverage={}]'.format(coverage)
+
+            calls_df = synthetic_calls_per_read(probes_df, coverage, rng)
+            bench(
+                'map_methyl_calls_to_probes_chr' + suffix,
+                'map_methyl_calls_to_probes_chr',
+                params,
+                lambda: map_methyl_calls_to_probes_chr(
+                    probes_df = probes_df,
+                    methyl_calls_per_read = calls_df,
+                    margin = 25,
+                    neg_threshold = 0.3,
+                    pos_threshold = 0.7,
+                ),
+            )
+
+            calls_files = list()
+            for i in range(3):
+                calls_file = os.path.join(
+                    tmp_dir, 'calls_{}_{}.txt'.format(coverage, i)
+                )
+                map_methyl_calls_to_probes_chr(
+                    probes_df = probes_df,
+                    methyl_calls_per_read = synthetic_calls_per_read(
+                        probes_df, coverage, rng
+                    ),
+                    margin = 25,
+                    neg_threshold = 0.3,
+                    pos_threshold = 0.7,
+                ).to_csv(calls_file, header = True, index = False, sep = '\t')
+                calls_files.append(calls_file)
+
+            merged_file = os.path.join(tmp_dir, 'merged_{}.txt'.format(coverage))
+            bench(
+                'merge_probes_methyl_calls' + suffix,
+                'merge_probes_methyl_calls',
+                params,
+                lambda: merge_probes_methyl_calls(calls_files, merged_file),
+            )
+
+            bench(
+                'probes_methyl_calls_to_bed' + suffix,
+                'probes_methyl_calls_to_bed',
+                params,
+                lambda: probes_methyl_calls_to_bed(
+                    merged_file,
+                    os.path.join(tmp_dir, 'merged_{}.bed'.format(coverage)),
+                ),
+            )
+
+    return {
+        'sturgeon_version': __version__,
+        'datetime': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+        },
+        'settings': {
+            'model_files': [str(m) for m in model_files],
+            'coverages': list(coverages),
+            'num_probes': num_probes,
+            'rounds': rounds,
+            'seed': seed,
+        },
+        'benchmarks': benchmarks,
+    }
+
+def compare_benchmarks(
+    baseline: dict,
+    current: dict,
+    threshold: Optional[float] = 0.1,
+) -> List[dict]:
+    """Compare the median timings of two benchmark results
+
+    Args:
+        baseline (dict): benchmark results to compare against
+        current (dict): new benchmark results
+        threshold (float): relative slow down above which a benchmark is
+            flagged as a regression
+
+    Returns a list with a dict for each benchmark in both results, with the
+    median timings, their ratio and whether it is a regression
+    """
+
+    baseline_medians = {
+        b['name']: b['stats']['median'] for b in baseline['benchmarks']
+    }
+
+    comparison = list()
+    for b in current['benchmarks']:
+        if b['name'] not in baseline_medians:
+            continue
+
+        baseline_median = baseline_medians[b['name']]
+        current_median = b['stats']['median']
+        ratio = current_median / baseline_median if baseline_median > 0 else np.inf
+        comparison.append({
+            'name': b['name'],
+            'baseline': baseline_median,
+            'current': current_median,
+            'ratio': ratio,
+            'regression': bool(ratio > 1 + threshold),
+        })
+
+    return comparison
@@ -17,24 +17,55 @@ class HistogramCalibration():
     def fit(self, probs: np.ndarray, labels: np.ndarray):
         """
         Fit the calibration model, finding optimal confidences for all the bins.
+
+        A probability belongs to a bin if it is larger than its lower bound
+        and smaller or equal than its upper bound. Probabilities are binned 
+        once for all classes, and the samples and labels in each bin are 
+        counted with a single histogram.
         
         Params:
             probs: probabilities of data [samples, classes]
             labels: numeric labels of the classes
         """
-        for label_num in range(self.num_classes):
 
-            subprobs = probs[:, label_num]
-            onevs_label = np.zeros(labels.shape, )
-            onevs_label[labels == label_num] = 1
-        
-            for conf_idx, conf_thresh in enumerate(self.upper_bounds):
-                acc = onevs_label[(subprobs > conf_thresh-self.bin_size) & (subprobs <= conf_thresh)]
-                if len(acc) > 0:
-                    acc = np.mean(acc)
-                else:
-                    acc = conf_thresh
-                self.conf[label_num, conf_idx] = acc
+        num_bins = len(self.upper_bounds)
+        lower_bounds = self.upper_bounds - self.bin_size
+        probs = probs[:, :self.num_classes]
+        num_samples = probs.shape[0]
+        labels = np.asarray(labels)
+
+        def histogram(probs, classes):
+            # bins first_bin up to last_bin (exclusive) contain a probability,
+            # usually a single bin, but bounds can overlap by floating point
+            # error. Probabilities outside any bin go to a discarded last slot
+            first_bin = np.searchsorted(self.upper_bounds, probs, side = 'left')
+            last_bin = np.searchsorted(lower_bounds, probs, side = 'left')
+            offset = classes * (num_bins + 1)
+            discard = self.num_classes * (num_bins + 1)
+            in_bin = first_bin < last_bin
+
+            size = discard + 1
+            hist = np.bincount(
+                np.where(in_bin, first_bin + offset, discard).ravel(), 
+                minlength = size,
+            )
+            hist -= np.bincount(
+                np.where(in_bin, last_bin + offset, discard).ravel(), 
+                minlength = size,
+            )
+            hist = hist[:discard].reshape(self.num_classes, num_bins + 1)
+            return np.cumsum(hist, axis = 1)[:, :num_bins]
+
+        counts = histogram(probs, np.arange(self.num_classes))
+
+        # only the probability of the true label of each sample is a positive
+        labeled = np.isin(labels, np.arange(self.num_classes))
+        labels = labels[labeled].astype(int)
+        positives = histogram(probs[np.arange(num_samples)[labeled], labels], labels)
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            acc = positives / counts
+        self.conf[:] = np.where(counts > 0, acc, self.upper_bounds)
 
     def _calculate_bins(self):
         self.bin_size = 1./self.num_bins
@@ -47,17 +78,20 @@ class HistogramCalibration():
         Params:
             probs: probabilities of data [classes]
         """
-        for i, prob in enumerate(probs):
-            idx = np.searchsorted(self.upper_bounds, prob)
-            probs[i] = self.conf[i, idx]
+        idx = np.searchsorted(self.upper_bounds, probs)
+        probs[:] = self.conf[np.arange(len(probs)), idx]
 
         return probs
 
     def calibrate_batch(self, probs):
-        for i in range(probs.shape[0]):
-            for j, prob in enumerate(probs[i, :]):
-                idx = np.searchsorted(self.upper_bounds, prob)
-                probs[i, j] = self.conf[j, idx]
+        """
+        Calibrate a batch of probabilities
+        
+        Params:
+            probs: probabilities of data [samples, classes]
+        """
+        idx = np.searchsorted(self.upper_bounds, probs)
+        probs[:] = self.conf[np.arange(probs.shape[1]), idx]
 
         return probs
 
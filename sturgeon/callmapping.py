@@ -1,19 +1,41 @@
+import io
 import os
+import bisect
+import multiprocessing
+import signal
+from array import array
 from pathlib import Path
 from copy import deepcopy
-from typing import Optional, List
+from typing import Optional, List, Tuple, Callable, Iterator, Dict
 import logging
 from contextlib import contextmanager
-import warnings
+from concurrent.futures import ProcessPoolExecutor, Future, wait
 
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
-try:
-    from modbampy import ModBam
-except ImportError:
-    warnings.warn('Error loading modbampy, bam functionalities will not work')
 
 from sturgeon.utils import read_probes_file
+from sturgeon.tracing import traced
+from sturgeon.constants import CHUNK_SIZE, INDEX_FREE_BAM_SIZE
+
+# columns read from megalodon and modkit files, and their types
+MEGALODON_DTYPES = {
+    'chrm': 'category',
+    'pos': np.int64,
+    'mod_log_prob': np.float64,
+}
+MODKIT_DTYPES = {
+    'chrom': 'category',
+    'ref_position': np.int64,
+    'mod_qual': np.float64,
+    'mod_code': 'category',
+    'canonical_base': 'category',
+    'modified_primary_base': 'category',
+}
+
+# probe windows closer than this are read from the bam file in a single fetch
+FETCH_REGION_GAP = 10000
 
 @contextmanager
 def SuppressPandasWarning():
@@ -21,115 +43,512 @@ def SuppressPandasWarning():
         yield
 
 
+def probe_windows(
+    starts: np.ndarray,
+    margin: int,
+    max_gap: Optional[int] = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions of the calls that are counted for some probe, as merged 
+    windows around the probes, see `probe_window_votes`
+
+    Args:
+        starts (np.ndarray): start position of each probe
+        margin (int): calls within this distance of a probe are considered
+        max_gap (int): windows with fewer positions than this between them
+            are also merged
+
+    Returns two arrays with the first and last position of each window
+    """
+
+    starts = np.sort(np.asarray(starts))
+    starts = starts[starts > -1]
+    if len(starts) == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+
+    firsts = starts - margin
+    lasts = np.maximum.accumulate(starts + margin + 1)
+
+    new_window = np.ones(len(starts), dtype = bool)
+    new_window[1:] = firsts[1:] > lasts[:-1] + max_gap + 1
+    window_starts = np.where(new_window)[0]
+    window_ends = np.append(window_starts[1:], len(starts)) - 1
+
+    return firsts[window_starts], lasts[window_ends]
+
+def in_windows(
+    positions: np.ndarray, 
+    window_firsts: np.ndarray, 
+    window_lasts: np.ndarray,
+) -> np.ndarray:
+    """Whether each position is in one of the sorted windows"""
+
+    i = np.searchsorted(window_lasts, positions, 'left')
+    inside = i < len(window_lasts)
+    inside[inside] = window_firsts[i[inside]] <= positions[inside]
+    return inside
+
+def query_to_reference_positions(
+    cigartuples: List[Tuple[int, int]],
+    reference_start: int,
+    query_positions: np.ndarray,
+) -> np.ndarray:
+    """Reference position of positions in the sequence of an aligned read
+
+    Args:
+        cigartuples (list): cigar operations of the read, as given by pysam
+        reference_start (int): reference position of the first aligned base
+        query_positions (np.ndarray): positions in the read sequence
+
+    Returns an array with the reference positions, -1 for positions that are
+    not aligned to the reference
+    """
+
+    block_query = list()
+    block_reference = list()
+    block_length = list()
+    query_pos = 0
+    reference_pos = reference_start
+    for operation, length in cigartuples:
+        # M, = and X consume both, I and S only the query, D and N only the
+        # reference, H and P neither
+        if operation in (0, 7, 8):
+            block_query.append(query_pos)
+            block_reference.append(reference_pos)
+            block_length.append(length)
+            query_pos += length
+            reference_pos += length
+        elif operation in (1, 4):
+            query_pos += length
+        elif operation in (2, 3):
+            reference_pos += length
+
+    if len(block_query) == 0:
+        return np.full(len(query_positions), -1, dtype = np.int64)
+
+    block_query = np.array(block_query)
+    block_length = np.array(block_length)
+    block_reference = np.array(block_reference)
+
+    i = np.searchsorted(block_query, query_positions, 'right') - 1
+    offset = query_positions - block_query[i]
+    aligned = (i >= 0) & (offset < block_length[i])
+
+    return np.where(aligned, block_reference[i] + offset, -1)
+
+class CallsBuffer():
+    """Growable typed buffers with the calls per read of a chromosome
+
+    Each call takes 5 bytes, its position (int32) and its raw ML score 
+    (uint8). The read id and strand are kept once per read, read ids as 
+    integer codes into a table of read names.
+    """
+
+    STRANDS = ['+', '-']
+
+    def __init__(self):
+
+        self.positions = array('i')
+        self.scores = array('B')
+        self.read_codes = array('i')
+        self.read_strands = array('b')
+        self.read_num_calls = array('I')
+        self.read_table = dict()
+
+    def add_read(
+        self,
+        read_id: str,
+        is_reverse: bool,
+        reference_pos: np.ndarray,
+        scores: np.ndarray,
+    ):
+        """Add the calls of a read
+
+        Args:
+            read_id (str): name of the read
+            is_reverse (bool): whether the read is on the reverse strand
+            reference_pos (np.ndarray): reference position of each call
+            scores (np.ndarray): raw ML score of each call, from 0 to 255
+        """
+
+        if len(reference_pos) == 0:
+            return
+
+        read_code = self.read_table.setdefault(read_id, len(self.read_table))
+        self.read_codes.append(read_code)
+        self.read_strands.append(int(is_reverse))
+        self.read_num_calls.append(len(reference_pos))
+        self.positions.frombytes(np.asarray(reference_pos, dtype = np.int32).tobytes())
+        self.scores.frombytes(np.asarray(scores, dtype = np.uint8).tobytes())
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def to_dataframe(self, chromosome: str) -> pd.DataFrame:
+        """Calls sorted by position, with read_id, chr and strand as 
+        categorical columns
+        """
+
+        positions = np.frombuffer(self.positions, dtype = np.int32)
+        order = np.argsort(positions, kind = 'stable')
+
+        read_num_calls = np.frombuffer(self.read_num_calls, dtype = np.uint32)
+        read_codes = np.repeat(
+            np.frombuffer(self.read_codes, dtype = np.int32), read_num_calls
+        )[order]
+        strands = np.repeat(
+            np.frombuffer(self.read_strands, dtype = np.int8), read_num_calls
+        )[order]
+        scores = np.frombuffer(self.scores, dtype = np.uint8)[order]
+
+        return pd.DataFrame({
+            'read_id': pd.Categorical.from_codes(
+                read_codes, categories = list(self.read_table.keys()),
+            ),
+            'chr': pd.Categorical.from_codes(
+                np.zeros(len(order), dtype = np.int8), categories = [chromosome],
+            ),
+            'reference_pos': positions[order],
+            'strand': pd.Categorical.from_codes(strands, categories = self.STRANDS),
+            'score': (1 + scores.astype(np.float64)) / 256,
+        })
+
+class ProbeWindows():
+    """Merged windows around the probes of a chromosome, calls outside of
+    them do not count for any probe
+
+    Args:
+        probe_starts (np.ndarray): start positions of the probes
+        margin (int): calls within this distance of a probe are kept
+    """
+
+    def __init__(self, probe_starts: np.ndarray, margin: int):
+
+        self.firsts, self.lasts = probe_windows(probe_starts, margin)
+        # plain lists are faster to bisect once per read
+        self._firsts = self.firsts.tolist()
+        self._lasts = self.lasts.tolist()
+
+    def overlaps(self, start: int, end: int) -> bool:
+        """Whether the reference span [start, end) overlaps any window"""
+
+        i = bisect.bisect_left(self._lasts, start)
+        return i < len(self._lasts) and self._firsts[i] < end
+
+    def contains(self, positions: np.ndarray) -> np.ndarray:
+        return in_windows(positions, self.firsts, self.lasts)
+
+def bam_chromosome_name(chromosome) -> str:
+    """Name of a probes chromosome in the bam files"""
+
+    chromosome = str(chromosome)
+    if not chromosome.startswith('chr'):
+        chromosome = 'chr' + chromosome
+    return chromosome
+
+def add_read_methyl_calls(
+    calls_buffer: CallsBuffer,
+    read,
+    windows: Optional[ProbeWindows] = None,
+    fivemc_code: Optional[str] = None,
+):
+    """Add the C modification calls of an aligned read to a buffer
+
+    By default every C modification in the MM/ML tags is a call of its own,
+    as modbampy gave them: a basecaller that also calls 5hmC ('h') gives a 
+    5mC and a 5hmC call for each C.
+
+    Args:
+        calls_buffer (CallsBuffer): buffer of the chromosome of the read
+        read (pysam.AlignedSegment): read with MM/ML tags
+        windows (ProbeWindows): only calls in these windows are kept, all 
+            calls if not given
+        fivemc_code (str): only calls of this modification code are kept, 
+            for example 'm' for 5mC alone, all C modifications if not given
+    """
+
+    if read.is_unmapped:
+        return
+
+    if windows is not None and not windows.overlaps(
+        read.reference_start, read.reference_end
+    ):
+        return
+
+    modified_bases = read.modified_bases
+    if not modified_bases:
+        return
+
+    calls = [
+        c for (base, _, modification), mod_calls in modified_bases.items()
+        if base == 'C' and (fivemc_code is None or modification == fivemc_code)
+        for c in mod_calls
+    ]
+    if len(calls) == 0:
+        return
+    calls = np.array(calls, dtype = np.int64)
+
+    reference_pos = query_to_reference_positions(
+        read.cigartuples, read.reference_start, calls[:, 0],
+    )
+    keep = (reference_pos > -1) & (calls[:, 1] > -1)
+    if windows is not None:
+        keep &= windows.contains(reference_pos)
+
+    calls_buffer.add_read(
+        read_id = read.query_name,
+        is_reverse = read.is_reverse,
+        reference_pos = reference_pos[keep],
+        scores = calls[keep, 1],
+    )
+
+def concat_calls_per_read(calls_per_read: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate the calls per read of several chromosomes, categorical 
+    columns stay categorical
+    """
+
+    columns = dict()
+    for column in calls_per_read[0].columns:
+        values = [df[column] for df in calls_per_read]
+        if all(isinstance(v.dtype, pd.CategoricalDtype) for v in values):
+            columns[column] = union_categoricals(values)
+        else:
+            columns[column] = np.concatenate([np.asarray(v) for v in values])
+
+    return pd.DataFrame(columns)
+
+@traced
 def get_methyl_calls_per_read( 
     bam_file: str, 
     chromosome: str,
+    probe_starts: Optional[np.ndarray] = None,
+    margin: Optional[int] = 25,
+    fivemc_code: Optional[str] = None,
 ) -> pd.DataFrame:
     """Get the methylation status of probes from a guppy methylation bam file
     of a chromosome.
 
+    The C modification calls are read from the MM/ML tags of the reads, see
+    `add_read_methyl_calls`. If probe_starts
+    is given, only the reads around the probes are fetched, with the bam 
+    index, and only the calls that can count for a probe are kept.
+
     Args:
         bam_file (str): path to the bam file
         chromosome (str): chromosome to be evaluated
+        probe_starts (np.ndarray): start positions of the probes of the 
+            chromosome, all calls of the chromosome if not given
+        margin (int): calls within this distance of a probe are kept
+        fivemc_code (str): see `add_read_methyl_calls`
 
     Returns:
         pd.DataFrame with methylation calls per position
     """
 
-    results = {
-        'read_id': list(),
-        'chr': list(),
-        'reference_pos': list(),
-        'strand': list(),
-        'score': list()
-    }
-
-    if not isinstance(chromosome, str):
-        chromosome = str(chromosome)
+    import pysam
 
-    if not chromosome.startswith('chr'):
-        chromosome = 'chr'+str(chromosome)
+    calls_buffer = CallsBuffer()
+    chromosome = bam_chromosome_name(chromosome)
     
-    with ModBam(bam_file) as bam:
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+
+        windows = None
+        if chromosome not in bam.references:
+            logging.debug(
+                'Chromosome {} not in bam file: {}'.format(chromosome, bam_file)
+            )
+            regions = list()
+        elif probe_starts is None:
+            regions = [(0, bam.get_reference_length(chromosome))]
+        else:
+            windows = ProbeWindows(probe_starts, margin)
+            region_firsts, region_lasts = probe_windows(
+                probe_starts, margin, max_gap = FETCH_REGION_GAP,
+            )
+            regions = list(zip(
+                np.maximum(region_firsts, 0).tolist(), 
+                (region_lasts + 1).tolist(),
+            ))
 
-        st = 0
-        nd = 250000000
+        previous_end = -1
+        for region_start, region_end in regions:
 
-        for read in bam.reads(chromosome, st, nd):
-            
-            for pos_mod in read.mod_sites:
-                read_id, reference_pos, _, strand, _, _, _, score = pos_mod
+            for read in bam.fetch(chromosome, region_start, region_end):
 
-                if reference_pos == -1:
+                # reads that overlap the previous region were already read
+                if read.reference_start < previous_end:
                     continue
 
-                results['read_id'].append(read_id)
-                results['chr'].append(chromosome[3:])
-                results['reference_pos'].append(reference_pos)
-                results['strand'].append(strand)
-                results['score'].append((1+score)/256)
+                add_read_methyl_calls(calls_buffer, read, windows, fivemc_code)
 
-    results = pd.DataFrame(results)
-    results = results.sort_values(['reference_pos'])
+            previous_end = region_end
 
-    return results
+    return calls_buffer.to_dataframe(chromosome[3:])
 
-def map_methyl_calls_to_probes_chr(
-    probes_df: pd.DataFrame,
-    methyl_calls_per_read: pd.DataFrame,
-    margin: int, 
-    neg_threshold: float,
-    pos_threshold: float,
-) -> pd.DataFrame:
-    """Maps calls per read to probe locations in a chromosome
+def scan_methyl_calls_per_read(
+    bam_file: str,
+    probe_starts: Dict[str, np.ndarray],
+    margin: Optional[int] = 25,
+    fivemc_code: Optional[str] = None,
+) -> Dict[str, pd.DataFrame]:
+    """Same as `get_methyl_calls_per_read` for all chromosomes at once, 
+    reading the bam file from start to end in a single pass. 
+
+    No index is needed, which suits the small bam files written during a 
+    run, and the file is opened only once instead of once per chromosome.
+
+    Args:
+        bam_file (str): path to the bam file
+        probe_starts (dict): start positions of the probes of each chromosome
+        margin (int): calls within this distance of a probe are kept
+        fivemc_code (str): see `add_read_methyl_calls`
+
+    Returns:
+        dict with the methylation calls per position of each chromosome
     """
 
+    import pysam
+
+    chromosomes = {bam_chromosome_name(c): c for c in probe_starts.keys()}
+    windows = {
+        bam_chromosome_name(c): ProbeWindows(starts, margin)
+        for c, starts in probe_starts.items()
+    }
+    calls_buffers = {name: CallsBuffer() for name in chromosomes.keys()}
+
+    with pysam.AlignmentFile(bam_file, 'rb', check_sq = False) as bam:
+        for read in bam.fetch(until_eof = True):
+
+            calls_buffer = calls_buffers.get(read.reference_name)
+            if calls_buffer is None:
+                continue
+            add_read_methyl_calls(
+                calls_buffer, read, windows[read.reference_name], fivemc_code,
+            )
+
+    return {
+        chromosome: calls_buffers[name].to_dataframe(name[3:])
+        for name, chromosome in chromosomes.items()
+    }
+
+def use_index_free_scan(bam_file: str) -> bool:
+    """Whether a bam file is read in a single pass with 
+    `scan_methyl_calls_per_read`, small files and files without an index are
+    """
+
+    if os.path.getsize(bam_file) < INDEX_FREE_BAM_SIZE:
+        return True
+    return not (
+        os.path.exists(bam_file + '.bai') or os.path.exists(bam_file + '.csi')
+    )
+
+def sorted_chromosome_probes(probes_df: pd.DataFrame) -> pd.DataFrame:
+    """Probes of a chromosome with a location, sorted by their start"""
+
     probes_df = probes_df[probes_df['start'] > -1]
     probes_df = probes_df.sort_values(['start'])
     probes_df.reset_index(inplace = True, drop = True)
-    methyl_calls_per_read = methyl_calls_per_read.sort_values(['reference_pos'])
-    methyl_calls_per_read.reset_index(inplace = True, drop = True)
+    return probes_df
 
-    starts = np.array(probes_df['start']) - margin
-    ends = starts + margin * 2 + 1
+def probe_window_votes(
+    starts: np.ndarray,
+    queries: np.ndarray,
+    scores: np.ndarray,
+    margin: int, 
+    neg_threshold: float,
+    pos_threshold: float,
+) -> np.ndarray:
+    """Net methylation votes of the calls around each probe
+
+    Each call votes +1 if methylated, -1 if unmethylated and not at all 
+    otherwise. Votes of different sets of calls can be added up, the sign of
+    the sum is the median of all the votes, and a tie gives no call.
+
+    Args:
+        starts (np.ndarray): start position of each probe
+        queries (np.ndarray): sorted positions of the calls
+        scores (np.ndarray): score of each call
+        margin (int): calls within this distance of a probe are considered
+        neg_threshold (float): scores below are unmethylated calls
+        pos_threshold (float): scores above are methylated calls
+
+    Returns an array with the sum of the votes around each probe
+    """
 
-    queries = np.array(methyl_calls_per_read['reference_pos'])
-    scores = np.array(methyl_calls_per_read['score'])
+    starts = np.asarray(starts) - margin
+    ends = starts + margin * 2 + 1
 
     s = np.searchsorted(queries, starts, 'left')
     n = np.searchsorted(queries, ends, 'right')
 
-    f = np.where(s != n)[0]
+    # the votes of a window are differences of the cumulative sum
+    votes = (scores > pos_threshold).astype(np.int64) - (scores < neg_threshold)
+    cumulative_votes = np.zeros(len(scores) + 1, dtype = np.int64)
+    np.cumsum(votes, out = cumulative_votes[1:])
 
-    s = s[f]
-    n = n[f]
+    return cumulative_votes[n] - cumulative_votes[s]
 
-    with SuppressPandasWarning():
-        for ss, nn, ff in zip(s, n, f):
+def count_probe_window_calls(
+    starts: np.ndarray,
+    methyl_calls_per_read: pd.DataFrame,
+    margin: int, 
+    neg_threshold: float,
+    pos_threshold: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Methylation call of each probe from the calls per read around it
 
-            current_scores = scores[ss:nn]
-            bin_scores = np.zeros(current_scores.shape)
+    Args:
+        starts (np.ndarray): start position of each probe
+        methyl_calls_per_read (pd.DataFrame): calls per read of the same 
+            chromosome, with reference_pos and score columns
+        margin (int): calls within this distance of a probe are considered
+        neg_threshold (float): scores below are unmethylated calls
+        pos_threshold (float): scores above are methylated calls
+
+    Returns two arrays with the number of methylated and unmethylated calls
+    of each probe
+    """
 
-            bin_scores[current_scores > pos_threshold] = 1
-            bin_scores[current_scores < neg_threshold] = -1
+    methyl_calls_per_read = methyl_calls_per_read.sort_values(['reference_pos'])
 
-            bin_scores = bin_scores[bin_scores != 0]
-            if len(bin_scores) == 0:
-                continue
-            
-            final_score = int(np.median(bin_scores))
-            
-            if final_score == 1:
-                probes_df.loc[ff, 'methylation_calls'] += 1
-            elif final_score == -1:
-                probes_df.loc[ff, 'unmethylation_calls'] += 1
-            else:
-                continue
+    votes = probe_window_votes(
+        starts = starts,
+        queries = np.array(methyl_calls_per_read['reference_pos']),
+        scores = np.array(methyl_calls_per_read['score']),
+        margin = margin,
+        neg_threshold = neg_threshold,
+        pos_threshold = pos_threshold,
+    )
 
-        probes_df['total_calls'] = probes_df['methylation_calls'] + probes_df['unmethylation_calls']
+    return (votes > 0).astype(np.int64), (votes < 0).astype(np.int64)
+
+@traced
+def map_methyl_calls_to_probes_chr(
+    probes_df: pd.DataFrame,
+    methyl_calls_per_read: pd.DataFrame,
+    margin: int, 
+    neg_threshold: float,
+    pos_threshold: float,
+) -> pd.DataFrame:
+    """Maps calls per read to probe locations in a chromosome
+    """
+
+    probes_df = sorted_chromosome_probes(probes_df)
+
+    methylation_calls, unmethylation_calls = count_probe_window_calls(
+        starts = np.array(probes_df['start']),
+        methyl_calls_per_read = methyl_calls_per_read,
+        margin = margin,
+        neg_threshold = neg_threshold,
+        pos_threshold = pos_threshold,
+    )
+
+    probes_df['methylation_calls'] += methylation_calls
+    probes_df['unmethylation_calls'] += unmethylation_calls
+    probes_df['total_calls'] = probes_df['methylation_calls'] + probes_df['unmethylation_calls']
 
     return probes_df
 
+@traced
 def merge_probes_methyl_calls(
     file_list: List[str],
     output_file: str,
@@ -167,10 +586,23 @@ def merge_probes_methyl_calls(
 
     return output_df
 
+@traced
 def probes_methyl_calls_to_bed(
     input_file: str,
     output_file: str,
+    probe_index = None,
 ) -> pd.DataFrame:
+    """Convert the probe methylation calls to a bed file ready for prediction
+
+    Args:
+        input_file (str): merged probe methylation calls file
+        output_file (str): path where to save the bed file
+        probe_index (sturgeon.prediction.ProbeIndex): if given, the returned
+            dataframe has a `probe_idx` column with the integer position of
+            each probe in this index. It is not written to the bed file.
+
+    Returns a pd.DataFrame with the contents of the bed file
+    """
 
     bed_df = {
         "chrom": list(), 
@@ -215,15 +647,34 @@ def probes_methyl_calls_to_bed(
         sep = '\t'
     )
 
+    if probe_index is not None:
+        bed_df['probe_idx'] = probe_index.positions(bed_df['probe_id'])
+
     return bed_df
 
+@traced
 def bam_to_calls(
     bam_file: str,
     probes_df: pd.DataFrame,
     margin: int,
     neg_threshold: float,
     pos_threshold: float,
+    index_free: Optional[bool] = None,
+    fivemc_code: Optional[str] = None,
 ):
+    """Calls per probe and calls per read of a bam file
+
+    Args:
+        bam_file (str): path to the bam file
+        probes_df (pd.DataFrame): probes as read by `read_probes_file`
+        margin, neg_threshold, pos_threshold: see `probe_window_votes`
+        index_free (bool): read the whole file in a single pass instead of
+            each chromosome with the index, see `use_index_free_scan` for 
+            when this is done if not given
+        fivemc_code (str): see `add_read_methyl_calls`
+
+    Returns the calls per probe and the calls per read
+    """
 
     chromosomes = np.unique(probes_df['chr'])
 
@@ -231,14 +682,34 @@ def bam_to_calls(
     probes_df['unmethylation_calls'] = 0
     probes_df['total_calls'] = 0
 
+    if index_free is None:
+        index_free = use_index_free_scan(bam_file)
+
+    if index_free:
+        scanned_calls = scan_methyl_calls_per_read(
+            bam_file,
+            {
+                chrom.item(): np.array(probes_df.loc[probes_df['chr'] == chrom.item(), 'start'])
+                for chrom in chromosomes
+            },
+            margin = margin,
+            fivemc_code = fivemc_code,
+        )
+
     calls_per_probe = list()
     calls_per_read = list()
     for chrom in chromosomes:
 
-        calls_per_read_df = get_methyl_calls_per_read(
-            bam_file,
-            chrom.item(),
-        )
+        if index_free:
+            calls_per_read_df = scanned_calls[chrom.item()]
+        else:
+            calls_per_read_df = get_methyl_calls_per_read(
+                bam_file,
+                chrom.item(),
+                probe_starts = np.array(probes_df.loc[probes_df['chr'] == chrom.item(), 'start']),
+                margin = margin,
+                fivemc_code = fivemc_code,
+            )
 
         calls_per_probe_df = map_methyl_calls_to_probes_chr(
             probes_df = probes_df[probes_df['chr'] == chrom.item()],
@@ -259,10 +730,814 @@ def bam_to_calls(
         calls_per_read.append(calls_per_read_df)
             
     calls_per_probe = pd.concat(calls_per_probe)
-    calls_per_read = pd.concat(calls_per_read)
+    calls_per_read = concat_calls_per_read(calls_per_read)
 
     return calls_per_probe, calls_per_read
 
+
+class ProbeLayout():
+    """Probes of each chromosome sorted by their start, one chromosome after
+    the other
+
+    The calls of a file are accumulated as an array with the votes of each
+    probe in this order, see `probe_window_votes`.
+
+    Args:
+        probes_df (pd.DataFrame): probes as read by `read_probes_file`
+    """
+
+    def __init__(self, probes_df: pd.DataFrame):
+
+        probes_df = deepcopy(probes_df)
+        probes_df['methylation_calls'] = 0
+        probes_df['unmethylation_calls'] = 0
+        probes_df['total_calls'] = 0
+
+        # (chromosome, offset, length) of each chromosome
+        self.chromosomes = list()
+        self.chromosome_dfs = list()
+        offset = 0
+        for chrom in np.unique(probes_df['chr']):
+            chrom_df = sorted_chromosome_probes(
+                probes_df[probes_df['chr'] == chrom.item()]
+            )
+            self.chromosomes.append((chrom.item(), offset, len(chrom_df)))
+            self.chromosome_dfs.append(chrom_df)
+            offset += len(chrom_df)
+
+        self.size = offset
+        self.starts = np.zeros(self.size, dtype = np.int64)
+        for chrom_df, (_, offset, length) in zip(self.chromosome_dfs, self.chromosomes):
+            self.starts[offset:offset + length] = chrom_df['start']
+
+    def calls_per_probe(self, votes: np.ndarray) -> pd.DataFrame:
+        """Calls per probe of all chromosomes, as given by 
+        `map_methyl_calls_to_probes_chr`, from the votes of each probe
+        """
+
+        calls_per_probe = list()
+        for chrom_df, (chrom, offset, length) in zip(self.chromosome_dfs, self.chromosomes):
+
+            chrom_votes = votes[offset:offset + length]
+
+            chrom_df = chrom_df.copy()
+            chrom_df['methylation_calls'] += (chrom_votes > 0).astype(np.int64)
+            chrom_df['unmethylation_calls'] += (chrom_votes < 0).astype(np.int64)
+            chrom_df['total_calls'] = chrom_df['methylation_calls'] + chrom_df['unmethylation_calls']
+            calls_per_probe.append(chrom_df)
+
+            logging.debug(
+                '''
+                Found a total of {} methylation array sites on chromosome {}
+                '''.format(chrom_df['total_calls'].sum(), chrom)
+            )
+
+        return pd.concat(calls_per_probe)
+
+
+class ProbeCallCounts():
+    """Methylation and unmethylation calls of each probe added up over all
+    the files of a live run
+
+    The counts are kept in memory as int32 vectors in the order of a 
+    `ProbeLayout`, the calls per probe of each new file are added to them in
+    place instead of merging probe files on disk.
+
+    Args:
+        probes_df (pd.DataFrame): probes as read by `read_probes_file`
+    """
+
+    def __init__(self, probes_df: pd.DataFrame):
+
+        probe_layout = ProbeLayout(probes_df)
+        self.probes_df = pd.concat(probe_layout.chromosome_dfs).drop(
+            columns = ['methylation_calls', 'unmethylation_calls', 'total_calls']
+        )
+        self.probes_df.reset_index(inplace = True, drop = True)
+        self.probe_ids = pd.Index(self.probes_df['ID_REF'])
+
+        self.methylation_calls = np.zeros(len(self.probes_df), dtype = np.int32)
+        self.unmethylation_calls = np.zeros(len(self.probes_df), dtype = np.int32)
+        self.num_files = 0
+
+        # positions of the probes in the model probe index, see `bed`
+        self._index_positions = None
+        self._index_key = None
+
+    def positions(self, probe_ids) -> np.ndarray:
+        """Position of each probe id in the counts, -1 if not a probe"""
+
+        probe_ids = np.asarray(probe_ids)
+        # calls per probe come in the same order as the counts
+        if len(probe_ids) == len(self.probe_ids) and np.array_equal(
+            probe_ids, self.probe_ids.values
+        ):
+            return np.arange(len(probe_ids))
+        return self.probe_ids.get_indexer(probe_ids)
+
+    def add(
+        self, 
+        calls_per_probe: pd.DataFrame,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Add the calls per probe of a file, as given by `bam_to_calls` or 
+        `mega_file_to_bed`
+
+        Returns the positions of the probes with calls in the file, and
+        their methylation and unmethylation calls, see `apply`
+        """
+
+        positions = self.positions(calls_per_probe['ID_REF'])
+        methylation_calls = np.asarray(
+            calls_per_probe['methylation_calls'], dtype = np.int32,
+        )
+        unmethylation_calls = np.asarray(
+            calls_per_probe['unmethylation_calls'], dtype = np.int32,
+        )
+        called = (positions > -1) & ((methylation_calls + unmethylation_calls) > 0)
+        change = (
+            positions[called].astype(np.int32), 
+            methylation_calls[called], 
+            unmethylation_calls[called],
+        )
+
+        self.apply(change)
+        self.num_files += 1
+        return change
+
+    def apply(
+        self,
+        change: Tuple[np.ndarray, np.ndarray, np.ndarray],
+        counts: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    ):
+        """Add the calls of a file, as returned by `add`, to the counts or 
+        to a copy of them, see `counts`
+        """
+
+        if counts is None:
+            counts = (self.methylation_calls, self.unmethylation_calls)
+        positions, methylation_calls, unmethylation_calls = change
+        counts[0][positions] += methylation_calls
+        counts[1][positions] += unmethylation_calls
+
+    def counts(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Copy of the methylation and unmethylation calls so far"""
+
+        return self.methylation_calls.copy(), self.unmethylation_calls.copy()
+
+    def calls_per_probe(self) -> pd.DataFrame:
+        """Calls per probe added up so far, the contents of a merged probe
+        methylation calls file, see `merge_probes_methyl_calls`
+        """
+
+        calls_per_probe = self.probes_df.copy()
+        calls_per_probe['methylation_calls'] = self.methylation_calls
+        calls_per_probe['unmethylation_calls'] = self.unmethylation_calls
+        calls_per_probe['total_calls'] = self.methylation_calls + self.unmethylation_calls
+        return calls_per_probe
+
+    def bed(
+        self, 
+        probe_index = None, 
+        counts: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    ) -> pd.DataFrame:
+        """Measured probes as a bed dataframe, the same as 
+        `probes_methyl_calls_to_bed` of the merged calls per probe
+
+        Args:
+            probe_index (sturgeon.prediction.ProbeIndex): if given, the 
+                returned dataframe has a `probe_idx` column with the integer
+                position of each probe in this index
+            counts (tuple): methylation and unmethylation calls to be used
+                instead of the current ones, see `counts`
+
+        Returns a pd.DataFrame with the contents of the bed file
+        """
+
+        if counts is None:
+            counts = (self.methylation_calls, self.unmethylation_calls)
+        methylation_calls, unmethylation_calls = counts
+
+        # probes with as many calls of each kind are not measured
+        measured = np.where(methylation_calls != unmethylation_calls)[0]
+        probes_df = self.probes_df.iloc[measured]
+
+        bed_df = pd.DataFrame({
+            "chrom": probes_df['chr'].values, 
+            "chromStart": probes_df['start'].values, 
+            "chromEnd": probes_df['end'].values, 
+            "methylation_call": (
+                methylation_calls[measured] > unmethylation_calls[measured]
+            ).astype(np.int64), 
+            "probe_id": probes_df['ID_REF'].values,
+        })
+        logging.info('Total measured array CpG sites: {}'.format(bed_df.shape[0]))
+
+        if probe_index is not None:
+            # probes are only ever appended to an index
+            index_key = (id(probe_index), len(probe_index))
+            if self._index_key != index_key:
+                self._index_positions = probe_index.positions(self.probe_ids)
+                self._index_key = index_key
+            bed_df['probe_idx'] = self._index_positions[measured]
+
+        return bed_df
+
+
+class ByteRange(io.RawIOBase):
+    """Read only file object over an open binary file, up to byte end"""
+
+    def __init__(self, handle, end: int):
+
+        self.handle = handle
+        self.end = end
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+
+        remaining = self.end - self.handle.tell()
+        if remaining <= 0:
+            return 0
+        return self.handle.readinto(memoryview(buffer)[:remaining])
+
+def file_byte_ranges(input_file: str, num_ranges: int) -> List[Tuple[int, int]]:
+    """Split a text file with a header line in ranges of whole lines
+
+    Args:
+        input_file (str): file to be split
+        num_ranges (int): number of ranges, fewer are returned for small files
+
+    Returns a list of (start, end) byte offsets, after the header line
+    """
+
+    size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as handle:
+        handle.readline()
+        boundaries = [handle.tell()]
+        first = boundaries[0]
+        for i in range(1, num_ranges):
+            position = first + (size - first) * i // num_ranges
+            if position <= boundaries[-1]:
+                continue
+            # move to the start of the next line
+            handle.seek(position - 1)
+            handle.readline()
+            boundaries.append(handle.tell())
+    boundaries.append(size)
+
+    return [
+        (st, nd) for st, nd in zip(boundaries[:-1], boundaries[1:]) if nd > st
+    ]
+
+def read_csv_chunks(
+    input_file: str,
+    dtypes: dict,
+    chunk_size: Optional[int] = CHUNK_SIZE,
+    byte_range: Optional[Tuple[int, int]] = None,
+) -> Iterator[pd.DataFrame]:
+    """Read some columns of a tab separated file, chunk_size rows at a time
+
+    Args:
+        input_file (str): file with a header line
+        dtypes (dict): columns to be read and their types
+        chunk_size (int): number of rows of each chunk
+        byte_range (tuple): only read the lines between these byte offsets,
+            see `file_byte_ranges`. The whole file if not given
+
+    Yields dataframes with the columns in dtypes
+    """
+
+    with open(input_file, 'rb') as handle:
+
+        column_names = handle.readline().decode().rstrip('\r\n').split('\t')
+        if byte_range is None:
+            byte_range = (handle.tell(), os.path.getsize(input_file))
+        if byte_range[0] >= byte_range[1]:
+            return
+        handle.seek(byte_range[0])
+
+        reader = pd.read_csv(
+            io.BufferedReader(ByteRange(handle, byte_range[1])),
+            sep = '\t',
+            header = None,
+            names = column_names,
+            usecols = list(dtypes.keys()),
+            dtype = dtypes,
+            chunksize = chunk_size,
+        )
+        with reader:
+            for chunk in reader:
+                yield chunk
+
+def read_megalodon_chunks(
+    input_file: str,
+    chunk_size: Optional[int] = CHUNK_SIZE,
+    byte_range: Optional[Tuple[int, int]] = None,
+) -> Iterator[pd.DataFrame]:
+    """Calls per read of a megalodon file, see `read_csv_chunks`
+
+    Yields dataframes with chr, reference_pos and score columns
+    """
+
+    for chunk in read_csv_chunks(input_file, MEGALODON_DTYPES, chunk_size, byte_range):
+        yield pd.DataFrame({
+            'chr': chunk['chrm'],
+            'reference_pos': chunk['pos'],
+            'score': np.exp(chunk['mod_log_prob']),
+        })
+
+def read_modkit_chunks(
+    input_file: str,
+    chunk_size: Optional[int] = CHUNK_SIZE,
+    byte_range: Optional[Tuple[int, int]] = None,
+    fivemc_code: str = 'm',
+) -> Iterator[pd.DataFrame]:
+    """5mC calls per read of a modkit file, see `read_csv_chunks`
+
+    Yields dataframes with chr, reference_pos and score columns
+    """
+
+    for chunk in read_csv_chunks(input_file, MODKIT_DTYPES, chunk_size, byte_range):
+        chunk = chunk[
+            (chunk['mod_code'] == fivemc_code)
+            & (chunk['canonical_base'] == 'C')
+            & (chunk['modified_primary_base'] == 'C')
+            & (chunk['ref_position'] != -1)
+            & (chunk['chrom'] != '.')
+        ]
+        yield pd.DataFrame({
+            'chr': chunk['chrom'],
+            'reference_pos': chunk['ref_position'],
+            'score': chunk['mod_qual'],
+        })
+
+def file_votes(
+    read_chunks: Callable,
+    input_file: str,
+    starts: np.ndarray,
+    chromosomes: List[tuple],
+    margin: int,
+    neg_threshold: float,
+    pos_threshold: float,
+    chunk_size: Optional[int] = CHUNK_SIZE,
+    byte_range: Optional[Tuple[int, int]] = None,
+    **reader_kwargs,
+) -> np.ndarray:
+    """Votes of each probe from the calls per read of a file, read one chunk
+    at a time so that memory does not grow with the file size
+
+    Args:
+        read_chunks (callable): `read_megalodon_chunks` or `read_modkit_chunks`
+        input_file (str): file with calls per read
+        starts (np.ndarray): probe starts, see `ProbeLayout`
+        chromosomes (list): (chromosome, offset, length) of the probe layout
+        margin, neg_threshold, pos_threshold: see `probe_window_votes`
+        chunk_size (int): rows read at a time
+        byte_range (tuple): only use the lines between these byte offsets
+        **reader_kwargs: passed to read_chunks
+
+    Returns an array with the votes of each probe
+    """
+
+    offsets = {
+        'chr' + str(chrom): (offset, length)
+        for chrom, offset, length in chromosomes
+    }
+    votes = np.zeros(len(starts), dtype = np.int64)
+
+    for chunk in read_chunks(
+        input_file,
+        chunk_size = chunk_size,
+        byte_range = byte_range,
+        **reader_kwargs,
+    ):
+        for chrom_name, chrom_calls in chunk.groupby('chr', observed = True, sort = False):
+
+            if chrom_name not in offsets:
+                continue
+            offset, length = offsets[chrom_name]
+
+            queries = np.asarray(chrom_calls['reference_pos'])
+            order = np.argsort(queries, kind = 'stable')
+            votes[offset:offset + length] += probe_window_votes(
+                starts = starts[offset:offset + length],
+                queries = queries[order],
+                scores = np.asarray(chrom_calls['score'])[order],
+                margin = margin,
+                neg_threshold = neg_threshold,
+                pos_threshold = pos_threshold,
+            )
+
+    return votes
+
+
+class SharedProbes():
+    """Probe starts of a layout in shared memory
+
+    Worker processes attach to the shared memory block by name instead of
+    getting a pickled copy of the probes dataframe.
+
+    Args:
+        probe_layout (ProbeLayout): layout of the probes
+
+    Raises ImportError if shared memory is not available (python < 3.8)
+    """
+
+    def __init__(self, probe_layout: ProbeLayout):
+
+        from multiprocessing import shared_memory
+
+        self.size = probe_layout.size
+        self.shm = shared_memory.SharedMemory(
+            create = True, size = max(self.size, 1) * 8,
+        )
+        starts = np.ndarray((self.size, ), dtype = np.int64, buffer = self.shm.buf)
+        starts[:] = probe_layout.starts
+        del starts
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# shared probe starts attached by each extraction worker
+_worker_shm = None
+_worker_starts = None
+_worker_chromosomes = None
+
+def _init_extraction_worker(
+    shm_name: Optional[str], 
+    size: int, 
+    chromosomes: List[tuple],
+    starts: Optional[np.ndarray] = None,
+):
+
+    # ctrl-c is handled by the main process, which shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    global _worker_shm, _worker_starts, _worker_chromosomes
+    _worker_chromosomes = chromosomes
+    # without shared memory each worker gets its own copy of the starts
+    if shm_name is None:
+        _worker_starts = starts
+        return
+
+    from multiprocessing import shared_memory
+
+    _worker_shm = shared_memory.SharedMemory(name = shm_name)
+    _worker_starts = np.ndarray((size, ), dtype = np.int64, buffer = _worker_shm.buf)
+
+def _worker_ready() -> int:
+
+    return os.getpid()
+
+def _extract_bam_chromosome(
+    bam_file: str,
+    chromosome,
+    offset: int,
+    length: int,
+    margin: int,
+    neg_threshold: float,
+    pos_threshold: float,
+    fivemc_code: Optional[str] = None,
+):
+
+    starts = _worker_starts[offset:offset + length]
+    calls_per_read_df = get_methyl_calls_per_read(
+        bam_file, 
+        chromosome, 
+        probe_starts = starts,
+        margin = margin,
+        fivemc_code = fivemc_code,
+    )
+    votes = probe_window_votes(
+        starts = starts,
+        queries = np.array(calls_per_read_df['reference_pos']),
+        scores = np.array(calls_per_read_df['score']),
+        margin = margin,
+        neg_threshold = neg_threshold,
+        pos_threshold = pos_threshold,
+    )
+    return [(offset, votes, calls_per_read_df)]
+
+def _scan_bam_file(
+    bam_file: str,
+    margin: int,
+    neg_threshold: float,
+    pos_threshold: float,
+    fivemc_code: Optional[str] = None,
+):
+
+    scanned_calls = scan_methyl_calls_per_read(
+        bam_file,
+        {
+            chrom: _worker_starts[offset:offset + length]
+            for chrom, offset, length in _worker_chromosomes
+        },
+        margin = margin,
+        fivemc_code = fivemc_code,
+    )
+
+    results = list()
+    for chrom, offset, length in _worker_chromosomes:
+        calls_per_read_df = scanned_calls[chrom]
+        votes = probe_window_votes(
+            starts = _worker_starts[offset:offset + length],
+            queries = np.array(calls_per_read_df['reference_pos']),
+            scores = np.array(calls_per_read_df['score']),
+            margin = margin,
+            neg_threshold = neg_threshold,
+            pos_threshold = pos_threshold,
+        )
+        results.append((offset, votes, calls_per_read_df))
+    return results
+
+def _extract_file_range(read_chunks: Callable, input_file: str, **kwargs):
+
+    return file_votes(
+        read_chunks,
+        input_file,
+        starts = _worker_starts,
+        chromosomes = _worker_chromosomes,
+        **kwargs,
+    )
+
+
+class ExtractionPool():
+    """Process pool that gets the methylation calls of input files. Bam files
+    are split in a task for each chromosome, unless they are read in a single
+    pass (see `use_index_free_scan`), megalodon and modkit files in a task 
+    for each byte range
+
+    The workers are started from a fresh process (forkserver, or spawn where
+    that is not available) instead of forking this one, which might already
+    run other threads, as during a live run, whose locks would stay locked
+    in the forked workers. They are started right away, and everything they
+    need is given to them by `_init_extraction_worker`.
+
+    Args:
+        probes_df (pd.DataFrame): probes as read by `read_probes_file`
+        workers (int): number of worker processes
+    """
+
+    def __init__(self, probes_df: pd.DataFrame, workers: int):
+
+        self.workers = workers
+        self.probe_layout = ProbeLayout(probes_df)
+        try:
+            self.probes = SharedProbes(self.probe_layout)
+            initargs = (
+                self.probes.name, 
+                self.probes.size, 
+                self.probe_layout.chromosomes,
+            )
+        except ImportError:
+            # shared memory needs python 3.8
+            self.probes = None
+            initargs = (
+                None, 
+                self.probe_layout.size, 
+                self.probe_layout.chromosomes,
+                self.probe_layout.starts,
+            )
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('forkserver')
+        else:
+            mp_context = multiprocessing.get_context('spawn')
+        self.executor = ProcessPoolExecutor(
+            max_workers = workers,
+            mp_context = mp_context,
+            initializer = _init_extraction_worker,
+            initargs = initargs,
+        )
+        # tasks not finished yet, cancelled on shutdown
+        self.futures = set()
+
+        # start the workers now, a worker that fails to start raises here
+        ready = [self.executor.submit(_worker_ready) for _ in range(workers)]
+        wait(ready)
+        for future in ready:
+            future.result()
+        logging.info("Started {} extraction workers".format(workers))
+
+    def bam_to_calls(
+        self,
+        bam_files: List[str],
+        margin: int,
+        neg_threshold: float,
+        pos_threshold: float,
+        fivemc_code: Optional[str] = None,
+    ) -> Iterator[Tuple[str, pd.DataFrame, pd.DataFrame]]:
+        """Same as `bam_to_calls` for several bam files at the same time
+
+        All tasks are submitted at once, the results are gathered one file
+        after the other, in the given order.
+
+        Yields the bam file, its calls per probe and its calls per read
+        """
+
+        futures = list()
+        for bam_file in bam_files:
+            if use_index_free_scan(bam_file):
+                futures.append([
+                    self.submit(
+                        _scan_bam_file,
+                        bam_file,
+                        margin,
+                        neg_threshold,
+                        pos_threshold,
+                        fivemc_code,
+                    )
+                ])
+                continue
+
+            futures.append([
+                self.submit(
+                    _extract_bam_chromosome,
+                    bam_file,
+                    chrom,
+                    offset,
+                    length,
+                    margin,
+                    neg_threshold,
+                    pos_threshold,
+                    fivemc_code,
+                )
+                for chrom, offset, length in self.probe_layout.chromosomes
+            ])
+
+        try:
+            for bam_file, file_futures in zip(bam_files, futures):
+
+                votes = np.zeros(self.probe_layout.size, dtype = np.int64)
+                calls_per_read = list()
+                for future in file_futures:
+                    for offset, chrom_votes, calls_per_read_df in future.result():
+                        votes[offset:offset + len(chrom_votes)] = chrom_votes
+                        calls_per_read.append(calls_per_read_df)
+
+                yield (
+                    bam_file, 
+                    self.probe_layout.calls_per_probe(votes), 
+                    concat_calls_per_read(calls_per_read),
+                )
+        finally:
+            for future in sum(futures, list()):
+                future.cancel()
+
+    def text_to_calls(
+        self,
+        read_chunks: Callable,
+        input_files: List[str],
+        margin: int,
+        neg_threshold: float,
+        pos_threshold: float,
+        chunk_size: Optional[int] = CHUNK_SIZE,
+        **reader_kwargs,
+    ) -> Iterator[Tuple[str, pd.DataFrame]]:
+        """Calls per probe of megalodon or modkit files, each file is split
+        in byte ranges that are read at the same time
+
+        Args:
+            read_chunks (callable): `read_megalodon_chunks` or 
+                `read_modkit_chunks`
+            input_files (list): files to be processed
+            margin, neg_threshold, pos_threshold: see `probe_window_votes`
+            chunk_size (int): rows read at a time by each worker
+            **reader_kwargs: passed to read_chunks
+
+        Yields each input file and its calls per probe, in the given order
+        """
+
+        futures = [
+            [
+                self.submit(
+                    _extract_file_range,
+                    read_chunks,
+                    input_file,
+                    margin = margin,
+                    neg_threshold = neg_threshold,
+                    pos_threshold = pos_threshold,
+                    chunk_size = chunk_size,
+                    byte_range = byte_range,
+                    **reader_kwargs,
+                )
+                for byte_range in file_byte_ranges(input_file, self.workers)
+            ]
+            for input_file in input_files
+        ]
+
+        try:
+            for input_file, file_futures in zip(input_files, futures):
+
+                votes = np.zeros(self.probe_layout.size, dtype = np.int64)
+                for future in file_futures:
+                    votes += future.result()
+
+                yield input_file, self.probe_layout.calls_per_probe(votes)
+        finally:
+            for future in sum(futures, list()):
+                future.cancel()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+
+        future = self.executor.submit(fn, *args, **kwargs)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def shutdown(self):
+
+        for future in list(self.futures):
+            future.cancel()
+        self.executor.shutdown(wait = True)
+        if self.probes is not None:
+            self.probes.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+def text_files_to_calls(
+    read_chunks: Callable,
+    input_files: List[str],
+    probes_file: str,
+    margin: int,
+    neg_threshold: float,
+    pos_threshold: float,
+    chunk_size: Optional[int] = CHUNK_SIZE,
+    workers: Optional[int] = 1,
+    **reader_kwargs,
+) -> Iterator[pd.DataFrame]:
+    """Calls per probe of megalodon or modkit files, with an `ExtractionPool`
+    if workers > 1
+
+    Yields the calls per probe of each file, in the order of input_files
+    """
+
+    if len(input_files) == 0:
+        return
+
+    probes_df = read_probes_file(probes_file)
+
+    if workers > 1:
+        with ExtractionPool(probes_df, workers) as extraction_pool:
+            for _, calls_per_probe in extraction_pool.text_to_calls(
+                read_chunks,
+                input_files,
+                margin = margin,
+                neg_threshold = neg_threshold,
+                pos_threshold = pos_threshold,
+                chunk_size = chunk_size,
+                **reader_kwargs,
+            ):
+                yield calls_per_probe
+        return
+
+    probe_layout = ProbeLayout(probes_df)
+    for input_file in input_files:
+
+        logging.info('Processing file: {}'.format(input_file))
+        votes = file_votes(
+            read_chunks,
+            input_file,
+            starts = probe_layout.starts,
+            chromosomes = probe_layout.chromosomes,
+            margin = margin,
+            neg_threshold = neg_threshold,
+            pos_threshold = pos_threshold,
+            chunk_size = chunk_size,
+            **reader_kwargs,
+        )
+        yield probe_layout.calls_per_probe(votes)
+
+
+def save_bam_calls(
+    bam_file: str,
+    output_path: str,
+    calls_per_probe: pd.DataFrame,
+    calls_per_read: pd.DataFrame,
+):
+    """Save the calls per probe and per read of a bam file in output_path"""
+
+    bam_name = Path(bam_file).stem
+    calls_per_probe.to_csv(
+        os.path.join(output_path, bam_name + '_probes_methyl_calls.txt'), 
+        header = True, index = False, sep = '\t'
+    )
+    calls_per_read.to_csv(
+        os.path.join(output_path, bam_name + '_read_methyl_calls.txt'), 
+        header = True, index = False, sep = '\t'
+    )
+
 def bam_path_to_bed(
     input_path: List[str],
     output_path: str,
@@ -270,11 +1545,14 @@ def bam_path_to_bed(
     margin: Optional[int] = 25,
     neg_threshold: Optional[float] = 0.3,
     pos_threshold: Optional[float] = 0.7,
+    workers: Optional[int] = 1,
+    fivemc_code: Optional[str] = None,
 ):
 
     probes_df = read_probes_file(probes_file)
 
     output_files = list()
+    pending_files = list()
 
     for bam_file in input_path:
 
@@ -300,27 +1578,33 @@ def bam_path_to_bed(
             )
             continue
 
-        probes_methyl_df = deepcopy(probes_df)
-        logging.info('Processing bam file: {}'.format(bam_file))
-
-        calls_per_probe, calls_per_read = bam_to_calls(
-            bam_file = bam_file,
-            probes_df = probes_methyl_df,
-            margin = margin,
-            neg_threshold = neg_threshold,
-            pos_threshold = pos_threshold,
-        )
-
-        calls_per_probe.to_csv(
-            output_file, header = True, index = False, sep = '\t'
-        )
-        ofile = os.path.join(
-            output_path,
-            bam_name + '_read_methyl_calls.txt'
-        )
-        calls_per_read.to_csv(
-            ofile, header = True, index = False, sep = '\t'
-        )
+        pending_files.append(bam_file)
+
+    if workers > 1 and len(pending_files) > 0:
+        with ExtractionPool(probes_df, workers) as extraction_pool:
+            for bam_file, calls_per_probe, calls_per_read in extraction_pool.bam_to_calls(
+                bam_files = pending_files,
+                margin = margin,
+                neg_threshold = neg_threshold,
+                pos_threshold = pos_threshold,
+                fivemc_code = fivemc_code,
+            ):
+                save_bam_calls(bam_file, output_path, calls_per_probe, calls_per_read)
+    else:
+        for bam_file in pending_files:
+
+            probes_methyl_df = deepcopy(probes_df)
+            logging.info('Processing bam file: {}'.format(bam_file))
+
+            calls_per_probe, calls_per_read = bam_to_calls(
+                bam_file = bam_file,
+                probes_df = probes_methyl_df,
+                margin = margin,
+                neg_threshold = neg_threshold,
+                pos_threshold = pos_threshold,
+                fivemc_code = fivemc_code,
+            )
+            save_bam_calls(bam_file, output_path, calls_per_probe, calls_per_read)
 
     merged_output_file = os.path.join(
         output_path, 
@@ -341,68 +1625,31 @@ def bam_path_to_bed(
     )
 
 
+@traced
 def mega_file_to_bed(
     input_file: str,
     probes_file: str,
     margin: Optional[int] = 25,
     neg_threshold: Optional[float] = 0.3,
     pos_threshold: Optional[float] = 0.7,
+    chunk_size: Optional[int] = CHUNK_SIZE,
 ) -> pd.DataFrame:
 
-    probes_df = read_probes_file(probes_file)
-
     logging.info(
         '''
         Getting methylation calls from: {}
         '''.format(input_file)
     )
 
-    mega_calls = pd.read_csv(
-        input_file,
-        header = 0,
-        index_col = None,
-        sep = '\t',
+    calls_per_probe, = text_files_to_calls(
+        read_megalodon_chunks,
+        [input_file],
+        probes_file = probes_file,
+        margin = margin,
+        neg_threshold = neg_threshold,
+        pos_threshold = pos_threshold,
+        chunk_size = chunk_size,
     )
-    mega_calls = mega_calls.rename(columns = {
-        'chrm':'chr', 
-        'pos': 'reference_pos',
-    })
-    mega_calls['score'] = np.exp(mega_calls['mod_log_prob'])
-    mega_calls = mega_calls.drop(columns = [
-        'mod_log_prob', 
-        'can_log_prob', 
-        'mod_base',
-    ])
-
-    probes_methyl_df = deepcopy(probes_df)
-    logging.info('Processing megalodon file: {}'.format(input_file))
-
-    chromosomes = np.unique(probes_df['chr'])
-
-    probes_methyl_df['methylation_calls'] = 0
-    probes_methyl_df['unmethylation_calls'] = 0
-    probes_methyl_df['total_calls'] = 0
-
-    calls_per_probe = list()
-    for chrom in chromosomes:
-
-        calls_per_probe_chr =  map_methyl_calls_to_probes_chr(
-            probes_df =  probes_methyl_df[probes_methyl_df['chr'] == chrom.item()],
-            methyl_calls_per_read = mega_calls[mega_calls['chr'] == 'chr'+str(chrom.item())],
-            margin = margin, 
-            neg_threshold = neg_threshold,
-            pos_threshold = pos_threshold,
-        )
-        calls_per_probe.append(calls_per_probe_chr)
-
-        calls = calls_per_probe_chr['total_calls'].sum()
-        logging.debug(
-            '''
-            Found a total of {} methylation array sites on chromosome {}
-            '''.format(calls, chrom)
-        )
-
-    calls_per_probe = pd.concat(calls_per_probe)
     return calls_per_probe
 
 
@@ -413,10 +1660,13 @@ def mega_path_to_bed(
     margin: Optional[int] = 25,
     neg_threshold: Optional[float] = 0.3,
     pos_threshold: Optional[float] = 0.7,
+    workers: Optional[int] = 1,
+    chunk_size: Optional[int] = CHUNK_SIZE,
 ):
 
     
     output_files = list()
+    pending_files = list()
     for mega_file in input_path:
 
         logging.info(
@@ -441,13 +1691,19 @@ def mega_path_to_bed(
             )
             continue
 
-        calls_per_probe = mega_file_to_bed(
-            input_file = mega_file,
-            probes_file = probes_file,
-            margin = margin,
-            neg_threshold = neg_threshold,
-            pos_threshold = pos_threshold,
-        )
+        pending_files.append((mega_file, output_file))
+
+    calls_per_probe_dfs = text_files_to_calls(
+        read_megalodon_chunks,
+        [mega_file for mega_file, _ in pending_files],
+        probes_file = probes_file,
+        margin = margin,
+        neg_threshold = neg_threshold,
+        pos_threshold = pos_threshold,
+        chunk_size = chunk_size,
+        workers = workers,
+    )
+    for (mega_file, output_file), calls_per_probe in zip(pending_files, calls_per_probe_dfs):
 
         calls_per_probe.to_csv(
             output_file, header = True, index = False, sep = '\t'
@@ -472,6 +1728,7 @@ def mega_path_to_bed(
     )
 
 
+@traced
 def modkit_file_to_bed(
     input_file: str,
     probes_file: str,
@@ -479,73 +1736,21 @@ def modkit_file_to_bed(
     neg_threshold: Optional[float] = 0.3,
     pos_threshold: Optional[float] = 0.7,
     fivemc_code:str = 'm',
+    chunk_size: Optional[int] = CHUNK_SIZE,
 ) -> pd.DataFrame:
-    
-    mandatory_columns = [
-        "read_id", 
-        "chrom",
-        "ref_position",
-        "mod_qual",
-        "mod_code",
-        "canonical_base",
-        "modified_primary_base",
-    ]
-    modkit_df = pd.read_csv(
-        input_file, 
-        sep = '\t', 
-        header = 0, 
-        index_col = None, 
-        usecols= mandatory_columns
-    )
-
-    modkit_df = modkit_df[modkit_df['mod_code'] == fivemc_code]
-    modkit_df = modkit_df[modkit_df['canonical_base'] == 'C']
-    modkit_df = modkit_df[modkit_df['modified_primary_base'] == 'C']
-
-    modkit_df = modkit_df.rename(columns={
-        'chrom': 'chr',
-        'ref_position': 'reference_pos',
-        'mod_qual': 'score'
-    })
-    modkit_df = modkit_df.drop(columns=[
-        'mod_code',
-        'canonical_base',
-        'modified_primary_base'
-    ])
-    modkit_df = modkit_df[modkit_df['reference_pos'] != -1]
-    modkit_df = modkit_df[modkit_df['chr'] != '.']
-
-    probes_df = read_probes_file(probes_file)
 
-    probes_methyl_df = deepcopy(probes_df)
     logging.info('Processing modkit file: {}'.format(input_file))
 
-    chromosomes = np.unique(probes_df['chr'])
-
-    probes_methyl_df['methylation_calls'] = 0
-    probes_methyl_df['unmethylation_calls'] = 0
-    probes_methyl_df['total_calls'] = 0
-
-    calls_per_probe = list()
-    for chrom in chromosomes:
-
-        calls_per_probe_chr =  map_methyl_calls_to_probes_chr(
-            probes_df =  probes_methyl_df[probes_methyl_df['chr'] == chrom.item()],
-            methyl_calls_per_read = modkit_df[modkit_df['chr'] == 'chr'+str(chrom.item())],
-            margin = margin, 
-            neg_threshold = neg_threshold,
-            pos_threshold = pos_threshold,
-        )
-        calls_per_probe.append(calls_per_probe_chr)
-
-        calls = calls_per_probe_chr['total_calls'].sum()
-        logging.debug(
-            '''
-            Found a total of {} methylation array sites on chromosome {}
-            '''.format(calls, chrom)
-        )
-
-    calls_per_probe = pd.concat(calls_per_probe)
+    calls_per_probe, = text_files_to_calls(
+        read_modkit_chunks,
+        [input_file],
+        probes_file = probes_file,
+        margin = margin,
+        neg_threshold = neg_threshold,
+        pos_threshold = pos_threshold,
+        chunk_size = chunk_size,
+        fivemc_code = fivemc_code,
+    )
     return calls_per_probe
 
 
@@ -557,9 +1762,12 @@ def modkit_path_to_bed(
     neg_threshold: Optional[float] = 0.3,
     pos_threshold: Optional[float] = 0.7,
     fivemc_code:str = 'c',
+    workers: Optional[int] = 1,
+    chunk_size: Optional[int] = CHUNK_SIZE,
 ):
     
     output_files = list()
+    pending_files = list()
     for modkit_file in input_path:
 
         logging.info(
@@ -584,14 +1792,20 @@ def modkit_path_to_bed(
             )
             continue
 
-        calls_per_probe = modkit_file_to_bed(
-            input_file = modkit_file,
-            probes_file = probes_file,
-            margin = margin,
-            neg_threshold = neg_threshold,
-            pos_threshold = pos_threshold,
-            fivemc_code = fivemc_code,
-        )
+        pending_files.append((modkit_file, output_file))
+
+    calls_per_probe_dfs = text_files_to_calls(
+        read_modkit_chunks,
+        [modkit_file for modkit_file, _ in pending_files],
+        probes_file = probes_file,
+        margin = margin,
+        neg_threshold = neg_threshold,
+        pos_threshold = pos_threshold,
+        chunk_size = chunk_size,
+        workers = workers,
+        fivemc_code = fivemc_code,
+    )
+    for (modkit_file, output_file), calls_per_probe in zip(pending_files, calls_per_probe_dfs):
 
         if calls_per_probe is None:
             logging.info(
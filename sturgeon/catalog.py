@@ -0,0 +1,139 @@
+"""
+Catalog of the built-in models
+
+Listing the models only needs the standard library, so that the command line
+starts fast. The name, number of classes and number of probes of each model
+are cached in MODEL_CATALOG_FILE, and refreshed when the model directory or a
+model file changes.
+"""
+import os
+import json
+import zipfile
+import logging
+from pathlib import Path
+
+from sturgeon.constants import MODEL_CATALOG_FILE
+
+MODEL_DIR = os.path.join(os.path.dirname(__file__), 'include/models')
+
+# catalog already loaded in this process, with the model dir mtime
+_catalog_cache = dict()
+
+
+def model_file_info(model_file: str) -> dict:
+    """Summary of a model zip file without loading the model
+
+    Args:
+        model_file (str): path to the model zip file
+
+    Returns a dict with the number of classes and probes of the model, None
+    if they could not be read
+    """
+
+    info = {
+        'num_classes': None,
+        'num_probes': None,
+    }
+    try:
+        with zipfile.ZipFile(model_file, 'r') as zipf:
+            info['num_classes'] = len(json.load(zipf.open('decoding.json')))
+            with zipf.open('probes.csv') as handle:
+                # one header line
+                info['num_probes'] = sum(1 for _ in handle) - 1
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+        logging.debug("Could not read model file {}: {}".format(model_file, e))
+
+    return info
+
+def load_model_catalog(
+    model_dir: str = MODEL_DIR,
+    catalog_file: str = MODEL_CATALOG_FILE,
+) -> dict:
+    """Get the catalog of the models in model_dir
+
+    Args:
+        model_dir (str): directory with the model zip files
+        catalog_file (str): json file where the catalog is cached
+
+    Returns a dict with the model names as keys and a dict with the file,
+    number of classes and number of probes of each model as values
+    """
+
+    model_dir = os.path.abspath(model_dir)
+    dir_mtime = os.stat(model_dir).st_mtime_ns
+
+    cached = _catalog_cache.get(model_dir)
+    if cached is not None and cached[0] == dir_mtime:
+        return cached[1]
+
+    all_catalogs = dict()
+    if catalog_file is not None and os.path.isfile(catalog_file):
+        try:
+            with open(catalog_file, 'r') as handle:
+                all_catalogs = json.load(handle)
+        except (OSError, ValueError):
+            logging.debug("Could not read model catalog: {}".format(catalog_file))
+
+    previous = all_catalogs.get(model_dir, dict())
+
+    catalog = dict()
+    changed = previous.get('dir_mtime_ns') != dir_mtime
+    for f in sorted(os.listdir(model_dir)):
+        if not f.endswith('.zip'):
+            continue
+
+        model_file = os.path.join(model_dir, f)
+        stat = os.stat(model_file)
+        entry = previous.get('models', dict()).get(Path(f).stem)
+        if (
+            entry is None
+            or entry['size'] != stat.st_size
+            or entry['mtime_ns'] != stat.st_mtime_ns
+        ):
+            entry = {
+                'file': model_file,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+            }
+            entry.update(model_file_info(model_file))
+            changed = True
+        catalog[Path(f).stem] = entry
+
+    if changed and catalog_file is not None:
+        all_catalogs[model_dir] = {
+            'dir_mtime_ns': dir_mtime,
+            'models': catalog,
+        }
+        try:
+            os.makedirs(os.path.dirname(catalog_file), exist_ok = True)
+            tmp_file = catalog_file + '.tmp'
+            with open(tmp_file, 'w') as handle:
+                json.dump(all_catalogs, handle, indent = 4)
+            os.replace(tmp_file, catalog_file)
+        except OSError:
+            logging.debug("Could not save model catalog: {}".format(catalog_file))
+
+    _catalog_cache[model_dir] = (dir_mtime, catalog)
+    return catalog
+
+def get_available_models(print_str = False):
+
+    available_models = list(load_model_catalog().keys())
+
+    if print_str:
+        available_models = "\n"+"\n".join(available_models)
+
+    return available_models
+
+def get_model_path(model_name):
+
+    if os.path.isfile(model_name):
+        return model_name
+
+    if model_name not in get_available_models():
+        err_msg = """
+        The following model could not be found in {}
+        """.format(MODEL_DIR)
+        raise ValueError(err_msg)
+
+    return os.path.join(MODEL_DIR, model_name + '.zip')
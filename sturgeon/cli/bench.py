@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import logging
+from typing import Optional, List
+
+
+def bench(
+    output_file: str,
+    model_files: Optional[List[str]] = None,
+    input_path: Optional[str] = None,
+    coverages: Optional[List[float]] = (0.05, 0.25, 1.0),
+    num_probes: Optional[int] = 5000,
+    rounds: Optional[int] = 5,
+    seed: Optional[int] = 0,
+    plot: Optional[bool] = True,
+    compare: Optional[List[str]] = None,
+    threshold: Optional[float] = 0.1,
+):
+    """Run the benchmarks and/or compare benchmark results
+
+    If compare has two files these are compared without running the 
+    benchmarks. If it has one file, the benchmarks are run and compared 
+    against it. The program exits with an error if there are regressions.
+    """
+
+    logging.info("Sturgeon start up")
+    logging.info("Benchmark program")
+
+    from sturgeon.benchmark import run_benchmarks, compare_benchmarks
+
+    if compare is not None and len(compare) > 2:
+        err_msg = '''
+        --compare takes a baseline file and optionally a results file, given: {}
+        '''.format(compare)
+        logging.error(err_msg)
+        raise ValueError(err_msg)
+
+    if compare is not None and len(compare) == 2:
+        with open(compare[1], 'r') as handle:
+            results = json.load(handle)
+    else:
+        results = run_benchmarks(
+            model_files = model_files,
+            bed_path = input_path,
+            coverages = coverages,
+            num_probes = num_probes,
+            rounds = rounds,
+            seed = seed,
+            plot = plot,
+        )
+
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        logging.info("Saving benchmark results to: {}".format(output_file))
+        with open(output_file, 'w') as handle:
+            json.dump(results, handle, indent = 4)
+
+    msg = '\n    {:60s} {:>12s}\n'.format('Benchmark', 'Median (ms)')
+    for b in results['benchmarks']:
+        msg += '    {:60s} {:12.3f}\n'.format(b['name'], 1000 * b['stats']['median'])
+    print(msg)
+
+    if compare is None:
+        return
+
+    with open(compare[0], 'r') as handle:
+        baseline = json.load(handle)
+
+    comparison = compare_benchmarks(baseline, results, threshold)
+
+    msg = '\n    {:60s} {:>12s} {:>12s} {:>8s}\n'.format(
+        'Benchmark', 'Base (ms)', 'New (ms)', 'Ratio'
+    )
+    for c in comparison:
+        msg += '    {:60s} {:12.3f} {:12.3f} {:8.2f} {}\n'.format(
+            c['name'], 
+            1000 * c['baseline'], 
+            1000 * c['current'], 
+            c['ratio'],
+            'REGRESSION' if c['regression'] else '',
+        )
+    print(msg)
+
+    regressions = [c['name'] for c in comparison if c['regression']]
+    if len(regressions) > 0:
+        logging.error(
+            "{} benchmarks are more than {:.0%} slower than the baseline".format(
+                len(regressions), threshold
+            )
+        )
+        sys.exit(1)
+
+    logging.info("No regressions above {:.0%}".format(threshold))
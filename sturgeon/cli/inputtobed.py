@@ -9,7 +9,7 @@ from sturgeon.callmapping import (
     modkit_path_to_bed,
 )
 from sturgeon.utils import validate_megalodon_file, validate_modkit_file
-import pysam
+from sturgeon.constants import CHUNK_SIZE, INDEX_FREE_BAM_SIZE
 
 def filetobed(
     input_path: List[str],
@@ -20,7 +20,9 @@ def filetobed(
     margin: Optional[int] = 25,
     neg_threshold: Optional[float] = 0.3,
     pos_threshold: Optional[float] = 0.7,
-    fivemc_code: str = 'm',
+    fivemc_code: Optional[str] = None,
+    workers: Optional[int] = 1,
+    chunk_size: Optional[int] = CHUNK_SIZE,
 ):
 
     logging.info("Sturgeon start up")
@@ -64,6 +66,18 @@ def filetobed(
         '''.format(margin)
         raise ValueError(err_msg)
 
+    if workers < 1:
+        err_msg = '''
+        --workers must be a positive integer, given: {}
+        '''.format(workers)
+        raise ValueError(err_msg)
+
+    if chunk_size < 1:
+        err_msg = '''
+        --chunk-size must be a positive integer, given: {}
+        '''.format(chunk_size)
+        raise ValueError(err_msg)
+
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
@@ -72,7 +86,7 @@ def filetobed(
         warnings.warn(
         '''\nUsing this source is NOT recommended.\n
         Please strongly consider using modkit (https://github.com/nanoporetech/modkit/), to extract methylation calls from bam files.\n 
-        Otherwise we rely on modbampy, which is currently deprecated. Updates to guppy might break modbampy compatibility and could give WRONG results.                   
+        Otherwise the C modification calls are read from the MM/ML tags of the bam files, modkit handles more basecallers and modification types.                   
         ''')
 
         bamtobed(
@@ -82,6 +96,8 @@ def filetobed(
             margin = margin,
             neg_threshold = neg_threshold,
             pos_threshold = pos_threshold,
+            workers = workers,
+            fivemc_code = fivemc_code,
         )
     
     elif source == 'megalodon':
@@ -99,6 +115,8 @@ def filetobed(
             margin = margin,
             neg_threshold = neg_threshold,
             pos_threshold = pos_threshold,
+            workers = workers,
+            chunk_size = chunk_size,
         )
 
     elif source == 'modkit':
@@ -110,7 +128,9 @@ def filetobed(
             margin = margin,
             neg_threshold = neg_threshold,
             pos_threshold = pos_threshold,
-            fivemc_code = fivemc_code,
+            fivemc_code = fivemc_code if fivemc_code is not None else 'm',
+            workers = workers,
+            chunk_size = chunk_size,
         )
 
 
@@ -121,8 +141,11 @@ def bamtobed(
     margin: Optional[int] = 25,
     neg_threshold: Optional[float] = 0.3,
     pos_threshold: Optional[float] = 0.7,
+    workers: Optional[int] = 1,
+    fivemc_code: Optional[str] = None,
 ):
     
+    import pysam
     
     logging.info("Bam to bed program")
 
@@ -144,8 +167,11 @@ def bamtobed(
     logging.info("Found a total of {} bam files".format(len(bam_files)))
     logging.info("Output will be saved in: {}".format(output_path))
 
+    # small bam files are read in a single pass without the index
     for bam_file in bam_files:
         bai_file = bam_file + '.bai'
+        if os.path.getsize(bam_file) < INDEX_FREE_BAM_SIZE:
+            continue
         if not os.path.exists(bai_file):
             logging.info(
                 '''
@@ -172,6 +198,8 @@ def bamtobed(
         margin = margin,
         neg_threshold = neg_threshold,
         pos_threshold = pos_threshold,
+        workers = workers,
+        fivemc_code = fivemc_code,
     )
 
 
@@ -184,6 +212,8 @@ def megatobed(
     margin: Optional[int] = 25,
     neg_threshold: Optional[float] = 0.3,
     pos_threshold: Optional[float] = 0.7,
+    workers: Optional[int] = 1,
+    chunk_size: Optional[int] = CHUNK_SIZE,
 ):
 
     logging.info("Megalodon to bed program")
@@ -226,6 +256,8 @@ def megatobed(
         margin = margin,
         neg_threshold = neg_threshold,
         pos_threshold = pos_threshold,
+        workers = workers,
+        chunk_size = chunk_size,
     )
 
 def modkittobed(
@@ -236,6 +268,8 @@ def modkittobed(
     neg_threshold: Optional[float] = 0.3,
     pos_threshold: Optional[float] = 0.7,
     fivemc_code: str = 'm',
+    workers: Optional[int] = 1,
+    chunk_size: Optional[int] = CHUNK_SIZE,
 ):
     
     logging.info("Modkit to bed program")
@@ -279,6 +313,8 @@ def modkittobed(
         neg_threshold = neg_threshold,
         pos_threshold = pos_threshold,
         fivemc_code = fivemc_code,
+        workers = workers,
+        chunk_size = chunk_size,
     )
 
 
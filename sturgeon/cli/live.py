@@ -1,35 +1,448 @@
 import os
+import json
+import hashlib
 import logging
-from typing import List
+from typing import List, Optional, Callable, Tuple, Dict
 import time
+import queue
+import threading
 from pathlib import Path
 from copy import deepcopy
-import shutil
-import zipfile
-import json
+from functools import partial
+from concurrent.futures import Executor, ThreadPoolExecutor, wait
 
 import numpy as np
 import pandas as pd
-import pysam
 
 from sturgeon.callmapping import (
     bam_to_calls, 
-    merge_probes_methyl_calls,
-    probes_methyl_calls_to_bed,
+    ExtractionPool,
+    ProbeCallCounts,
     mega_file_to_bed,
+    read_megalodon_chunks,
 )
 from sturgeon.utils import (
-    validate_model_file, 
-    get_model_path, 
-    creation_date, 
     validate_megalodon_file,
+    validate_bam_file,
+    atomic_write,
 )
 
-from sturgeon.prediction import predict_sample, load_model
-from sturgeon.plot import plot_prediction, plot_prediction_over_time
+from sturgeon.registry import (
+    get_model_registry, 
+    configure_sessions, 
+    predict_sample_bundles,
+    predict_samples_bundles,
+    PredictionMemo,
+    file_key,
+    file_checksum,
+)
+from sturgeon.constants import SESSION_CONFIG_FILE, CHUNK_SIZE
+from sturgeon.tracing import trace_span, save_trace
+from sturgeon.metrics import LiveMetrics, start_metrics_server
+from sturgeon.watcher import FileWatcher
 from sturgeon.utils import read_probes_file
 
 
+# checkpoint of a live run in its output folder, see `LiveSnapshot`
+CHECKPOINT_FILE = 'live_checkpoint.npz'
+CHECKPOINT_VERSION = 2
+
+def file_identity(file_path: str) -> dict:
+    """Path, size, modification time and sha1 of the contents of a file"""
+
+    stat = os.stat(file_path)
+    return {
+        'path': os.path.abspath(file_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'checksum': file_checksum(file_path),
+    }
+
+def _to_json(x):
+    """Numpy scalars in predictions are written as python numbers"""
+
+    if isinstance(x, np.generic):
+        return x.item()
+    raise TypeError('Not serializable: {}'.format(type(x)))
+
+
+class LiveSnapshot():
+    """Saves the state of a live run in the output folder: the calls added up
+    in memory as the merged probe methylation calls and bed files, and a 
+    checkpoint from which a restarted run continues
+
+    The checkpoint has the calls added up so far, the path, size, 
+    modification time and sha1 of the files they come from, the predictions
+    made so far by each model, and the files still waiting to be predicted 
+    after they were added up without it (see `LivePipeline`), with the 
+    calls they added. All the files are written to a
+    temporary file that is then renamed over them, so a crash leaves the
+    last complete save.
+
+    Args:
+        probe_counts (ProbeCallCounts): calls added up so far
+        output_path (str): folder where the files are saved
+        interval (int): seconds in between saving the files
+        settings (dict): options of the run that change the calls, a 
+            checkpoint saved with other settings is not resumed
+    """
+
+    def __init__(
+        self,
+        probe_counts: ProbeCallCounts,
+        output_path: str,
+        interval: Optional[int] = 60,
+        settings: Optional[dict] = None,
+    ):
+
+        self.probe_counts = probe_counts
+        self.output_path = output_path
+        self.interval = interval
+        self.settings = json.loads(json.dumps(settings or dict()))
+        self.checkpoint_file = os.path.join(output_path, CHECKPOINT_FILE)
+
+        # files added up so far and the rows of the predictions csv files,
+        # the predictions are added from another thread than the files
+        self.files = list()
+        self.history = dict()
+        self.predicted_file = -1
+        # files added up without being predicted, and the files of these
+        # that were predicted afterwards
+        self.backfill = list()
+        self.backfilled = set()
+        self._changed = False
+        self._lock = threading.Lock()
+
+        self.saved_files = 0
+        self.last_save = time.monotonic()
+
+    @property
+    def probes_checksum(self) -> str:
+
+        probe_ids = '\n'.join(self.probe_counts.probe_ids.astype(str))
+        return hashlib.sha1(probe_ids.encode()).hexdigest()
+
+    def add_backfill_job(self) -> dict:
+        """Start recording files that are added up without being predicted
+
+        Returns the job, with a copy of the counts before its files and the
+        files added to it by `add`
+        """
+
+        with self._lock:
+            job = {'counts': self.probe_counts.counts(), 'files': list()}
+            self.backfill.append(job)
+            self._changed = True
+        return job
+
+    def add(
+        self, 
+        calls_per_probe: pd.DataFrame, 
+        identity: dict, 
+        timestamp: float,
+        backfill_job: Optional[dict] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Add the calls per probe of a file to the counts and record the
+        file, so that both are saved together
+
+        Args:
+            calls_per_probe (pd.DataFrame): calls of the file
+            identity (dict): as given by `file_identity`
+            timestamp (float): creation time of the file
+            backfill_job (dict): job of `add_backfill_job` if the file is 
+                not predicted now
+
+        Returns the change of the counts, see `ProbeCallCounts.add`
+        """
+
+        with self._lock:
+            change = self.probe_counts.add(calls_per_probe)
+            self.files.append(dict(identity, timestamp = timestamp))
+            if backfill_job is not None:
+                backfill_job['files'].append(
+                    (self.probe_counts.num_files - 1, timestamp, change)
+                )
+            self._changed = True
+        return change
+
+    def add_predictions(
+        self, 
+        prediction_dfs: Dict[str, pd.DataFrame], 
+        file_nums: List[int],
+        backfill: Optional[bool] = False,
+    ):
+        """Record the rows added to the predictions csv files
+
+        Args:
+            prediction_dfs (dict): rows of the csv file of each model
+            file_nums (list): numbers of the files of the rows
+            backfill (bool): whether these are predictions of earlier files
+        """
+
+        with self._lock:
+            for model_name, prediction_df in prediction_dfs.items():
+                self.history.setdefault(model_name, list()).extend(
+                    prediction_df.to_dict('records')
+                )
+
+            if not backfill:
+                self.predicted_file = max([self.predicted_file] + file_nums)
+            else:
+                self.backfilled.update(file_nums)
+                # jobs with all their files predicted are not saved anymore
+                for job in list(self.backfill):
+                    job_files = [file_num for file_num, _, _ in job['files']]
+                    if len(job_files) == 0:
+                        continue
+                    if all(f in self.backfilled for f in job_files):
+                        self.backfill.remove(job)
+                        self.backfilled.difference_update(job_files)
+            self._changed = True
+
+    def pending_backfill(self) -> List[dict]:
+        """Jobs of files waiting to be predicted, restored by `load`"""
+
+        with self._lock:
+            return list(self.backfill)
+
+    def unpredicted(self) -> Optional[float]:
+        """Timestamp of the last file added up, if the counts with it were 
+        not predicted
+        """
+
+        with self._lock:
+            if len(self.files) == 0 or self.predicted_file >= len(self.files) - 1:
+                return None
+            return self.files[-1]['timestamp']
+
+    def update(self):
+        """Save the files if the interval passed since they were last saved"""
+
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        """Save the files if any file or prediction was added since they were
+        last saved, files are not added up in the meantime
+        """
+
+        with self._lock:
+            if not self._changed:
+                return
+            num_files = self.probe_counts.num_files
+            metadata = {
+                'version': CHECKPOINT_VERSION,
+                'settings': self.settings,
+                'probes': self.probes_checksum,
+                'num_files': num_files,
+                'files': self.files,
+                'predicted_file': self.predicted_file,
+                'history': self.history,
+                'backfill': [
+                    [
+                        [file_num, timestamp, len(change[0])]
+                        for file_num, timestamp, change in job['files']
+                    ]
+                    for job in self.backfill
+                ],
+                'backfilled': sorted(self.backfilled),
+            }
+
+            # counts before the files of each job, and the calls the files
+            # added one after the other
+            backfill_arrays = dict()
+            for i, job in enumerate(self.backfill):
+                changes = [change for _, _, change in job['files']]
+                backfill_arrays['backfill_{}_counts'.format(i)] = np.stack(
+                    job['counts']
+                )
+                for j, name in enumerate(
+                    ('positions', 'methylation_calls', 'unmethylation_calls')
+                ):
+                    backfill_arrays['backfill_{}_{}'.format(i, name)] = (
+                        np.concatenate(
+                            [change[j] for change in changes] 
+                            + [np.zeros(0, dtype = np.int32)]
+                        )
+                    )
+
+            with trace_span('save_snapshot', files = num_files):
+                if num_files != self.saved_files:
+                    self.save_merged_calls()
+
+                with atomic_write(self.checkpoint_file, 'wb') as handle:
+                    np.savez(
+                        handle,
+                        methylation_calls = self.probe_counts.methylation_calls,
+                        unmethylation_calls = self.probe_counts.unmethylation_calls,
+                        metadata = np.frombuffer(
+                            json.dumps(metadata, default = _to_json).encode(),
+                            dtype = np.uint8,
+                        ),
+                        **backfill_arrays,
+                    )
+
+            self._changed = False
+            self.saved_files = num_files
+            self.last_save = time.monotonic()
+
+    def save_merged_calls(self):
+
+        merged_output_file = os.path.join(
+            self.output_path, 'merged_probes_methyl_calls.txt'
+        )
+        bed_output_file = os.path.join(
+            self.output_path, 'merged_probes_methyl_calls.bed'
+        )
+        with atomic_write(merged_output_file) as handle:
+            self.probe_counts.calls_per_probe().to_csv(
+                handle, header = True, index = False, sep = '\t'
+            )
+        with atomic_write(bed_output_file) as handle:
+            self.probe_counts.bed().to_csv(
+                handle, header = True, index = False, sep = '\t'
+            )
+        logging.info(
+            'Saved merged calls of {} files to: {}'.format(
+                self.probe_counts.num_files, bed_output_file
+            )
+        )
+
+    def load(self) -> bool:
+        """Continue from the checkpoint in the output folder, if there is one
+        saved with the same settings
+
+        The counts and the files added up are restored, and the predictions
+        csv files are written again from the predictions in the checkpoint,
+        dropping the rows added after it was saved. The files that were 
+        still waiting to be predicted are given again by `pending_backfill`.
+
+        Returns whether the checkpoint was resumed
+        """
+
+        if not os.path.exists(self.checkpoint_file):
+            return False
+
+        try:
+            with np.load(self.checkpoint_file) as checkpoint:
+                metadata = json.loads(checkpoint['metadata'].tobytes().decode())
+                methylation_calls = checkpoint['methylation_calls']
+                unmethylation_calls = checkpoint['unmethylation_calls']
+                backfill = self._load_backfill(checkpoint, metadata)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(
+                'Could not read checkpoint {}, starting over: {}'.format(
+                    self.checkpoint_file, e
+                )
+            )
+            return False
+
+        if (
+            metadata.get('version') != CHECKPOINT_VERSION
+            or metadata.get('settings') != self.settings
+            or metadata.get('probes') != self.probes_checksum
+        ):
+            logging.warning(
+                '''
+                Checkpoint {} was saved by a run with other settings or 
+                probes, starting over
+                '''.format(self.checkpoint_file)
+            )
+            return False
+
+        self.probe_counts.methylation_calls[:] = methylation_calls
+        self.probe_counts.unmethylation_calls[:] = unmethylation_calls
+        self.probe_counts.num_files = metadata['num_files']
+        self.files = metadata['files']
+        self.history = metadata['history']
+        self.predicted_file = metadata['predicted_file']
+        self.saved_files = metadata['num_files']
+        self.backfill = backfill
+        self.backfilled = set()
+
+        for model_name, rows in self.history.items():
+            output_csv = os.path.join(
+                self.output_path, 
+                'predictions_{}.csv'.format(model_name)
+            )
+            prediction_df = pd.DataFrame(rows).sort_values(
+                'timestamp', kind = 'stable'
+            )
+            with atomic_write(output_csv) as handle:
+                prediction_df.to_csv(handle, index = False)
+
+        logging.info(
+            'Resumed from checkpoint {} with {} files'.format(
+                self.checkpoint_file, len(self.files)
+            )
+        )
+        return True
+
+    def _load_backfill(self, checkpoint, metadata: dict) -> List[dict]:
+        """Jobs of the files of a checkpoint that were not predicted yet"""
+
+        backfilled = set(metadata['backfilled'])
+        # the newest state is predicted on its own after resuming
+        newest_file = metadata['num_files'] - 1
+        if metadata['predicted_file'] >= newest_file:
+            newest_file = None
+
+        jobs = list()
+        for i, job_files in enumerate(metadata['backfill']):
+            counts = tuple(checkpoint['backfill_{}_counts'.format(i)].copy())
+            changes = [
+                checkpoint['backfill_{}_{}'.format(i, name)] 
+                for name in (
+                    'positions', 'methylation_calls', 'unmethylation_calls'
+                )
+            ]
+
+            files = list()
+            start = 0
+            for file_num, timestamp, length in job_files:
+                change = tuple(c[start:start + length] for c in changes)
+                start += length
+                if file_num in backfilled and len(files) == 0:
+                    # predicted already, its calls are part of the counts
+                    # the next files are predicted from
+                    self.probe_counts.apply(change, counts)
+                elif file_num != newest_file:
+                    files.append((file_num, timestamp, change))
+
+            if len(files) > 0:
+                jobs.append({'counts': counts, 'files': files})
+        return jobs
+
+    def processed_files(self) -> dict:
+        """Files of the checkpoint by name, as kept by `watch_input_path`
+
+        Files that changed on disk since they were added up are logged, they
+        are not processed again.
+        """
+
+        input_files = dict()
+        for identity in self.files:
+            file_path = identity['path']
+            input_files[Path(file_path).stem] = file_path
+
+            try:
+                changed = file_key(file_path) != (
+                    identity['size'], identity['mtime_ns']
+                )
+                if changed:
+                    changed = file_checksum(file_path) != identity['checksum']
+            except FileNotFoundError:
+                continue
+            if changed:
+                logging.warning(
+                    '''
+                    File {} changed since its calls were added up, it is not 
+                    processed again
+                    '''.format(file_path)
+                )
+        return input_files
+
+
 def live(
     input_path: str,
     output_path: str,
@@ -41,6 +454,19 @@ def live(
     pos_threshold: float,
     plot_results: bool,
     cooldown: int,
+    session_config: Optional[dict] = None,
+    tune: Optional[bool] = False,
+    session_config_file: Optional[str] = SESSION_CONFIG_FILE,
+    concurrent_models: Optional[bool] = False,
+    reuse_max_changed_probes: Optional[int] = 0,
+    metrics_port: Optional[int] = None,
+    workers: Optional[int] = 1,
+    chunk_size: Optional[int] = CHUNK_SIZE,
+    snapshot_interval: Optional[int] = 60,
+    poll: Optional[bool] = False,
+    pipeline_depth: Optional[int] = 2,
+    coalesce: Optional[bool] = True,
+    resume: Optional[bool] = True,
 ):
     """
     """
@@ -53,496 +479,892 @@ def live(
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
+    probes_df = read_probes_file(probes_file)
+
+    # each new file is split in tasks that are processed in parallel, the
+    # workers are started before the models and the metrics server so that
+    # they do not inherit their threads
+    extraction_pool = None
+    if workers > 1:
+        extraction_pool = ExtractionPool(probes_df, workers)
+
+    # load the models before any file arrives, these are kept warm in the
+    # registry for the whole run
+    configure_sessions(
+        model_files = model_files,
+        session_config = session_config,
+        tune = tune,
+        session_config_file = session_config_file,
+    )
+    model_registry = get_model_registry()
+    for model in model_files:
+        model_registry.get(model)
+
+    # run all the models at the same time on each update
+    executor = None
+    if concurrent_models:
+        executor = ThreadPoolExecutor(max_workers = len(model_files))
+
+    # new files often do not change the probes, then the models are not run
+    memo = PredictionMemo(max_changed_probes = reuse_max_changed_probes)
+
+    live_metrics = LiveMetrics()
+    if metrics_port is not None:
+        start_metrics_server(live_metrics, metrics_port)
+
+    # calls of all the files are added up in memory, they are saved to the 
+    # output folder every snapshot_interval seconds and on exit, together 
+    # with a checkpoint to continue from if the run is restarted
+    probe_counts = ProbeCallCounts(probes_df)
+    snapshot = LiveSnapshot(
+        probe_counts, 
+        output_path, 
+        snapshot_interval,
+        settings = {
+            'input_path': os.path.abspath(input_path),
+            'source': source,
+            'margin': margin,
+            'neg_threshold': neg_threshold,
+            'pos_threshold': pos_threshold,
+        },
+    )
+    if resume:
+        snapshot.load()
+
+    # new files are picked up with inotify, unless polling is asked for
     if source == 'guppy':
-
-        probes_df = read_probes_file(probes_file)
-        
-        live_guppy(
-            input_path = input_path,
-            output_path = output_path,
-            model_files = model_files,
-            probes_df = probes_df,
-            margin = margin,
-            neg_threshold = neg_threshold,
-            pos_threshold = pos_threshold,
-            plot_results = plot_results,
-            cooldown = cooldown,
+        watcher = FileWatcher(
+            input_path, '.bam', cooldown, use_inotify = not poll,
+        )
+    else:
+        watcher = FileWatcher(
+            input_path, '.txt', cooldown, 
+            validate = validate_megalodon_file, use_inotify = not poll,
         )
 
-    elif source == 'megalodon':
+    try:
+        if source == 'guppy':
+            
+            live_guppy(
+                input_path = input_path,
+                output_path = output_path,
+                model_files = model_files,
+                probes_df = probes_df,
+                margin = margin,
+                neg_threshold = neg_threshold,
+                pos_threshold = pos_threshold,
+                plot_results = plot_results,
+                cooldown = cooldown,
+                executor = executor,
+                memo = memo,
+                live_metrics = live_metrics,
+                extraction_pool = extraction_pool,
+                probe_counts = probe_counts,
+                snapshot = snapshot,
+                watcher = watcher,
+                pipeline_depth = pipeline_depth,
+                coalesce = coalesce,
+            )
 
-        live_megalodon(
-            input_path = input_path,
-            output_path = output_path,
-            model_files = model_files,
-            probes_file = probes_file,
-            margin = margin,
-            neg_threshold = neg_threshold,
-            pos_threshold = pos_threshold,
-            plot_results = plot_results,
-            cooldown = cooldown,
-        )
+        elif source == 'megalodon':
+
+            live_megalodon(
+                input_path = input_path,
+                output_path = output_path,
+                model_files = model_files,
+                probes_file = probes_file,
+                margin = margin,
+                neg_threshold = neg_threshold,
+                pos_threshold = pos_threshold,
+                plot_results = plot_results,
+                cooldown = cooldown,
+                executor = executor,
+                memo = memo,
+                live_metrics = live_metrics,
+                extraction_pool = extraction_pool,
+                chunk_size = chunk_size,
+                probe_counts = probe_counts,
+                snapshot = snapshot,
+                watcher = watcher,
+                pipeline_depth = pipeline_depth,
+                coalesce = coalesce,
+            )
+    finally:
+        watcher.close()
+        snapshot.save()
+        if extraction_pool is not None:
+            extraction_pool.shutdown()
 
 
-def live_guppy(
-    input_path: str,
+def extract_bam_file(
+    file_path: str,
     output_path: str,
-    model_files: List[str],
     probes_df: pd.DataFrame,
     margin: int,
     neg_threshold: float,
     pos_threshold: float,
-    plot_results: bool,
-    cooldown: int,
-):
+    extraction_pool: Optional[ExtractionPool] = None,
+) -> pd.DataFrame:
+    """Get the calls per probe of a new bam file, its calls per read are 
+    saved to the output folder
 
-    # keep track of processed bam files
-    bam_files = dict()
-    logging.info('Starting live prediction from bam files')
+    Returns the calls per probe
+    """
 
-    while True:
+    file_name = Path(file_path).stem
+    logging.info('Getting methylation calls from file: {}'.format(file_path))
+    calls_per_read_file = os.path.join(
+        output_path, 
+        file_name + '_read_methyl_calls.txt'
+    )
+
+    if extraction_pool is not None:
+        _, calls_per_probe, calls_per_read = next(
+            extraction_pool.bam_to_calls(
+                bam_files = [file_path],
+                margin = margin,
+                neg_threshold = neg_threshold,
+                pos_threshold = pos_threshold,
+            )
+        )
+    else:
+        probes_methyl_df = deepcopy(probes_df)
+        calls_per_probe, calls_per_read = bam_to_calls(
+            bam_file = file_path,
+            probes_df = probes_methyl_df,
+            margin = margin,
+            neg_threshold = neg_threshold,
+            pos_threshold = pos_threshold,
+        )
+    with trace_span('write_calls', file = file_name):
+        calls_per_read.to_csv(
+            calls_per_read_file, 
+            header = True, index = False, sep = '\t'
+        )
 
-        logging.info(
-            '''
-            Looking for new bam files, so far found {}
-            '''.format(len(bam_files))
+    return calls_per_probe
+
+def extract_megalodon_file(
+    file_path: str,
+    probes_file: str,
+    margin: int,
+    neg_threshold: float,
+    pos_threshold: float,
+    chunk_size: Optional[int] = CHUNK_SIZE,
+    extraction_pool: Optional[ExtractionPool] = None,
+) -> pd.DataFrame:
+    """Get the calls per probe of a new megalodon file"""
+
+    logging.info('Getting methylation calls from file: {}'.format(file_path))
+
+    if extraction_pool is not None:
+        _, calls_per_probe = next(
+            extraction_pool.text_to_calls(
+                read_megalodon_chunks,
+                [file_path],
+                margin = margin,
+                neg_threshold = neg_threshold,
+                pos_threshold = pos_threshold,
+                chunk_size = chunk_size,
+            )
+        )
+    else:
+        calls_per_probe = mega_file_to_bed(
+            input_file = file_path,
+            probes_file = probes_file,
+            margin = margin,
+            neg_threshold = neg_threshold,
+            pos_threshold = pos_threshold,
+            chunk_size = chunk_size,
         )
 
-        # get all available bam files and sort them by timestamp so that we
-        # process them in an orderly manner
-        available_bam_files = list()
-        available_bam_timestamps = list()
-        for file in os.listdir(input_path):
-            if not file.endswith('.bam'):
-                continue
-            f = os.path.join(input_path, file)
-            available_bam_files.append(f)
-            available_bam_timestamps.append(creation_date(f))
+    return calls_per_probe
+
+
+# marks the end of the files going through the pipeline stages
+_END = object()
+
+# earlier files predicted at a time, once there is time for them
+BACKFILL_BATCH_SIZE = 16
+
+class LivePipeline():
+    """Processes the files of a live run in stages that run at the same time,
+    connected by bounded queues:
+
+    - extraction: the calls per probe of up to `depth` files are extracted 
+      at the same time, in a thread pool
+    - accumulation: the calls of each file are added to the calls so far, in
+      the order the files were submitted, and the bed of the sample is built
+    - inference: the sample is predicted with each model
+    - output: the predictions are saved and plotted
+
+    A new file is predicted as soon as the slowest stage is free, instead of 
+    after the previous file went through all of them.
+
+    When files come in faster than they are predicted, for example when the
+    run starts on a folder that already has files, all the files waiting are
+    added up and only the newest state is predicted. The predictions of the
+    files in between are made afterwards in batches, when no new file waits,
+    and are added to the predictions csv files in order.
+
+    Args:
+        extract (callable): called with the path of a file, returns its calls
+            per probe
+        output_path (str): folder where the predictions are saved
+        model_files (list): models to predict with, from the registry
+        probe_counts (ProbeCallCounts): calls added up so far
+        snapshot (LiveSnapshot): saves the calls added up so far
+        plot_results (bool): also plot the predictions
+        executor (concurrent.futures.Executor): thread pool to run the models
+        memo (PredictionMemo): remembered predictions
+        live_metrics (LiveMetrics): metrics of the run
+        depth (int): files extracted at the same time, and files waiting in
+            between the other stages
+        coalesce (bool): predict only the newest of the files waiting
+    """
 
-        available_bam_files = np.array(available_bam_files)
-        available_bam_timestamps = np.array(available_bam_timestamps)
-        creation_order = np.argsort(available_bam_timestamps)
+    def __init__(
+        self,
+        extract: Callable,
+        output_path: str,
+        model_files: List[str],
+        probe_counts: ProbeCallCounts,
+        snapshot: LiveSnapshot,
+        plot_results: bool,
+        executor: Optional[Executor] = None,
+        memo: Optional[PredictionMemo] = None,
+        live_metrics: Optional[LiveMetrics] = None,
+        depth: Optional[int] = 2,
+        coalesce: Optional[bool] = True,
+    ):
+
+        self.extract = extract
+        self.output_path = output_path
+        self.model_files = model_files
+        self.probe_counts = probe_counts
+        self.snapshot = snapshot
+        self.plot_results = plot_results
+        self.executor = executor
+        self.memo = memo
+        self.live_metrics = live_metrics if live_metrics is not None else LiveMetrics()
+        self.coalesce = coalesce
+
+        if plot_results:
+            # the plots are made outside of the main thread
+            import matplotlib
+            matplotlib.use('Agg')
+
+        self.extraction_executor = ThreadPoolExecutor(max_workers = depth)
+        # extractions not finished yet, cancelled on close
+        self.extractions = set()
+        self.extracted = queue.Queue(maxsize = depth)
+        self.accumulated = queue.Queue(maxsize = depth)
+        self.predicted = queue.Queue(maxsize = depth)
+        # files added up without being predicted, see `_backfill`, those of
+        # a resumed run come first
+        self.backfill_jobs = queue.Queue()
+        self._backfill_job = None
+        for job in snapshot.pending_backfill():
+            self.backfill_jobs.put(job)
+
+        self.stop = threading.Event()
+        self.error = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+        # the last state of a resumed run might not have been predicted
+        timestamp = snapshot.unpredicted()
+        if timestamp is not None:
+            with self._lock:
+                self._in_flight += 1
+            self.accumulated.put((
+                probe_counts.num_files - 1, 
+                timestamp, 
+                probe_counts.bed(probe_index = get_model_registry().probe_index),
+            ))
+
+        self.threads = [
+            threading.Thread(
+                target = self._run_stage, args = (stage, ), 
+                name = 'live-{}'.format(stage.__name__.strip('_')),
+                daemon = True,
+            )
+            for stage in (self._accumulate, self._infer, self._output)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def in_flight(self) -> int:
+        """Files submitted whose predictions are not saved yet"""
+
+        with self._lock:
+            return self._in_flight
+
+    def submit(self, file_path: str, timestamp: float, more: Optional[bool] = False):
+        """Process a new file, blocks while the pipeline is full
+
+        Args:
+            file_path (str): path of the new file
+            timestamp (float): creation time of the file
+            more (bool): whether more files are submitted right after this one
+        """
+
+        self.check()
+        with self._lock:
+            self._in_flight += 1
+        future = self.extraction_executor.submit(self._extract, file_path)
+        self.extractions.add(future)
+        future.add_done_callback(self.extractions.discard)
+        self._put(self.extracted, (file_path, timestamp, future, more))
+        self.check()
+
+    def check(self):
+        """Raise the error of a stage, if any failed"""
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Stop the stages, files that are still going through are dropped"""
+
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+        for future in list(self.extractions):
+            future.cancel()
+        self.extraction_executor.shutdown(wait = False)
+
+    def _put(self, stage_queue: queue.Queue, item) -> bool:
+
+        while not self.stop.is_set():
+            try:
+                stage_queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-        available_bam_files = available_bam_files[creation_order]
-        available_bam_timestamps = available_bam_timestamps[creation_order]
+    def _get(self, stage_queue: queue.Queue):
 
-        for file_path, timestamp in zip(available_bam_files, available_bam_timestamps):
-            
-            # check if we have processed this bam file already
-            file_name = Path(file_path).stem
+        while not self.stop.is_set():
             try:
-                # already processed bam file, skip
-                bam_files[file_name]
+                return stage_queue.get(timeout = 0.1)
+            except queue.Empty:
                 continue
-            except KeyError:
-                logging.info('New bam file found: {}'.format(file_path))
-                
-            # generate index file if not existing
-            bai_file = file_path + '.bai'
-            if not os.path.exists(bai_file):
-                logging.info(
-                    '''
-                    Index file not found for bam file: {}
-                    '''.format(file_path)
-                )
-                logging.info(
-                    '''
-                    Generating index file: {}
-                    '''.format(bai_file)
+        return _END
+
+    def _run_stage(self, stage: Callable):
+
+        try:
+            stage()
+        except BaseException as e:
+            logging.exception('Live processing failed in {}'.format(stage.__name__))
+            self.error = e
+            self.stop.set()
+
+    def _extract(self, file_path: str) -> Tuple[pd.DataFrame, dict]:
+
+        with self.live_metrics.stage('extraction'):
+            identity = file_identity(file_path)
+            return self.extract(file_path), identity
+
+    def _accumulate(self):
+
+        model_registry = get_model_registry()
+        # files added up since the last prediction
+        backfill_job = None
+        while True:
+            item = self._get(self.extracted)
+            if item is _END:
+                return
+            file_path, timestamp, future, more = item
+
+            # wait for the extraction, unless the pipeline is stopped
+            while not future.done():
+                if self.stop.is_set():
+                    return
+                wait([future], timeout = 0.1)
+            calls_per_probe, identity = future.result()
+
+            # newer files are waiting, only the newest state is predicted
+            coalesce = self.coalesce and (more or not self.extracted.empty())
+            if coalesce and backfill_job is None:
+                backfill_job = self.snapshot.add_backfill_job()
+
+            # add the calls of this file to the calls of the previous ones
+            with self.live_metrics.stage('merge'):
+                self.snapshot.add(
+                    calls_per_probe, identity, timestamp, 
+                    backfill_job = backfill_job if coalesce else None,
                 )
-                # sometimes we catch the bam file mid write up, try again
-                # in the next iteration
-                try:
-                    pysam.index(file_path)
-                except pysam.utils.SamtoolsError:
-                    logging.warning(
-                        '''
-                        Making index file failed, bam file might not be 
-                        complete yet, will try again later
-                        '''
-                    )
-                    continue
+            file_num = self.probe_counts.num_files - 1
 
+            if coalesce:
                 logging.info(
-                    '''
-                    Generated index file: {}
-                    '''.format(bai_file)
+                    'Newer files are waiting, not predicting: {}'.format(file_path)
                 )
+                self.live_metrics.files_coalesced.inc()
+                self.live_metrics.files_processed.inc()
+                self.live_metrics.backlog.inc(-1)
+                with self._lock:
+                    self._in_flight -= 1
+                continue
 
-            # extract methylation calls from the bam file
-            logging.info('Getting methylation calls from file')
-            calls_per_probe_file = os.path.join(
-                output_path, 
-                file_name + '_probes_methyl_calls.txt',
-            )
-            calls_per_read_file = os.path.join(
-                output_path, 
-                file_name + '_read_methyl_calls.txt'
-            )
-            if not os.path.isfile(calls_per_probe_file) or not os.path.isfile(calls_per_read_file):
-                
-                probes_methyl_df = deepcopy(probes_df)
-                calls_per_probe, calls_per_read = bam_to_calls(
-                    bam_file = file_path,
-                    probes_df = probes_methyl_df,
-                    margin = margin,
-                    neg_threshold = neg_threshold,
-                    pos_threshold = pos_threshold,
-                )
-                calls_per_probe.to_csv(
-                    calls_per_probe_file,
-                    header = True, index = False, sep = '\t'
-                )
-                calls_per_read.to_csv(
-                    calls_per_read_file, 
-                    header = True, index = False, sep = '\t'
+            with self.live_metrics.stage('bed'):
+                bed_df = self.probe_counts.bed(
+                    probe_index = model_registry.probe_index
                 )
 
-            merged_output_file = os.path.join(
-                output_path, 
-                'merged_probes_methyl_calls_{}.txt'.format(len(bam_files))
-            )
+            with self.live_metrics.stage('snapshot'):
+                self.snapshot.update()
 
-            # if this is the first processed file, there's no need to merge
-            if len(bam_files) == 0:
-                shutil.copyfile(calls_per_probe_file, merged_output_file)
-            # here we merge the current probe file with the previous merge file
-            else:
-                merge_probes_methyl_calls(
-                    [
-                        calls_per_probe_file,
-                        os.path.join(
-                            output_path, 
-                            'merged_probes_methyl_calls_{}.txt'.format(len(bam_files)-1)
-                        )
-                    ], 
-                    merged_output_file
-                )
+            self._put(self.accumulated, (file_num, timestamp, bed_df))
+            if backfill_job is not None:
+                self.backfill_jobs.put(backfill_job)
+                backfill_job = None
 
-            # conver the probe file to bed, so that we can predict
-            bed_output_file = os.path.join(
-                output_path,
-                'merged_probes_methyl_calls_{}.bed'.format(len(bam_files))
-            )
-            probes_methyl_calls_to_bed(
-                merged_output_file,
-                bed_output_file
-            )
+    def _infer(self):
 
-            # add to bam_files as we consider this file processed
-            bam_files[file_name] = file_path
+        model_registry = get_model_registry()
+        while not self.stop.is_set():
+            try:
+                item = self.accumulated.get(timeout = 0.1)
+            except queue.Empty:
+                # files waiting for a prediction come first
+                self._backfill()
+                # the last files are saved even if no new file comes
+                self.snapshot.update()
+                continue
+            file_num, timestamp, bed_df = item
 
             # make a prediction with each model
-            for model in model_files:
-
-                model = get_model_path(model)
-
-                logging.info("Validating model: {}".format(model))
-                valid_model = validate_model_file(model)
-
-                if valid_model:
-                    logging.info("Successful model validation")
-                else:
-                    logging.error(
-                        '''
-                        Model did no pass validation, it will be skipped
-                        '''
-                    )
-                    continue
-
-                inference_session, array_probes_df, decoding_dict, temperatures, merge_dict = load_model(model)    
-
-                logging.info("Starting prediction")
-                prediction_df = predict_sample(
-                    inference_session = inference_session,
-                    bed_file = bed_output_file,
-                    decoding_dict = deepcopy(decoding_dict),
-                    probes_df = array_probes_df,
-                    temperatures = temperatures,
-                    merge_dict = merge_dict,
+            bundles = [model_registry.get(model) for model in self.model_files]
+            bundles = [bundle for bundle in bundles if bundle is not None]
+
+            logging.info("Starting prediction")
+            with self.live_metrics.stage('inference'):
+                prediction_dfs = predict_sample_bundles(
+                    bed_file = None,
+                    bundles = bundles,
+                    executor = self.executor,
+                    memo = self.memo,
+                    bed_df = bed_df,
                 )
-                prediction_df['timestamp'] = timestamp
 
-                output_csv = os.path.join(
-                    output_path, 
-                    'predictions_{}.csv'.format(Path(model).stem)
-                )
-                prediction_df.to_csv(
-                    output_csv,
-                    mode = 'a',
-                    index = False,
-                    header = not os.path.exists(output_csv),
-                )
+            self._put(
+                self.predicted, 
+                ('prediction', file_num, timestamp, bundles, prediction_dfs),
+            )
 
-                if plot_results:
+    def _backfill(self):
+        """Predict a batch of the files that were added up without being
+        predicted
+        """
 
-                    # plot the last prediction
-                    output_pdf = os.path.join(
-                        output_path, 
-                        'predictions_{}_{}.pdf'.format(
-                            len(bam_files)-1,
-                            Path(model).stem,
-                        )
-                    )
-                    logging.info('Plotting results to: {}'.format(output_pdf))
-
-                    with zipfile.ZipFile(model, 'r') as zipf:
-                        logging.debug("Loading colors dict")
-                        try:
-                            color_dict = json.load(zipf.open('colors.json'))
-                        except FileNotFoundError:
-                            logging.debug("No colors dict in zip file")
-                            color_dict = None
-                    
-                    plot_prediction(
-                        prediction_df = prediction_df,
-                        color_dict = color_dict,
-                        output_file = output_pdf
-                    )
+        if self._backfill_job is None:
+            try:
+                self._backfill_job = self.backfill_jobs.get_nowait()
+            except queue.Empty:
+                return
+        job = self._backfill_job
+        # the job is saved as it is in the checkpoint, the counts are 
+        # advanced in a copy
+        if 'next' not in job:
+            job['next'] = 0
+            job['current'] = tuple(c.copy() for c in job['counts'])
+
+        model_registry = get_model_registry()
+        batch = job['files'][job['next']:job['next'] + BACKFILL_BATCH_SIZE]
+        bed_dfs = list()
+        for _, _, change in batch:
+            self.probe_counts.apply(change, job['current'])
+            bed_dfs.append(self.probe_counts.bed(
+                probe_index = model_registry.probe_index, counts = job['current'],
+            ))
+
+        job['next'] += len(batch)
+        if job['next'] >= len(job['files']):
+            self._backfill_job = None
+
+        bundles = [model_registry.get(model) for model in self.model_files]
+        bundles = [bundle for bundle in bundles if bundle is not None]
+
+        logging.info("Predicting {} earlier files".format(len(batch)))
+        with self.live_metrics.stage('backfill'):
+            prediction_dfs = predict_samples_bundles(
+                bed_dfs = bed_dfs,
+                bundles = bundles,
+                executor = self.executor,
+            )
 
-                    output_pdf = os.path.join(
-                        output_path, 
-                        'predictions_overtime_{}.pdf'.format(
-                            Path(model).stem,
-                        )
-                    )
-                    predictions_time = pd.read_csv(
-                        output_csv,
-                        header = 0,
-                        index_col = None,
-                    )
-                    plot_prediction_over_time(
-                        prediction_df = predictions_time,
-                        color_dict = color_dict,
-                        output_file = output_pdf,
-                    )
+        file_nums = [file_num for file_num, _, _ in batch]
+        timestamps = [timestamp for _, timestamp, _ in batch]
+        self._put(
+            self.predicted, 
+            ('backfill', file_nums, timestamps, bundles, prediction_dfs),
+        )
 
-                else:
-                    logging.info('Skipping plotting results')
+    def _output(self):
+
+        while True:
+            item = self._get(self.predicted)
+            if item is _END:
+                return
+            kind, file_num, timestamp, bundles, prediction_dfs = item
+
+            if kind == 'backfill':
+                for bundle, prediction_df in zip(bundles, prediction_dfs):
+                    self.save_backfill(timestamp, bundle, prediction_df)
+                self.snapshot.add_predictions(
+                    {
+                        bundle.name: prediction_df 
+                        for bundle, prediction_df in zip(bundles, prediction_dfs)
+                    },
+                    file_num,
+                    backfill = True,
+                )
+                continue
 
+            for bundle, prediction_df in zip(bundles, prediction_dfs):
+                self.save_prediction(file_num, timestamp, bundle, prediction_df)
+            self.snapshot.add_predictions(
+                {
+                    bundle.name: prediction_df 
+                    for bundle, prediction_df in zip(bundles, prediction_dfs)
+                },
+                [file_num],
+            )
 
-        logging.info(
-            '''
-            No new bam files found, sleeping for {} seconds
-            '''.format(cooldown)
+            # keep the trace on disk reasonably up to date, it is saved as
+            # a whole so not after every file, and once more on exit
+            save_trace(include_onnx = False, interval = self.snapshot.interval)
+
+            self.live_metrics.files_processed.inc()
+            self.live_metrics.backlog.inc(-1)
+            with self._lock:
+                self._in_flight -= 1
+
+    def save_prediction(
+        self, 
+        file_num: int, 
+        timestamp: float, 
+        bundle, 
+        prediction_df: pd.DataFrame,
+    ):
+        """Append the prediction of a model to its csv file and plot it"""
+
+        self.live_metrics.prediction(
+            bundle.name, prediction_df['number_probes'].item()
         )
-        time.sleep(cooldown)
+        prediction_df['timestamp'] = timestamp
 
-def live_megalodon(
-    input_path: str,
-    output_path: str,
-    model_files: List[str],
-    probes_file: str,
-    margin: int,
-    neg_threshold: float,
-    pos_threshold: float,
-    plot_results: bool,
-    cooldown: int,
-):
+        output_csv = os.path.join(
+            self.output_path, 
+            'predictions_{}.csv'.format(bundle.name)
+        )
+        with trace_span('write_predictions', model = bundle.name):
+            prediction_df.to_csv(
+                output_csv,
+                mode = 'a',
+                index = False,
+                header = not os.path.exists(output_csv),
+            )
 
-    # keep track of processed bam files
-    meg_files = dict()
-    logging.info('Starting live prediction from megalodon output files')
-    
-    while True:
+        if not self.plot_results:
+            logging.info('Skipping plotting results')
+            return
 
-        logging.info(
-            '''
-            Looking for new megalodon files, so far found {}
-            '''.format(len(meg_files))
-        )
+        with self.live_metrics.stage('plotting'):
 
-        # get all available bam files and sort them by timestamp so that we
-        # process them in an orderly manner
-        available_meg_files = list()
-        available_meg_timestamps = list()
-        for file in os.listdir(input_path):
-            if not file.endswith('.txt'):
-                continue
-            f = os.path.join(input_path, file)
+            from sturgeon.plot import plot_prediction
 
-            success, msg = validate_megalodon_file(f)
-                
-            if not success:
-                logging.info(
-                    '''
-                    File {}, did not pass validation either not a megalodon file or
-                    an invalid megalodon file. Reason: {}.
-                    '''.format(f, msg)
+            # plot the last prediction
+            output_pdf = os.path.join(
+                self.output_path, 
+                'predictions_{}_{}.pdf'.format(
+                    file_num,
+                    bundle.name,
                 )
-                continue
-
-            available_meg_files.append(f)
-            available_meg_timestamps.append(creation_date(f))
+            )
+            logging.info('Plotting results to: {}'.format(output_pdf))
+        
+            plot_prediction(
+                prediction_df = prediction_df,
+                color_dict = bundle.color_dict,
+                output_file = output_pdf
+            )
 
-        available_meg_files = np.array(available_meg_files)
-        available_meg_timestamps = np.array(available_meg_timestamps)
-        creation_order = np.argsort(available_meg_timestamps)
+            self.plot_over_time(bundle, output_csv)
 
-        available_meg_files = available_meg_files[creation_order]
-        available_meg_timestamps = available_meg_timestamps[creation_order]
+    def save_backfill(
+        self,
+        timestamps: List[float],
+        bundle,
+        prediction_df: pd.DataFrame,
+    ):
+        """Add the predictions of earlier files of a model to its csv file, 
+        in the order of their timestamps
+        """
 
-        for file_path, timestamp in zip(available_meg_files, available_meg_timestamps):
-            
-            # check if we have processed this bam file already
-            file_name = Path(file_path).stem
-            try:
-                # already processed bam file, skip
-                meg_files[file_name]
-                continue
-            except KeyError:
-                logging.info('New megalodon file found: {}'.format(file_path))
-                
-
-            # extract methylation calls from the bam file
-            logging.info('Getting methylation calls from file')
-            calls_per_probe_file = os.path.join(
-                output_path, 
-                file_name + '_probes_methyl_calls.txt',
-            )
+        prediction_df['timestamp'] = timestamps
 
-            if not os.path.isfile(calls_per_probe_file):
-                
-                calls_per_probe = mega_file_to_bed(
-                    input_file = file_path,
-                    probes_file = probes_file,
-                    margin = margin,
-                    neg_threshold = neg_threshold,
-                    pos_threshold = pos_threshold,
+        output_csv = os.path.join(
+            self.output_path, 
+            'predictions_{}.csv'.format(bundle.name)
+        )
+        with trace_span('write_predictions', model = bundle.name):
+            if os.path.exists(output_csv):
+                predictions_time = pd.read_csv(
+                    output_csv,
+                    header = 0,
+                    index_col = None,
                 )
-                calls_per_probe.to_csv(
-                    calls_per_probe_file,
-                    header = True, index = False, sep = '\t'
+                if 'reused' in predictions_time.columns:
+                    prediction_df['reused'] = False
+                prediction_df = pd.concat([predictions_time, prediction_df])
+                prediction_df = prediction_df.sort_values(
+                    'timestamp', kind = 'stable'
                 )
+            prediction_df.to_csv(output_csv, index = False)
 
+        if self.plot_results:
+            with self.live_metrics.stage('plotting'):
+                self.plot_over_time(bundle, output_csv)
 
-            merged_output_file = os.path.join(
-                output_path, 
-                'merged_probes_methyl_calls_{}.txt'.format(len(meg_files))
-            )
+    def plot_over_time(self, bundle, output_csv: str):
 
-            # if this is the first processed file, there's no need to merge
-            if len(meg_files) == 0:
-                shutil.copyfile(calls_per_probe_file, merged_output_file)
-            # here we merge the current probe file with the previous merge file
-            else:
-                merge_probes_methyl_calls(
-                    [
-                        calls_per_probe_file,
-                        os.path.join(
-                            output_path, 
-                            'merged_probes_methyl_calls_{}.txt'.format(len(meg_files)-1)
-                        )
-                    ], 
-                    merged_output_file
-                )
+        from sturgeon.plot import plot_prediction_over_time
 
-            # conver the probe file to bed, so that we can predict
-            bed_output_file = os.path.join(
-                output_path,
-                'merged_probes_methyl_calls_{}.bed'.format(len(meg_files))
-            )
-            probes_methyl_calls_to_bed(
-                merged_output_file,
-                bed_output_file
+        output_pdf = os.path.join(
+            self.output_path, 
+            'predictions_overtime_{}.pdf'.format(
+                bundle.name,
             )
+        )
+        predictions_time = pd.read_csv(
+            output_csv,
+            header = 0,
+            index_col = None,
+        )
+        plot_prediction_over_time(
+            prediction_df = predictions_time,
+            color_dict = bundle.color_dict,
+            output_file = output_pdf,
+        )
 
-            # add to bam_files as we consider this file processed
-            meg_files[file_name] = file_path
 
-            # make a prediction with each model
-            for model in model_files:
+def watch_input_path(
+    watcher: FileWatcher,
+    pipeline: LivePipeline,
+    source_name: str,
+    live_metrics: LiveMetrics,
+    is_ready: Optional[Callable] = None,
+    input_files: Optional[dict] = None,
+):
+    """Send the new files of the input folder through the pipeline, oldest
+    first. This never returns.
+
+    Args:
+        watcher (FileWatcher): new files of the input folder
+        pipeline (LivePipeline): processes the new files
+        source_name (str): kind of files, for logging
+        live_metrics (LiveMetrics): metrics of the run
+        is_ready (callable): called with the path of each new file, returns
+            (bool, str) as `validate_bam_file`. Files that are not ready are
+            tried again later.
+        input_files (dict): paths of the files processed already by name, 
+            as given by `LiveSnapshot.processed_files`
+    """
 
-                model = get_model_path(model)
+    # keep track of processed files
+    if input_files is None:
+        input_files = dict()
+    discovered = 0
+    while True:
 
-                logging.info("Validating model: {}".format(model))
-                valid_model = validate_model_file(model)
+        pipeline.check()
 
-                if valid_model:
-                    logging.info("Successful model validation")
-                else:
-                    logging.error(
-                        '''
-                        Model did no pass validation, it will be skipped
+        # files found since the last iteration
+        live_metrics.files_discovered.inc(watcher.discovered - discovered)
+        discovered = watcher.discovered
+        live_metrics.backlog.set(len(watcher.pending) + pipeline.in_flight)
+
+        logging.info(
+            '''
+            Looking for new {} files, so far found {}
+            '''.format(source_name, len(input_files))
+        )
+
+        # new files sorted by timestamp so that we process them in an 
+        # orderly manner
+        ready_files = list()
+        for file_path, timestamp in watcher.pending_files():
+            
+            # check if we have processed a file with this name already
+            file_name = Path(file_path).stem
+            if file_name in input_files:
+                watcher.mark_done(file_path)
+                live_metrics.backlog.inc(-1)
+                continue
+            logging.info('New {} file found: {}'.format(source_name, file_path))
+
+            if is_ready is not None:
+                ready, msg = is_ready(file_path)
+                if not ready:
+                    logging.warning(
                         '''
+                        File might not be complete yet, will try again later.
+                        Reason: {}.
+                        '''.format(msg)
                     )
                     continue
 
-                inference_session, array_probes_df, decoding_dict, temperatures, weight_matrix, merge_dict = load_model(model)    
-
-                logging.info("Starting prediction")
-                prediction_df = predict_sample(
-                    inference_session = inference_session,
-                    bed_file = bed_output_file,
-                    decoding_dict = deepcopy(decoding_dict),
-                    probes_df = array_probes_df,
-                    weight_matrix = weight_matrix,
-                    temperatures = temperatures,
-                    merge_dict = merge_dict,
-                )
-                prediction_df['timestamp'] = timestamp
+            # add to input_files as we consider this file processed
+            input_files[file_name] = file_path
+            watcher.mark_done(file_path)
+            ready_files.append((file_path, timestamp))
 
-                output_csv = os.path.join(
-                    output_path, 
-                    'predictions_{}.csv'.format(Path(model).stem)
-                )
-                prediction_df.to_csv(
-                    output_csv,
-                    mode = 'a',
-                    index = False,
-                    header = not os.path.exists(output_csv),
-                )
+        # a file followed by others is added up without being predicted
+        for i, (file_path, timestamp) in enumerate(ready_files):
+            pipeline.submit(
+                file_path, timestamp, more = i < len(ready_files) - 1,
+            )
 
-                if plot_results:
+        logging.info('No new files found, waiting for new files')
+        watcher.wait()
 
-                    # plot the last prediction
-                    output_pdf = os.path.join(
-                        output_path, 
-                        'predictions_{}_{}.pdf'.format(
-                            len(meg_files)-1,
-                            Path(model).stem,
-                        )
-                    )
-                    logging.info('Plotting results to: {}'.format(output_pdf))
-
-                    with zipfile.ZipFile(model, 'r') as zipf:
-                        logging.debug("Loading colors dict")
-                        try:
-                            color_dict = json.load(zipf.open('colors.json'))
-                        except FileNotFoundError:
-                            logging.debug("No colors dict in zip file")
-                            color_dict = None
-                    
-                    plot_prediction(
-                        prediction_df = prediction_df,
-                        color_dict = color_dict,
-                        output_file = output_pdf
-                    )
+def live_guppy(
+    input_path: str,
+    output_path: str,
+    model_files: List[str],
+    probes_df: pd.DataFrame,
+    margin: int,
+    neg_threshold: float,
+    pos_threshold: float,
+    plot_results: bool,
+    cooldown: int,
+    executor: Optional[Executor] = None,
+    memo: Optional[PredictionMemo] = None,
+    live_metrics: Optional[LiveMetrics] = None,
+    extraction_pool: Optional[ExtractionPool] = None,
+    probe_counts: Optional[ProbeCallCounts] = None,
+    snapshot: Optional[LiveSnapshot] = None,
+    watcher: Optional[FileWatcher] = None,
+    pipeline_depth: Optional[int] = 2,
+    coalesce: Optional[bool] = True,
+):
 
-                    output_pdf = os.path.join(
-                        output_path, 
-                        'predictions_overtime_{}.pdf'.format(
-                            Path(model).stem,
-                        )
-                    )
-                    predictions_time = pd.read_csv(
-                        output_csv,
-                        header = 0,
-                        index_col = None,
-                    )
-                    plot_prediction_over_time(
-                        prediction_df = predictions_time,
-                        color_dict = color_dict,
-                        output_file = output_pdf,
-                    )
+    if live_metrics is None:
+        live_metrics = LiveMetrics()
+    if probe_counts is None:
+        probe_counts = ProbeCallCounts(probes_df)
+    if snapshot is None:
+        snapshot = LiveSnapshot(probe_counts, output_path)
+    if watcher is None:
+        watcher = FileWatcher(input_path, '.bam', cooldown)
+    logging.info('Starting live prediction from bam files')
+
+    pipeline = LivePipeline(
+        extract = partial(
+            extract_bam_file,
+            output_path = output_path,
+            probes_df = probes_df,
+            margin = margin,
+            neg_threshold = neg_threshold,
+            pos_threshold = pos_threshold,
+            extraction_pool = extraction_pool,
+        ),
+        output_path = output_path,
+        model_files = model_files,
+        probe_counts = probe_counts,
+        snapshot = snapshot,
+        plot_results = plot_results,
+        executor = executor,
+        memo = memo,
+        live_metrics = live_metrics,
+        depth = pipeline_depth,
+        coalesce = coalesce,
+    )
+
+    try:
+        # sometimes we catch the bam file mid write up, it is tried again
+        # later, the file is read without an index so there is no index 
+        # file to make
+        watch_input_path(
+            watcher = watcher,
+            pipeline = pipeline,
+            source_name = 'bam',
+            live_metrics = live_metrics,
+            is_ready = validate_bam_file,
+            input_files = snapshot.processed_files(),
+        )
+    finally:
+        pipeline.close()
 
-                else:
-                    logging.info('Skipping plotting results')
+def live_megalodon(
+    input_path: str,
+    output_path: str,
+    model_files: List[str],
+    probes_file: str,
+    margin: int,
+    neg_threshold: float,
+    pos_threshold: float,
+    plot_results: bool,
+    cooldown: int,
+    executor: Optional[Executor] = None,
+    memo: Optional[PredictionMemo] = None,
+    live_metrics: Optional[LiveMetrics] = None,
+    extraction_pool: Optional[ExtractionPool] = None,
+    chunk_size: Optional[int] = CHUNK_SIZE,
+    probe_counts: Optional[ProbeCallCounts] = None,
+    snapshot: Optional[LiveSnapshot] = None,
+    watcher: Optional[FileWatcher] = None,
+    pipeline_depth: Optional[int] = 2,
+    coalesce: Optional[bool] = True,
+):
 
+    if live_metrics is None:
+        live_metrics = LiveMetrics()
+    if probe_counts is None:
+        probe_counts = ProbeCallCounts(read_probes_file(probes_file))
+    if snapshot is None:
+        snapshot = LiveSnapshot(probe_counts, output_path)
+    if watcher is None:
+        watcher = FileWatcher(
+            input_path, '.txt', cooldown, validate = validate_megalodon_file,
+        )
+    logging.info('Starting live prediction from megalodon output files')
 
-        logging.info(
-            '''
-            No new bam files found, sleeping for {} seconds
-            '''.format(cooldown)
+    pipeline = LivePipeline(
+        extract = partial(
+            extract_megalodon_file,
+            probes_file = probes_file,
+            margin = margin,
+            neg_threshold = neg_threshold,
+            pos_threshold = pos_threshold,
+            chunk_size = chunk_size,
+            extraction_pool = extraction_pool,
+        ),
+        output_path = output_path,
+        model_files = model_files,
+        probe_counts = probe_counts,
+        snapshot = snapshot,
+        plot_results = plot_results,
+        executor = executor,
+        memo = memo,
+        live_metrics = live_metrics,
+        depth = pipeline_depth,
+        coalesce = coalesce,
+    )
+
+    try:
+        watch_input_path(
+            watcher = watcher,
+            pipeline = pipeline,
+            source_name = 'megalodon',
+            live_metrics = live_metrics,
+            input_files = snapshot.processed_files(),
         )
-        time.sleep(cooldown)
\ No newline at end of file
+    finally:
+        pipeline.close()
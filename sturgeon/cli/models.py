@@ -3,10 +3,17 @@ import shutil
 from pathlib import Path
 import logging
 
-from sturgeon.utils import get_available_models, validate_model_file
+from sturgeon.catalog import get_available_models, get_model_path
+from sturgeon.catalog import load_model_catalog
 
 
-def actions_models(action, model_files):
+def actions_models(
+    action, 
+    model_files, 
+    quantization = 'dynamic', 
+    input_path = None, 
+    output_path = None,
+):
 
     logging.info("Sturgeon start up")
     logging.info("Model program")
@@ -17,10 +24,18 @@ def actions_models(action, model_files):
         add_models(model_files)
     elif action == 'delete':
         del_models(model_files)
+    elif action == 'quantize':
+        quantize_models(model_files, quantization, input_path, output_path)
 
 def list_models():
 
-    available_models = get_available_models(print_str=True)
+    catalog = load_model_catalog()
+
+    available_models = ""
+    for name, entry in catalog.items():
+        available_models += "\n{} ({} classes, {} probes)".format(
+            name, entry['num_classes'], entry['num_probes'],
+        )
 
     msg = '''
     The following models are available: {}
@@ -33,6 +48,8 @@ def list_models():
 
 def add_models(model_files):
 
+    from sturgeon.utils import validate_model_file
+
     for model in model_files:
 
         model_name = Path(model).stem
@@ -85,4 +102,74 @@ def del_models(model_files):
         os.remove(model)
 
 
-    list_models()
\ No newline at end of file
+    list_models()
+
+
+def quantize_models(model_files, quantization, input_path, output_path):
+    """Make quantized copies of the models and compare them against the
+    original models on the bed files in input_path
+    """
+
+    from sturgeon.utils import validate_model_file
+    from sturgeon.quantization import quantize_model_file, compare_model_files
+
+    bed_files = list()
+    if input_path is not None and os.path.isfile(input_path):
+        bed_files.append(input_path)
+    elif input_path is not None and os.path.isdir(input_path):
+        for f in sorted(os.listdir(input_path)):
+            if not f.endswith('.bed'):
+                continue
+            bed_files.append(os.path.join(input_path, f))
+
+    if len(bed_files) == 0:
+        if quantization == 'static':
+            err_msg = '''
+            Static quantization needs bed files to calibrate, none found in: {}
+            '''.format(input_path)
+            logging.error(err_msg)
+            raise ValueError(err_msg)
+        logging.warning(
+            "No bed files found in: {}, skipping the comparison".format(input_path)
+        )
+
+    for model in model_files:
+
+        model_file = get_model_path(model)
+        if not validate_model_file(model_file):
+            logging.error("Given model file is not a valid model file, skipping: {}".format(model))
+            continue
+
+        model_dir = output_path
+        if model_dir is None:
+            model_dir = os.path.dirname(os.path.abspath(model_file))
+        elif not os.path.isdir(model_dir):
+            os.makedirs(model_dir)
+        output_file = os.path.join(
+            model_dir, 
+            Path(model_file).stem + '_{}.zip'.format(quantization),
+        )
+
+        quantize_model_file(
+            model_file = model_file,
+            output_file = output_file,
+            mode = quantization,
+            bed_files = bed_files,
+        )
+
+        if len(bed_files) == 0:
+            continue
+
+        report = compare_model_files(model_file, output_file, bed_files)
+
+        msg = '''
+    Quantized model: {output_file}
+        Samples compared:       {samples}
+        Top class agreement:    {top_class_agreement:.2%}
+        Max score deviation:    {max_score_deviation:.5f}
+        Inference time (ms):    {original_time_ms:.3f} -> {quantized_time_ms:.3f}
+        Speed up:               {speed_up:.2f}x
+        Size (MB):              {original_size_mb:.1f} -> {quantized_size_mb:.1f}
+    '''.format(output_file = output_file, **report)
+
+        print(msg)
@@ -1,20 +1,31 @@
 import os
 from typing import Optional, List
 import logging
-import zipfile
-import json
 from pathlib import Path
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 
-from sturgeon.utils import validate_model_file, get_model_path
-from sturgeon.prediction import load_model, predict_sample
-from sturgeon.plot import plot_prediction
+import pandas as pd
+
+from sturgeon.prediction import predict_samples
+from sturgeon.registry import (
+    ModelBundle,
+    get_model_registry, 
+    configure_sessions, 
+    predict_sample_bundles,
+)
+from sturgeon.constants import SESSION_CONFIG_FILE
 
 def predict(
     input_path: List[str],
     model_files: List[str],
     output_path: str,
     plot_results: Optional[bool] = False,
+    batch_size: Optional[int] = 32,
+    session_config: Optional[dict] = None,
+    tune: Optional[bool] = False,
+    session_config_file: Optional[str] = SESSION_CONFIG_FILE,
+    concurrent_models: Optional[bool] = False,
 ):
 
     logging.info("Sturgeon start up")
@@ -48,77 +59,120 @@ def predict(
             logging.warning(err_msg)
             #raise ValueError(err_msg)
 
+    if batch_size < 1:
+        err_msg = '''
+        --batch-size must be a positive integer, given: {}
+        '''.format(batch_size)
+        logging.error(err_msg)
+        raise ValueError(err_msg)
+
     logging.info("Found a total of {} bed files".format(len(bed_files)))
     logging.info("Found a total of {} model files".format(len(model_files)))
     logging.info("Results will be saved in: {}".format(output_path))
 
-    for model in model_files:
-
-        model = get_model_path(model)
+    configure_sessions(
+        model_files = model_files,
+        session_config = session_config,
+        tune = tune,
+        session_config_file = session_config_file,
+    )
+    model_registry = get_model_registry()
+
+    if concurrent_models:
+        bundles = [model_registry.get(model) for model in model_files]
+        bundles = [bundle for bundle in bundles if bundle is not None]
+        if len(bundles) == 0:
+            return
+
+        logging.info("Starting prediction with {} models at the same time".format(
+            len(bundles)
+        ))
+        with ThreadPoolExecutor(max_workers = len(bundles)) as executor:
+            for bed_file in bed_files:
+                prediction_dfs = predict_sample_bundles(
+                    bed_file = bed_file,
+                    bundles = bundles,
+                    executor = executor,
+                )
+                for bundle, prediction_df in zip(bundles, prediction_dfs):
+                    save_prediction(
+                        prediction_df = prediction_df,
+                        bed_file = bed_file,
+                        bundle = bundle,
+                        output_path = output_path,
+                        plot_results = plot_results,
+                    )
+        return
 
-        logging.info("Validating model: {}".format(model))
-        valid_model = validate_model_file(model)
+    for model in model_files:
 
-        if valid_model:
-            logging.info("Successful model validation")
-        else:
-            logging.error("Model did no pass validation, it will be skipped")
+        bundle = model_registry.get(model)
+        if bundle is None:
             continue
 
         logging.info("Starting prediction")
 
-        inference_session, probes_df, decoding_dict, temperatures, merge_dict = load_model(model)                
-
-        for bed_file in bed_files:
-
-            bed_name = Path(bed_file).stem
-
-            prediction_df = predict_sample(
-                inference_session = inference_session,
+        prediction_dfs = predict_samples(
+            inference_session = bundle.inference_session,
+            bed_files = bed_files,
+            decoding_dict = deepcopy(bundle.decoding_dict),
+            probes_df = bundle.probes_df,
+            temperatures = bundle.temperatures,
+            merge_dict = bundle.merge_dict,
+            batch_size = batch_size,
+            probe_index = bundle.probe_index,
+            io_binding = bundle.io_binding,
+        )
+
+        for bed_file, prediction_df in zip(bed_files, prediction_dfs):
+            save_prediction(
+                prediction_df = prediction_df,
                 bed_file = bed_file,
-                decoding_dict = deepcopy(decoding_dict),
-                probes_df = probes_df,
-                temperatures = temperatures,
-                merge_dict = merge_dict,
-            )
-
-            output_csv = os.path.join(
-                output_path, 
-                bed_name + '_{}.csv'.format(Path(model).stem)
-            )
-            logging.info('Saving results to: {}'.format(output_csv))
-            prediction_df.to_csv(
-                output_csv, 
-                header = True, 
-                index = False,
+                bundle = bundle,
+                output_path = output_path,
+                plot_results = plot_results,
             )
 
-            if plot_results:
-                output_pdf = os.path.join(
-                    output_path, 
-                    bed_name + '_{}.pdf'.format(Path(model).stem)
-                )
-                output_png = os.path.join(
-                    output_path,
-                    bed_name + '_{}.png'.format(Path(model).stem)
-                )
-                logging.info('Plotting results to: {}'.format(output_pdf))
-
-                with zipfile.ZipFile(model, 'r') as zipf:
-                    logging.debug("Loading colors dict")
-                    try:
-                        color_dict = json.load(zipf.open('colors.json'))
-                    except FileNotFoundError:
-                        logging.debug("No colors dict in zip file")
-                        color_dict = None
-                
-                plot_prediction(
-                    prediction_df = prediction_df,
-                    color_dict = color_dict,
-                    output_file = output_pdf,
-                    output_png = output_png
-                )
-            else:
-                logging.info('Skipping plotting results')
-
-    
\ No newline at end of file
+def save_prediction(
+    prediction_df: pd.DataFrame,
+    bed_file: str,
+    bundle: ModelBundle,
+    output_path: str,
+    plot_results: bool,
+):
+    """Save the prediction of a bed file by a model as csv, and plot it"""
+
+    bed_name = Path(bed_file).stem
+
+    output_csv = os.path.join(
+        output_path, 
+        bed_name + '_{}.csv'.format(bundle.name)
+    )
+    logging.info('Saving results to: {}'.format(output_csv))
+    prediction_df.to_csv(
+        output_csv, 
+        header = True, 
+        index = False,
+    )
+
+    if plot_results:
+        from sturgeon.plot import plot_prediction
+
+        output_pdf = os.path.join(
+            output_path, 
+            bed_name + '_{}.pdf'.format(bundle.name)
+        )
+        output_png = os.path.join(
+            output_path,
+            bed_name + '_{}.png'.format(bundle.name)
+        )
+        logging.info('Plotting results to: {}'.format(output_pdf))
+        
+        plot_prediction(
+            prediction_df = prediction_df,
+            color_dict = bundle.color_dict,
+            output_file = output_pdf,
+            output_png = output_png
+        )
+    else:
+        logging.info('Skipping plotting results')
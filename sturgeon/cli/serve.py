@@ -0,0 +1,285 @@
+import os
+import io
+import json
+import signal
+import logging
+import socketserver
+from typing import Optional, List
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pandas as pd
+
+from sturgeon.utils import load_bed_file
+from sturgeon.prediction import bed_to_numpy
+from sturgeon.registry import get_model_registry, configure_sessions
+from sturgeon.constants import NOMEASURE_VALUE, SESSION_CONFIG_FILE
+
+
+def serve(
+    model_files: List[str],
+    host: Optional[str] = '127.0.0.1',
+    port: Optional[int] = 8765,
+    socket_file: Optional[str] = None,
+    workers: Optional[int] = 1,
+    session_config: Optional[dict] = None,
+    tune: Optional[bool] = False,
+    session_config_file: Optional[str] = SESSION_CONFIG_FILE,
+):
+    """Keep models loaded and predict samples sent over HTTP
+
+    The server listens on localhost or on a unix socket. Models are loaded
+    once before the worker processes are forked, so the workers share them
+    copy-on-write.
+
+    Endpoints:
+        GET /models: loaded models and their classes
+        POST /predict: json with one of
+            {"bed_file": path to a bed file}
+            {"bed": contents of a bed file}
+            {"calls": {"probe_id": [...], "methylation_call": [...]}}
+            and optionally {"models": [model names]} to use only some models.
+            Returns the number of measured probes and the calibrated scores of
+            each model.
+
+    Args:
+        model_files (list): models to load
+        host (str): address to listen on, if socket_file is not given
+        port (int): port to listen on, if socket_file is not given
+        socket_file (str): unix socket to listen on
+        workers (int): number of worker processes
+        session_config (dict): onnxruntime session settings
+        tune (bool): whether to find and save the fastest session settings
+        session_config_file (str): file with saved session settings
+    """
+
+    logging.info("Sturgeon start up")
+    logging.info("Prediction server program")
+
+    if workers < 1:
+        err_msg = '''
+        --workers must be a positive integer, given: {}
+        '''.format(workers)
+        logging.error(err_msg)
+        raise ValueError(err_msg)
+
+    if workers > 1 and not hasattr(os, 'fork'):
+        logging.warning(
+            "Worker processes are not supported on this platform, using one"
+        )
+        workers = 1
+
+    session_config = configure_sessions(
+        model_files = model_files,
+        session_config = session_config,
+        tune = tune,
+        session_config_file = session_config_file,
+    )
+
+    # onnxruntime thread pools do not survive a fork, forked workers run
+    # single threaded sessions and the parallelism comes from the workers
+    if workers > 1 and session_config.get('intra_op_num_threads', 1) != 1:
+        logging.warning(
+            "Using single threaded sessions since there are several workers"
+        )
+        session_config['intra_op_num_threads'] = 1
+        session_config['inter_op_num_threads'] = 1
+        get_model_registry().set_session_config(session_config)
+
+    model_registry = get_model_registry()
+    model_registry.max_models = max(model_registry.max_models, len(model_files))
+    bundles = dict()
+    for model in model_files:
+        bundle = model_registry.get(model)
+        if bundle is not None:
+            bundles[bundle.name] = bundle
+
+    if len(bundles) == 0:
+        err_msg = "None of the given models could be loaded"
+        logging.error(err_msg)
+        raise ValueError(err_msg)
+
+    if socket_file is not None:
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
+        server = UnixHTTPServer(socket_file, PredictionRequestHandler)
+        logging.info("Listening on unix socket: {}".format(socket_file))
+    else:
+        server = HTTPServer((host, port), PredictionRequestHandler)
+        logging.info("Listening on: http://{}:{}".format(host, port))
+    server.bundles = bundles
+
+    try:
+        if workers == 1:
+            server.serve_forever()
+        else:
+            serve_prefork(server, workers)
+    except KeyboardInterrupt:
+        logging.info("Stopping server")
+    finally:
+        server.server_close()
+        if socket_file is not None and os.path.exists(socket_file):
+            os.remove(socket_file)
+
+def serve_prefork(server: socketserver.BaseServer, workers: int):
+    """Fork worker processes that accept requests on the same socket, and
+    wait for them. Workers that die are replaced.
+
+    Workers ignore interrupts, the main process stops them when it is
+    interrupted or terminated.
+    """
+
+    children = set()
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    def fork_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    for _ in range(workers):
+        fork_worker()
+    logging.info("Started {} workers".format(workers))
+
+    try:
+        while True:
+            pid, _ = os.wait()
+            children.discard(pid)
+            logging.warning("Worker {} stopped, starting a new one".format(pid))
+            fork_worker()
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                continue
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                continue
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """HTTP over a unix socket"""
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path == '/models':
+            models = {
+                name: {
+                    'model_file': bundle.model_file,
+                    'classes': bundle.class_names,
+                    'number_probes': len(bundle.probe_index),
+                }
+                for name, bundle in self.server.bundles.items()
+            }
+            self.send_json(200, models)
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'Unknown path: {}'.format(self.path)})
+
+    def do_POST(self):
+
+        if self.path != '/predict':
+            self.send_json(404, {'error': 'Unknown path: {}'.format(self.path)})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            response = predict_request(request, self.server.bundles)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            logging.warning("Invalid request: {}".format(e))
+            self.send_json(400, {'error': str(e)})
+            return
+
+        self.send_json(200, response)
+
+    def send_json(self, status: int, content: dict):
+
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the default implementation does not work on unix sockets
+        logging.debug(format % args)
+
+
+def request_to_bed_df(request: dict) -> pd.DataFrame:
+    """Get the bed dataframe from a prediction request"""
+
+    if 'bed_file' in request:
+        return load_bed_file(request['bed_file'])
+    if 'bed' in request:
+        return load_bed_file(io.StringIO(request['bed']))
+    if 'calls' in request:
+        return pd.DataFrame({
+            'probe_id': request['calls']['probe_id'],
+            'methylation_call': request['calls']['methylation_call'],
+        })
+    raise ValueError("Request must contain one of: bed_file, bed, calls")
+
+def predict_request(request: dict, bundles: dict) -> dict:
+    """Predict the sample in a request with the requested models
+
+    Args:
+        request (dict): decoded request body
+        bundles (dict): loaded models by name
+
+    Returns a dict with the scores of each model
+    """
+
+    model_names = request.get('models', list(bundles.keys()))
+    # a single model can be given by its name
+    if isinstance(model_names, str):
+        model_names = [model_names]
+    if not isinstance(model_names, list) or not all(
+        isinstance(model_name, str) for model_name in model_names
+    ):
+        raise ValueError(
+            "models must be a model name or a list of model names, got: {}".format(
+                json.dumps(model_names)
+            )
+        )
+    for model_name in model_names:
+        if model_name not in bundles:
+            raise ValueError("Model not loaded: {}".format(model_name))
+
+    bed_df = request_to_bed_df(request)
+
+    # encode the sample once and gather the input of each model from it
+    x_union = bed_to_numpy(
+        bed_df = bed_df,
+        probe_index = get_model_registry().probe_index,
+    )[0]
+
+    response = dict()
+    for model_name in model_names:
+        bundle = bundles[model_name]
+        x = bundle.input_from_union(x_union)
+        scores = bundle.predict(x)[0]
+        response[model_name] = {
+            'number_probes': int(np.sum(x != NOMEASURE_VALUE)),
+            'scores': dict(zip(bundle.class_names, scores.tolist())),
+        }
+
+    return response
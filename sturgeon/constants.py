@@ -1,3 +1,21 @@
+import os
+
 METHYL_VALUE = 1.0
 UNMETHYL_VALUE = -1.0
-NOMEASURE_VALUE = 0.0
\ No newline at end of file
+NOMEASURE_VALUE = 0.0
+
+# onnxruntime session settings saved by --tune
+SESSION_CONFIG_FILE = os.path.join(
+    os.path.expanduser('~'), '.sturgeon', 'session_config.json'
+)
+
+# names, classes and probes of the built-in models
+MODEL_CATALOG_FILE = os.path.join(
+    os.path.expanduser('~'), '.sturgeon', 'model_catalog.json'
+)
+
+# rows of megalodon and modkit files read at a time
+CHUNK_SIZE = 1000000
+
+# bam files smaller than this are read in a single pass, without the index
+INDEX_FREE_BAM_SIZE = 256 * 1024 * 1024
@@ -5,6 +5,10 @@ import sys
 import os
 import time
 import argparse
+import logging
+
+# keep imports here light, subcommands import what they need when they run
+START_TIME = time.perf_counter()
 
 from sturgeon import __version__
 from sturgeon.logger import setup_logging
@@ -37,6 +41,17 @@ def run():
         action='store_true',
         help="Will not write the log to a file",
     )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Save the time spent in each stage to this file, in the Chrome trace format",
+    )
+    parser.add_argument(
+        "--trace-onnx",
+        action='store_true',
+        help="Also include the onnxruntime profiler events in the trace",
+    )
     parser.set_defaults(func=lambda _: parser.print_help())
 
     from sturgeon.parsers import (
@@ -44,6 +59,8 @@ def run():
         register_live,
         register_inputtobed,
         register_models,
+        register_serve,
+        register_bench,
     )
     
     subparsers = parser.add_subparsers(title="sub-commands")
@@ -51,6 +68,8 @@ def run():
     register_live(subparsers)
     register_inputtobed(subparsers)
     register_models(subparsers)
+    register_serve(subparsers)
+    register_bench(subparsers)
 
     args = parser.parse_args()
     
@@ -71,8 +90,20 @@ def run():
     if not log_setup_success:
         print('Failed to setup the log')
         sys.exit(1)
-    
-    cmd_func(args)
+
+    logging.debug("Start up time: {:.3f} seconds".format(
+        time.perf_counter() - START_TIME
+    ))
+
+    if args.trace is not None:
+        from sturgeon.tracing import enable_tracing, save_trace
+        enable_tracing(args.trace, profile_onnx = args.trace_onnx)
+        try:
+            cmd_func(args)
+        finally:
+            save_trace()
+    else:
+        cmd_func(args)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,317 @@
+"""
+Metrics of a live run in the Prometheus text format
+
+The metrics are updated from the live loop and served on localhost by a
+background thread, so scraping does not interrupt the loop.
+"""
+import os
+import sys
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Callable
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# seconds, from fast inference up to slow bam extraction
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+    120.0, 300.0,
+)
+
+
+def format_labels(labels: tuple) -> str:
+
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels
+    ) + '}'
+
+
+class Metric():
+    """Base of the metric types, values are kept per set of labels
+
+    Args:
+        name (str): metric name
+        documentation (str): help text of the metric
+    """
+
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+
+        self.name = name
+        self.documentation = documentation
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def samples(self) -> list:
+        """List of (name, labels, value) to be exposed"""
+
+        with self._lock:
+            return [
+                (self.name, labels, value)
+                for labels, value in self._values.items()
+            ]
+
+    def render(self) -> str:
+
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.metric_type),
+        ]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(labels), repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    metric_type = 'counter'
+
+    def inc(self, value: Optional[float] = 1, **labels):
+
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+
+    metric_type = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        function: Optional[Callable] = None,
+    ):
+
+        super(Gauge, self).__init__(name, documentation)
+        self.function = function
+
+    def set(self, value: float, **labels):
+
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value: Optional[float] = 1, **labels):
+
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self) -> list:
+
+        # gauges computed when scraped
+        if self.function is not None:
+            value = self.function()
+            if value is None:
+                return list()
+            return [(self.name, tuple(), value)]
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+
+    metric_type = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Optional[tuple] = DEFAULT_BUCKETS,
+    ):
+
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> list:
+
+        samples = list()
+        with self._lock:
+            values = [(k, (list(c), t)) for k, (c, t) in self._values.items()]
+
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append(
+                    (self.name + '_bucket', labels + (('le', le), ), cumulative)
+                )
+            samples.append((self.name + '_count', labels, cumulative))
+            samples.append((self.name + '_sum', labels, total))
+        return samples
+
+
+class MetricsRegistry():
+    """Collection of metrics that are exposed together"""
+
+    def __init__(self):
+
+        self.metrics = list()
+
+    def add(self, metric: Metric) -> Metric:
+
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+class LiveMetrics():
+    """Metrics of the live prediction loop"""
+
+    def __init__(self):
+
+        self.registry = MetricsRegistry()
+        self.last_prediction_time = None
+
+        self.files_discovered = self.registry.add(Counter(
+            'sturgeon_live_files_discovered_total',
+            'New input files found in the input folder',
+        ))
+        self.files_processed = self.registry.add(Counter(
+            'sturgeon_live_files_processed_total',
+            'Input files processed and predicted',
+        ))
+        self.files_coalesced = self.registry.add(Counter(
+            'sturgeon_live_files_coalesced_total',
+            'Input files added up while newer files were waiting, predicted later',
+        ))
+        self.backlog = self.registry.add(Gauge(
+            'sturgeon_live_backlog_files',
+            'Input files found but not processed yet',
+        ))
+        self.stage_seconds = self.registry.add(Histogram(
+            'sturgeon_live_stage_seconds',
+            'Time spent in each stage of processing a file',
+        ))
+        self.measured_probes = self.registry.add(Gauge(
+            'sturgeon_live_measured_probes',
+            'Measured probes in the last prediction of each model',
+        ))
+        self.predictions = self.registry.add(Counter(
+            'sturgeon_live_predictions_total',
+            'Predictions made by each model',
+        ))
+        self.last_prediction = self.registry.add(Gauge(
+            'sturgeon_live_last_prediction_timestamp_seconds',
+            'Unix time of the last prediction',
+            function = lambda: self.last_prediction_time,
+        ))
+        self.since_last_prediction = self.registry.add(Gauge(
+            'sturgeon_live_seconds_since_last_prediction',
+            'Seconds since the last prediction',
+            function = self.seconds_since_last_prediction,
+        ))
+        self.rss = self.registry.add(Gauge(
+            'process_resident_memory_bytes',
+            'Resident memory of the process in bytes',
+            function = resident_memory_bytes,
+        ))
+
+    @contextmanager
+    def stage(self, stage: str):
+        """Time a stage of processing a file"""
+
+        st = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds.observe(time.perf_counter() - st, stage = stage)
+
+    def prediction(self, model: str, number_probes: int):
+        """Record a prediction of a model"""
+
+        self.predictions.inc(model = model)
+        self.measured_probes.set(number_probes, model = model)
+        self.last_prediction_time = time.time()
+
+    def seconds_since_last_prediction(self) -> Optional[float]:
+
+        if self.last_prediction_time is None:
+            return None
+        return time.time() - self.last_prediction_time
+
+    def render(self) -> str:
+
+        return self.registry.render()
+
+
+def resident_memory_bytes() -> Optional[float]:
+    """Current resident memory of the process, peak memory if the current
+    one is not available
+    """
+
+    try:
+        with open('/proc/self/statm', 'r') as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macos
+        return peak if sys.platform == 'darwin' else peak * 1024
+    return None
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def start_metrics_server(
+    metrics: LiveMetrics,
+    port: int,
+    host: Optional[str] = '127.0.0.1',
+) -> ThreadingHTTPServer:
+    """Serve the metrics on http://host:port/metrics from a daemon thread"""
+
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    logging.info("Serving metrics on: http://{}:{}/metrics".format(host, port))
+
+    return server
@@ -1,7 +1,78 @@
 import os
 import argparse
 
-from sturgeon.utils import get_available_models
+from sturgeon.catalog import get_available_models
+from sturgeon.constants import SESSION_CONFIG_FILE, CHUNK_SIZE
+
+def register_session_arguments(subparser):
+
+    subparser.add_argument(
+        '--threads',
+        type = int,
+        default = None,
+        help='''
+        Number of threads used by onnxruntime within each operator. Defaults 
+        to the saved session settings, or 1
+        '''
+    )
+    subparser.add_argument(
+        '--inter-op-threads',
+        type = int,
+        default = None,
+        help='''
+        Number of threads used by onnxruntime to run operators in parallel, 
+        only used with the parallel execution mode. Defaults to the saved 
+        session settings, or 1
+        '''
+    )
+    subparser.add_argument(
+        '--graph-optimization',
+        type = str,
+        default = None,
+        choices = ['disable', 'basic', 'extended', 'all'],
+        help='''
+        onnxruntime graph optimization level. Defaults to the saved session
+        settings, or all
+        '''
+    )
+    subparser.add_argument(
+        '--execution-mode',
+        type = str,
+        default = None,
+        choices = ['sequential', 'parallel'],
+        help='''
+        onnxruntime execution mode. Defaults to the saved session settings, or
+        sequential
+        '''
+    )
+    subparser.add_argument(
+        '--tune',
+        action='store_true',
+        help='''
+        Benchmark several session settings on this machine with the first
+        model, save the fastest to --session-config and use them
+        '''
+    )
+    subparser.add_argument(
+        '--session-config',
+        type = str,
+        default = SESSION_CONFIG_FILE,
+        help='''
+        File with saved session settings, used if it exists. Explicitly given
+        settings take precedence
+        '''
+    )
+
+def session_config_from_args(args):
+
+    session_config = {
+        'intra_op_num_threads': args.threads,
+        'inter_op_num_threads': args.inter_op_threads,
+        'graph_optimization_level': args.graph_optimization,
+        'execution_mode': args.execution_mode,
+    }
+    session_config = {k: v for k, v in session_config.items() if v is not None}
+    return session_config
 
 def register_predict(parser):
 
@@ -39,6 +110,25 @@ def register_predict(parser):
         action='store_true',
         help='Also plot the results of the predictions'
     )
+    subparser.add_argument(
+        '--batch-size',
+        type = int,
+        default = 32,
+        help='''
+        Number of bed files that are stacked together and predicted in a single
+        model call
+        '''
+    )
+    subparser.add_argument(
+        '--concurrent-models',
+        action='store_true',
+        help='''
+        Read each sample once and run all the models on it at the same time,
+        instead of one model after the other
+        '''
+    )
+
+    register_session_arguments(subparser)
 
     subparser.set_defaults(func=run_predict)
 
@@ -50,7 +140,12 @@ def run_predict(args):
         input_path = args.input_path,
         output_path = args.output_path,
         model_files = args.model_files,
-        plot_results = args.plot_results
+        plot_results = args.plot_results,
+        batch_size = args.batch_size,
+        session_config = session_config_from_args(args),
+        tune = args.tune,
+        session_config_file = args.session_config,
+        concurrent_models = args.concurrent_models,
     )
 
 def register_live(parser):
@@ -140,8 +235,107 @@ def register_live(parser):
         '--cooldown',
         type = int,
         default = 10,
-        help = 'Seconds in between checking for a new bam file'
+        help = '''
+        Longest time in seconds in between checking for new files, and for
+        files that could not be processed yet
+        '''
+    )
+    subparser.add_argument(
+        '--reuse-max-changed-probes',
+        type = int,
+        default = 0,
+        help='''
+        Reuse the previous prediction of a model if fewer than this number of
+        probes changed since it was predicted, reused predictions are marked in
+        a `reused` column. With 0 only predictions of identical inputs are 
+        reused
+        '''
+    )
+    subparser.add_argument(
+        '--concurrent-models',
+        action='store_true',
+        help='''
+        Read each sample once and run all the models on it at the same time,
+        instead of one model after the other
+        '''
+    )
+    subparser.add_argument(
+        '--metrics-port',
+        type = int,
+        default = None,
+        help='''
+        Serve metrics of the live run in the Prometheus text format on 
+        http://127.0.0.1:PORT/metrics
+        '''
+    )
+    subparser.add_argument(
+        '--workers',
+        type = int,
+        default = 1,
+        help='''
+        Number of processes used to extract methylation calls. The chromosomes of
+        each new bam file, or byte ranges of each new megalodon file, are
+        processed in parallel
+        '''
+    )
+    subparser.add_argument(
+        '--chunk-size',
+        type = int,
+        default = CHUNK_SIZE,
+        help='''
+        Rows of megalodon and modkit files read at a time, this bounds the 
+        memory used to read large files
+        '''
+    )
+    subparser.add_argument(
+        '--snapshot-interval',
+        type = int,
+        default = 60,
+        help='''
+        Seconds in between saving the merged probe methylation calls and bed 
+        file. The calls are added up in memory, the files are also saved on 
+        exit
+        '''
+    )
+    subparser.add_argument(
+        '--poll',
+        action='store_true',
+        help='''
+        Look for new files by listing the input folder instead of watching it
+        with inotify, for example for network file systems. Also used when 
+        inotify is not available
+        '''
+    )
+    subparser.add_argument(
+        '--pipeline-depth',
+        type = int,
+        default = 2,
+        help='''
+        New files are extracted, added up, predicted and plotted in stages 
+        that run at the same time. This many files are extracted at the same
+        time, and wait in between the other stages
+        '''
     )
+    subparser.add_argument(
+        '--no-coalesce',
+        action='store_true',
+        help='''
+        Predict every new file as it comes. By default, when several files
+        are waiting, they are added up and only the newest state is 
+        predicted, the files in between are predicted later in batches
+        '''
+    )
+    subparser.add_argument(
+        '--no-resume',
+        action='store_true',
+        help='''
+        Start over even if the output folder has a checkpoint of an earlier
+        run. By default a run on the same input folder and settings continues
+        from where it stopped, without processing its files again
+        '''
+    )
+
+    register_session_arguments(subparser)
 
     subparser.set_defaults(func=run_live)
 
@@ -160,6 +354,19 @@ def run_live(args):
         pos_threshold = args.pos_threshold,
         plot_results = args.plot_results,
         cooldown = args.cooldown,
+        session_config = session_config_from_args(args),
+        tune = args.tune,
+        session_config_file = args.session_config,
+        concurrent_models = args.concurrent_models,
+        reuse_max_changed_probes = args.reuse_max_changed_probes,
+        metrics_port = args.metrics_port,
+        workers = args.workers,
+        chunk_size = args.chunk_size,
+        snapshot_interval = args.snapshot_interval,
+        poll = args.poll,
+        pipeline_depth = args.pipeline_depth,
+        coalesce = not args.no_coalesce,
+        resume = not args.no_resume,
     )
 
 def register_inputtobed(parser):
@@ -246,9 +453,31 @@ def register_inputtobed(parser):
     subparser.add_argument(
         '--fivemc-code',
         type=str,
-        default = 'm',
+        default = None,
+        help='''
+        Onle letter code used to annotate 5mC. In modkit files 'm' if not 
+        given. In guppy bam files only the calls with this code are used, 
+        if not given every C modification in the MM/ML tags is used, for 
+        example both 5mC ('m') and 5hmC ('h')
+        '''
+    )
+    subparser.add_argument(
+        '--workers',
+        type = int,
+        default = 1,
         help='''
-        Onle letter code used to annotate 5mC in modkit files
+        Number of processes used to extract methylation calls. Bam files are
+        split in a task per file and chromosome, megalodon and modkit files in
+        a task per byte range of each file
+        '''
+    )
+    subparser.add_argument(
+        '--chunk-size',
+        type = int,
+        default = CHUNK_SIZE,
+        help='''
+        Rows of megalodon and modkit files read at a time, this bounds the 
+        memory used to read large files
         '''
     )
 
@@ -268,6 +497,8 @@ def run_inputtobed(args):
         neg_threshold = args.neg_threshold,
         pos_threshold = args.pos_threshold,
         fivemc_code = args.fivemc_code,
+        workers = args.workers,
+        chunk_size = args.chunk_size,
     )
 
 def register_models(parser):
@@ -281,9 +512,12 @@ def register_models(parser):
     subparser.add_argument(
         "-a", "--action",
         type = str,
-        choices = ['list', 'add', 'delete'],
+        choices = ['list', 'add', 'delete', 'quantize'],
         default = 'list',
-        help = 'What to do, list the models, add models or delete models'
+        help = '''
+        What to do, list the models, add models, delete models or make 
+        quantized copies of models
+        '''
     )
 
     subparser.add_argument(
@@ -291,7 +525,39 @@ def register_models(parser):
         type=str,
         required = False,
         nargs='+',
-        help='Model files to be added or deleted'
+        help='Model files to be added, deleted or quantized'
+    )
+    subparser.add_argument(
+        '--quantization',
+        type = str,
+        default = 'dynamic',
+        choices = ['dynamic', 'static', 'fp16'],
+        help = '''
+        Used with quantize. 'dynamic' and 'static' quantize the model to int8, 
+        'static' also quantizes the activations using the bed files in 
+        --input-path. 'fp16' converts the weights to float16
+        '''
+    )
+    subparser.add_argument(
+        '-i', '--input-path',
+        type = str,
+        default = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), 'demo', 'bed'
+        ),
+        help = '''
+        Used with quantize. Path to file (bed) or directory with bed files to 
+        compare the quantized models against the original models, and to 
+        calibrate static quantization
+        '''
+    )
+    subparser.add_argument(
+        '-o', '--output-path',
+        type = str,
+        default = None,
+        help = '''
+        Used with quantize. Where to save the quantized models, by default next 
+        to the original models
+        '''
     )
 
     subparser.set_defaults(func=run_models)
@@ -303,5 +569,179 @@ def run_models(args):
 
     models.actions_models(
         action = args.action,
-        model_files = args.model_files
+        model_files = args.model_files,
+        quantization = args.quantization,
+        input_path = args.input_path,
+        output_path = args.output_path,
+    )
+
+def register_serve(parser):
+
+    subparser = parser.add_parser(
+        'serve',
+        description = '''
+        Run a local prediction server that keeps the models loaded. Samples 
+        are sent as json over HTTP, either on localhost or on a unix socket, 
+        and the calibrated scores are returned as json. This program never 
+        ends, therefore this has to be terminated manually.''',
+        help = 'Run a local prediction server with the models loaded',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparser.add_argument(
+        '-m', '--model-files',
+        type=str,
+        required = True,
+        nargs='+',
+        help= '''
+        Model file (zip) to be used to predict. More than one can be specified.
+        These can be a path to the zip file, or one of the following built in
+        models: {} '''.format(get_available_models(print_str = True)),
+    )
+    subparser.add_argument(
+        '--host',
+        type = str,
+        default = '127.0.0.1',
+        help = 'Address to listen on'
+    )
+    subparser.add_argument(
+        '--port',
+        type = int,
+        default = 8765,
+        help = 'Port to listen on'
+    )
+    subparser.add_argument(
+        '--socket',
+        type = str,
+        default = None,
+        help = 'Listen on this unix socket instead of --host and --port'
+    )
+    subparser.add_argument(
+        '--workers',
+        type = int,
+        default = 1,
+        help = '''
+        Number of worker processes, these share the loaded models
+        '''
+    )
+
+    register_session_arguments(subparser)
+
+    subparser.set_defaults(func=run_serve)
+
+def run_serve(args):
+
+    from sturgeon.cli import serve
+
+    serve.serve(
+        model_files = args.model_files,
+        host = args.host,
+        port = args.port,
+        socket_file = args.socket,
+        workers = args.workers,
+        session_config = session_config_from_args(args),
+        tune = args.tune,
+        session_config_file = args.session_config,
+    )
+
+def register_bench(parser):
+
+    subparser = parser.add_parser(
+        'bench',
+        description = '''
+        Time each stage of the pipeline on synthetic inputs at several probe 
+        coverages and on the demo bed files. Results are saved as json, and can
+        be compared against previous results to find regressions.''',
+        help = 'Benchmark each stage of the pipeline',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparser.add_argument(
+        '-o', '--output-file',
+        type = str,
+        default = 'sturgeon_bench.json',
+        help = 'Json file where to save the results'
+    )
+    subparser.add_argument(
+        '-m', '--model-files',
+        type = str,
+        nargs = '+',
+        default = None,
+        help = '''
+        Model files (zip) to benchmark, by default a small bundled model
+        '''
+    )
+    subparser.add_argument(
+        '-i', '--input-path',
+        type = str,
+        default = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), 'demo', 'bed'
+        ),
+        help = 'Directory with bed files that are also benchmarked'
+    )
+    subparser.add_argument(
+        '--coverages',
+        type = float,
+        nargs = '+',
+        default = [0.05, 0.25, 1.0],
+        help = 'Fractions of measured probes of the synthetic inputs'
+    )
+    subparser.add_argument(
+        '--num-probes',
+        type = int,
+        default = 5000,
+        help = 'Number of probes of the synthetic call mapping inputs'
+    )
+    subparser.add_argument(
+        '--rounds',
+        type = int,
+        default = 5,
+        help = 'Number of timed runs of each benchmark'
+    )
+    subparser.add_argument(
+        '--seed',
+        type = int,
+        default = 0,
+        help = 'Seed of the synthetic inputs'
+    )
+    subparser.add_argument(
+        '--no-plot',
+        action = 'store_true',
+        help = 'Do not benchmark plotting'
+    )
+    subparser.add_argument(
+        '--compare',
+        type = str,
+        nargs = '+',
+        default = None,
+        help = '''
+        Baseline results file to compare against. If a second results file is 
+        given, these two are compared without running the benchmarks
+        '''
+    )
+    subparser.add_argument(
+        '--threshold',
+        type = float,
+        default = 0.1,
+        help = '''
+        Relative slow down of the median time above which a benchmark is a 
+        regression
+        '''
+    )
+
+    subparser.set_defaults(func=run_bench)
+
+def run_bench(args):
+
+    from sturgeon.cli import bench
+
+    bench.bench(
+        output_file = args.output_file,
+        model_files = args.model_files,
+        input_path = args.input_path,
+        coverages = args.coverages,
+        num_probes = args.num_probes,
+        rounds = args.rounds,
+        seed = args.seed,
+        plot = not args.no_plot,
+        compare = args.compare,
+        threshold = args.threshold,
     )
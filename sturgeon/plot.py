@@ -6,6 +6,9 @@ import pandas as pd
 from matplotlib import pyplot as plt
 import matplotlib.backends.backend_pdf # required for compilation
 
+from sturgeon.tracing import traced
+
+@traced
 def plot_prediction(
     prediction_df: pd.DataFrame,
     output_file: str,
@@ -25,7 +28,7 @@ def plot_prediction(
     plt.rc('legend', fontsize=SMALL_SIZE)    # legend fontsize
     plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
 
-    non_label_columns = ['number_probes', 'timestamp']
+    non_label_columns = ['number_probes', 'timestamp', 'reused']
     label_columns = []
     for c in prediction_df.columns:
         if c not in non_label_columns:
@@ -65,6 +68,7 @@ def plot_prediction(
     plt.close()
 
 
+@traced
 def plot_prediction_over_time(
     prediction_df: pd.DataFrame,
     output_file: str,
@@ -84,7 +88,7 @@ def plot_prediction_over_time(
     plt.rc('legend', fontsize=BIGGER_SIZE)    # legend fontsize
     plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
 
-    non_label_columns = ['number_probes', 'timestamp']
+    non_label_columns = ['number_probes', 'timestamp', 'reused']
     label_columns = []
     for c in prediction_df.columns:
         if c not in non_label_columns:
@@ -1,7 +1,9 @@
+import os
+import time
 from pathlib import Path
 import json
 import zipfile
-from typing import List
+from typing import List, Optional, Tuple
 import logging
 from copy import deepcopy
 
@@ -9,31 +11,103 @@ import numpy as np
 import pandas as pd
 import onnxruntime
 
-from sturgeon.utils import load_bed_file, softmax, merge_predictions
+from sturgeon.utils import load_bed_file, softmax
 from sturgeon.constants import METHYL_VALUE, UNMETHYL_VALUE, NOMEASURE_VALUE
+from sturgeon.tracing import traced, get_tracer
 
+class ProbeIndex():
+    """Maps probe ids to integer columns of a model input
+
+    The lookup table is built once, afterwards probe ids are converted to 
+    integer positions and samples are filled with a single scatter. Probes can
+    be appended but never removed, so positions that have been handed out
+    stay valid.
+
+    Args:
+        probe_ids (list): probe ids in column order
+    """
+
+    def __init__(self, probe_ids: Optional[List[str]] = None):
+
+        if probe_ids is None:
+            probe_ids = list()
+        self.probe_ids = pd.Index(probe_ids)
+
+    def __len__(self):
+        return len(self.probe_ids)
+
+    def positions(self, probe_ids) -> np.ndarray:
+        """Get the column of each probe id, -1 for probes not in the index"""
+
+        return self.probe_ids.get_indexer(probe_ids)
+
+    def add(self, probe_ids) -> np.ndarray:
+        """Append the missing probe ids and return the column of each one"""
+
+        probe_ids = pd.Index(probe_ids)
+        new_probe_ids = probe_ids[~probe_ids.isin(self.probe_ids)].unique()
+        if len(new_probe_ids) > 0:
+            self.probe_ids = self.probe_ids.append(new_probe_ids)
+        return self.positions(probe_ids)
+
+    def fill(
+        self, 
+        positions: np.ndarray, 
+        values: np.ndarray, 
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Scatter values into a vector with one column per probe
+
+        Args:
+            positions (np.ndarray): columns of the values, -1 are skipped
+            values (np.ndarray): values to be written
+            out (np.ndarray): optional buffer to write into, it is reset
+
+        Returns a np.ndarray with shape [number_probes]
+        """
+
+        if out is None:
+            out = np.empty(len(self), dtype = np.float32)
+        out[:] = NOMEASURE_VALUE
+
+        valid = positions > -1
+        out[positions[valid]] = values[valid]
+        return out
+
+@traced
 def bed_to_numpy(
     bed_df: pd.DataFrame, 
-    probes_df: pd.DataFrame,
+    probes_df: Optional[pd.DataFrame] = None,
+    probe_index: Optional[ProbeIndex] = None,
+    out: Optional[np.ndarray] = None,
 ) -> np.ndarray:
     """Convert the bed dataframe into a numpy array ready for prediction
 
     Args:
         bed_file (pd.DataFrame): loaded dataframe with methylation status
         probes_df (pd.DataFrame): dataframe with the probes information
+        probe_index (ProbeIndex): precompiled index of the model probes, if
+            given probes_df is not used. If bed_df has a `probe_idx` column, 
+            it is taken as the positions in this index.
+        out (np.ndarray): optional buffer with shape [number_probes] to fill
 
-    Returns a `OrtValue` with shape [number_probes]
+    Returns a np.ndarray with shape [1, number_probes]
     """
     methyl_col = 'methylation_call'
 
-    bed_df.loc[bed_df[methyl_col] == 0, methyl_col] = UNMETHYL_VALUE
-    bed_df = bed_df.set_index('probe_id')
-    bed_df = bed_df.reindex(index=probes_df['ID_REF'])
-    bed_df = bed_df.reset_index()
+    if probe_index is None:
+        probe_index = ProbeIndex(probes_df['ID_REF'])
+
+    if 'probe_idx' in bed_df.columns:
+        positions = np.array(bed_df['probe_idx'])
+    else:
+        positions = probe_index.positions(bed_df['probe_id'])
+
+    values = np.array(bed_df[methyl_col], dtype = np.float32)
+    values[values == 0] = UNMETHYL_VALUE
+    values[np.isnan(values)] = NOMEASURE_VALUE
 
-    x = np.transpose(np.array(bed_df[methyl_col]))
-    x = x.astype(np.float32)
-    x[np.isnan(x)] = NOMEASURE_VALUE
+    x = probe_index.fill(positions, values, out = out)
 
     t = 'Total amount of measurable probes:'
     logging.info('{0:45s} {1:6d}'.format(t, len(x)))
@@ -67,20 +141,266 @@ def model_forward(
     inference_session: onnxruntime.InferenceSession
 ) -> np.ndarray:
 
+    uncalibrated_scores = model_forward_batch(x, inference_session)[0]
+
+    return uncalibrated_scores
+
+@traced
+def model_forward_batch(
+    x: np.ndarray, 
+    inference_session: onnxruntime.InferenceSession,
+    io_binding: Optional['IOBinding'] = None,
+) -> np.ndarray:
+    """Run the model on a stack of samples
+
+    Args:
+        x (np.ndarray): input with shape [samples, number_probes]
+        inference_session (onnxruntime.InferenceSession): loaded model
+        io_binding (IOBinding): persistent buffers of the session, used if x
+            has the same shape as the bound input
+
+    Returns a np.ndarray with shape [samples, heads, classes]
+    """
+
+    if io_binding is not None and x.shape == io_binding.input_buffer.shape:
+        return io_binding.run(x)
+
+    input_node = inference_session.get_inputs()[0]
+
+    # some models are exported with a fixed batch dimension, in that case
+    # we feed them chunks of that size, the last one padded up to it
+    fixed_batch_size = input_node.shape[0]
+    if isinstance(fixed_batch_size, int) and fixed_batch_size != x.shape[0]:
+        outputs = list()
+        for i in range(0, x.shape[0], fixed_batch_size):
+            chunk = x[i:i+fixed_batch_size]
+            num_samples = chunk.shape[0]
+            if num_samples < fixed_batch_size:
+                padding = np.zeros(
+                    (fixed_batch_size - num_samples, ) + chunk.shape[1:],
+                    dtype = chunk.dtype,
+                )
+                chunk = np.concatenate([chunk, padding])
+            outputs.append(
+                run_session(chunk, inference_session)[:num_samples]
+            )
+        return np.concatenate(outputs)
+
+    return run_session(x, inference_session)
+
+def run_session(
+    x: np.ndarray, 
+    inference_session: onnxruntime.InferenceSession,
+) -> np.ndarray:
+    """Run the model on an input that matches its input shape"""
 
     # compute ONNX Runtime output prediction
+    input_node = inference_session.get_inputs()[0]
     x = onnxruntime.OrtValue.ortvalue_from_numpy(x)
-    ort_inputs = {inference_session.get_inputs()[0].name: x}
+    ort_inputs = {input_node.name: x}
     ort_outs = inference_session.run(
         ['predictions'], 
         ort_inputs,
     )[0]
 
-    uncalibrated_scores = ort_outs[0]
+    return ort_outs
 
-    return uncalibrated_scores
+class IOBinding():
+    """Input and output buffers bound to an inference session
+
+    The session reads from and writes to the same memory on every call, so
+    repeated single sample predictions do not allocate.
+
+    Args:
+        inference_session (onnxruntime.InferenceSession): loaded model
+        num_probes (int): number of input probes of the model
+    """
+
+    def __init__(
+        self, 
+        inference_session: onnxruntime.InferenceSession, 
+        num_probes: int,
+    ):
+
+        self.inference_session = inference_session
+        self.input_buffer = np.zeros((1, num_probes), dtype = np.float32)
+
+        # one regular run to find out the output shape
+        self.output_buffer = np.empty_like(
+            model_forward_batch(self.input_buffer, inference_session)
+        )
+
+        self.binding = inference_session.io_binding()
+        self.binding.bind_input(
+            name = inference_session.get_inputs()[0].name,
+            device_type = 'cpu',
+            device_id = 0,
+            element_type = self.input_buffer.dtype,
+            shape = self.input_buffer.shape,
+            buffer_ptr = self.input_buffer.ctypes.data,
+        )
+        self.binding.bind_output(
+            name = 'predictions',
+            device_type = 'cpu',
+            device_id = 0,
+            element_type = self.output_buffer.dtype,
+            shape = self.output_buffer.shape,
+            buffer_ptr = self.output_buffer.ctypes.data,
+        )
+
+    def run(self, x: np.ndarray) -> np.ndarray:
+        """Run the model, returns the output buffer which is overwritten by
+        the next call
+        """
+
+        if x is not self.input_buffer:
+            self.input_buffer[:] = x
+        self.inference_session.run_with_iobinding(self.binding)
+        return self.output_buffer
+
+DEFAULT_SESSION_CONFIG = {
+    'intra_op_num_threads': 1,
+    'inter_op_num_threads': 1,
+    'graph_optimization_level': 'all',
+    'execution_mode': 'sequential',
+}
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+def make_session_options(
+    session_config: Optional[dict] = None,
+) -> onnxruntime.SessionOptions:
+    """Create the onnxruntime session options
+
+    Args:
+        session_config (dict): values to override DEFAULT_SESSION_CONFIG
+
+    Returns a onnxruntime.SessionOptions
+    """
+
+    config = deepcopy(DEFAULT_SESSION_CONFIG)
+    if session_config is not None:
+        config.update(session_config)
+
+    so = onnxruntime.SessionOptions()
+    so.intra_op_num_threads = int(config['intra_op_num_threads'])
+    so.inter_op_num_threads = int(config['inter_op_num_threads'])
+    so.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[
+        config['graph_optimization_level']
+    ]
+    so.execution_mode = EXECUTION_MODES[config['execution_mode']]
+
+    tracer = get_tracer()
+    if tracer is not None and tracer.profile_onnx:
+        so.enable_profiling = True
+        so.profile_file_prefix = os.path.join(tracer.profile_dir, 'onnxruntime')
+
+    return so
+
+def load_session_config(config_file: str) -> dict:
+    """Read session settings saved by `save_session_config`"""
+
+    with open(config_file, 'r') as handle:
+        session_config = json.load(handle)
+    return session_config
+
+def save_session_config(session_config: dict, config_file: str):
 
-def load_model(model_file):
+    config_dir = os.path.dirname(config_file)
+    if config_dir and not os.path.isdir(config_dir):
+        os.makedirs(config_dir)
+
+    with open(config_file, 'w') as handle:
+        json.dump(session_config, handle, indent = 4)
+
+@traced
+def tune_session_config(
+    model_file: str,
+    num_runs: Optional[int] = 20,
+) -> dict:
+    """Find the fastest session settings on this machine
+
+    A few thread counts, graph optimization levels and execution modes are
+    benchmarked with single sample predictions on a random input.
+
+    Args:
+        model_file (str): model zip file to benchmark with
+        num_runs (int): number of timed predictions per configuration
+
+    Returns a dict with the fastest session settings
+    """
+
+    with zipfile.ZipFile(model_file, 'r') as zipf:
+        model_bytes = zipf.read('model.onnx')
+        num_probes = len(pd.read_csv(zipf.open('probes.csv'), header = 0))
+
+    rng = np.random.default_rng(0)
+    x = rng.choice(
+        [UNMETHYL_VALUE, NOMEASURE_VALUE, METHYL_VALUE], 
+        size = (1, num_probes),
+    ).astype(np.float32)
+
+    max_threads = os.cpu_count() or 1
+    thread_options = sorted(set([
+        1, 2, max(1, max_threads // 2), max_threads
+    ]))
+    thread_options = [t for t in thread_options if t <= max_threads]
+
+    candidates = list()
+    for threads in thread_options:
+        for graph_level in ['extended', 'all']:
+            candidates.append({
+                'intra_op_num_threads': threads,
+                'inter_op_num_threads': 1,
+                'graph_optimization_level': graph_level,
+                'execution_mode': 'sequential',
+            })
+    candidates.append({
+        'intra_op_num_threads': max_threads,
+        'inter_op_num_threads': max_threads,
+        'graph_optimization_level': 'all',
+        'execution_mode': 'parallel',
+    })
+
+    best_time = np.inf
+    best_config = None
+    for config in candidates:
+        inference_session = onnxruntime.InferenceSession(
+            model_bytes, 
+            providers = ['CPUExecutionProvider'],
+            sess_options = make_session_options(config),
+        )
+        io_binding = IOBinding(inference_session, num_probes)
+
+        times = list()
+        for _ in range(num_runs):
+            st = time.perf_counter()
+            io_binding.run(x)
+            times.append(time.perf_counter() - st)
+        run_time = np.median(times)
+
+        logging.info('Tuning {}: {:.2f} ms per prediction'.format(
+            config, run_time * 1000
+        ))
+        if run_time < best_time:
+            best_time = run_time
+            best_config = config
+
+    logging.info('Fastest session settings: {}'.format(best_config))
+    return best_config
+
+@traced
+def load_model(model_file, session_config: Optional[dict] = None):
 
     with zipfile.ZipFile(model_file, 'r') as zipf:
 
@@ -108,9 +428,7 @@ def load_model(model_file):
             temperatures = None
 
         logging.info("Starting inference session")
-        so = onnxruntime.SessionOptions()
-        so.inter_op_num_threads = 1
-        so.intra_op_num_threads = 1
+        so = make_session_options(session_config)
 
         inference_session = onnxruntime.InferenceSession(
             zipf.read('model.onnx'), 
@@ -118,9 +436,120 @@ def load_model(model_file):
             sess_options = so,
         )
 
+    tracer = get_tracer()
+    if tracer is not None and tracer.profile_onnx:
+        tracer.register_session(inference_session)
+
     return inference_session, probes_df, decoding_dict, temperatures, merge_dict
 
 
+def calibrate_scores(
+    scores: np.ndarray,
+    temperatures: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Temperature scale and softmax the scores of all the heads
+
+    Args:
+        scores (np.ndarray): raw model output with shape 
+            [samples, heads, classes]
+        temperatures (np.ndarray): one temperature per head, if None no
+            temperature scaling is done
+
+    Returns a np.ndarray with the calibrated scores, same shape as scores
+    """
+
+    dtype = scores.dtype
+    if temperatures is not None:
+        scores = scores / temperatures.reshape(1, -1, 1)
+
+    return np.exp(softmax(scores, axis = -1)).astype(dtype)
+
+def class_aggregation_matrix(
+    decoding_dict: dict,
+    merge_dict: Optional[dict] = None,
+) -> Tuple[np.ndarray, List[str]]:
+    """Matrix that maps the model classes to the output classes
+
+    Without merging this only orders the classes as in decoding_dict. With
+    merging, each merged class replaces its classes and is the sum of them,
+    and all the output classes, merged or not, are sorted by name.
+
+    Args:
+        decoding_dict (dict): class number to class name
+        merge_dict (dict): classes to be merged into a new class
+
+    Returns:
+        (np.ndarray, list): matrix with shape [model_classes, output_classes]
+        and the name of each output class
+    """
+
+    class_columns = {v: int(k) for k, v in decoding_dict.items()}
+    num_model_classes = max(class_columns.values()) + 1
+
+    if merge_dict is None:
+        class_names = list(class_columns.keys())
+        merged_classes = {c: [c] for c in class_names}
+    else:
+        merged_classes = dict()
+        for c in class_columns.keys():
+            merged_classes[c] = [c]
+        for k, v in merge_dict.items():
+            for c in v:
+                del merged_classes[c]
+            merged_classes[k] = v
+        class_names = sorted(merged_classes.keys())
+
+    aggregation = np.zeros((num_model_classes, len(class_names)))
+    for i, c in enumerate(class_names):
+        for mc in merged_classes[c]:
+            aggregation[class_columns[mc], i] = 1
+
+    return aggregation, class_names
+
+@traced
+def postprocess_scores(
+    scores: np.ndarray,
+    decoding_dict: dict,
+    temperatures: Optional[np.ndarray],
+    merge_dict: Optional[dict],
+    class_aggregation: Optional[Tuple[np.ndarray, List[str]]] = None,
+) -> Tuple[np.ndarray, List[str]]:
+    """Calibrate, merge and select the best head for a batch of samples
+
+    Args:
+        scores (np.ndarray): raw model output with shape 
+            [samples, heads, classes]
+        decoding_dict (dict): class number to class name
+        temperatures (np.ndarray): one temperature per head
+        merge_dict (dict): classes to be merged into a new class
+        class_aggregation (tuple): output of `class_aggregation_matrix`,
+            computed from decoding_dict and merge_dict if not given
+
+    Returns:
+        (np.ndarray, list): final scores with shape [samples, classes] and
+        the class names for each column
+    """
+
+    if class_aggregation is None:
+        class_aggregation = class_aggregation_matrix(decoding_dict, merge_dict)
+    aggregation, class_names = class_aggregation
+
+    calibrated_scores = calibrate_scores(scores, temperatures)
+
+    # merged classes are added up in double precision, otherwise keep the 
+    # precision of the model output
+    if merge_dict is None:
+        aggregation = aggregation.astype(calibrated_scores.dtype)
+    else:
+        calibrated_scores = calibrated_scores.astype(aggregation.dtype)
+    arr = np.matmul(calibrated_scores, aggregation)
+
+    # the head with the highest score is used for the whole sample
+    best_m = np.argmax(arr.max(-1), axis = -1)
+    final_scores = arr[np.arange(arr.shape[0]), best_m]
+
+    return final_scores, class_names
+
 def predict_sample(
     inference_session: str, 
     bed_file: str,
@@ -128,64 +557,134 @@ def predict_sample(
     probes_df: pd.DataFrame,
     temperatures: np.ndarray,
     merge_dict: dict, 
+    probe_index: Optional[ProbeIndex] = None,
+    io_binding: Optional[IOBinding] = None,
 ):
 
-    requires_merging = False
-    requires_calibration = False
+    prediction_df = predict_samples(
+        inference_session = inference_session,
+        bed_files = [bed_file],
+        decoding_dict = decoding_dict,
+        probes_df = probes_df,
+        temperatures = temperatures,
+        merge_dict = merge_dict,
+        probe_index = probe_index,
+        io_binding = io_binding,
+    )[0]
 
-    if merge_dict is not None:
-        requires_merging = True
+    return prediction_df
 
-    if temperatures is not None:
-        requires_calibration = True
+@traced
+def predict_samples(
+    inference_session: str, 
+    bed_files: List[str],
+    decoding_dict: dict,
+    probes_df: pd.DataFrame,
+    temperatures: np.ndarray,
+    merge_dict: dict, 
+    batch_size: Optional[int] = 32,
+    probe_index: Optional[ProbeIndex] = None,
+    io_binding: Optional[IOBinding] = None,
+) -> List[pd.DataFrame]:
+    """Predict several bed files, running the model on batches of samples
+
+    Args:
+        inference_session (onnxruntime.InferenceSession): loaded model
+        bed_files (list): paths to the bed files to be predicted
+        decoding_dict (dict): class number to class name
+        probes_df (pd.DataFrame): dataframe with the probes information
+        temperatures (np.ndarray): one temperature per head
+        merge_dict (dict): classes to be merged into a new class
+        batch_size (int): number of samples per model call
+        probe_index (ProbeIndex): precompiled index of the model probes, built
+            from probes_df if not given
+        io_binding (IOBinding): persistent buffers of the session, used for
+            single sample batches
+
+    Returns a list with a pd.DataFrame with the scores of each bed file, in the
+    same order as bed_files
+    """
 
-    logging.info("Loading bed file: {}".format(bed_file))
-    x = bed_to_numpy(
-        bed_df = load_bed_file(bed_file), 
-        probes_df = probes_df
+    if probe_index is None:
+        probe_index = ProbeIndex(probes_df['ID_REF'])
+
+    class_aggregation = class_aggregation_matrix(decoding_dict, merge_dict)
+
+    # input buffer reused across batches
+    input_buffer = np.empty(
+        (min(batch_size, len(bed_files)), len(probe_index)), 
+        dtype = np.float32,
     )
-    scores = model_forward(x, inference_session)
 
-    calibrated_scores = np.empty_like(scores)
-    for i in range(scores.shape[0]):
-        if requires_calibration:
-            calibrated_scores[i, :]  = np.exp(softmax(scores[i, :]/temperatures[i]))
-        else:
-            calibrated_scores[i, :]  = np.exp(softmax(scores[i, :]))
+    prediction_dfs = list()
+    for batch_st in range(0, len(bed_files), batch_size):
+
+        batch_files = bed_files[batch_st:batch_st + batch_size]
+        x = input_buffer[:len(batch_files)]
+
+        for i, bed_file in enumerate(batch_files):
+            logging.info("Loading bed file: {}".format(bed_file))
+            bed_to_numpy(
+                bed_df = load_bed_file(bed_file), 
+                probe_index = probe_index,
+                out = x[i],
+            )
+
+        logging.debug("Predicting a batch of {} samples".format(x.shape[0]))
+        scores = model_forward_batch(x, inference_session, io_binding)
+
+        final_scores, class_names = postprocess_scores(
+            scores = scores,
+            decoding_dict = decoding_dict,
+            temperatures = temperatures,
+            merge_dict = merge_dict,
+            class_aggregation = class_aggregation,
+        )
+        number_probes = np.sum(x != NOMEASURE_VALUE, axis = 1)
+
+        for bed_file, n, sample_scores in zip(
+            batch_files, number_probes, final_scores
+        ):
 
-    calibrated_df = dict()
-    for k, v in decoding_dict.items():
-        calibrated_df[v] = calibrated_scores[:, int(k)]
-    calibrated_df = pd.DataFrame(calibrated_df)
+            prediction_dfs.append(
+                scores_to_dataframe(n, sample_scores, class_names)
+            )
 
-    if requires_merging:
-        calibrated_df, decoding_dict = merge_predictions(calibrated_df, decoding_dict, merge_dict)
-        
-    n = np.sum(x != NOMEASURE_VALUE)
+            logging.info("Prediction for: {}".format(bed_file))
+            log_top_scores(sample_scores, class_names)
+
+    return prediction_dfs
+
+def scores_to_dataframe(
+    number_probes: int,
+    scores: np.ndarray,
+    class_names: List[str],
+) -> pd.DataFrame:
+    """Single row dataframe with the number of probes and final scores of a
+    sample
+
+    Args:
+        number_probes (int): number of measured probes
+        scores (np.ndarray): final scores with shape [classes]
+        class_names (list): name of each class
+    """
 
     avg_scores = {
-        'number_probes': [n],
+        'number_probes': [number_probes],
     }
+    for colname, score in zip(class_names, scores):
+        avg_scores[colname] = [score.item()]
 
-    final_scores = list()
-    arr = np.array(calibrated_df[calibrated_df.columns])
-    best_m = np.where(arr == np.max(arr))[0]
-    if len(best_m) > 0:
-        best_m = best_m[0]
-    for colname in calibrated_df.columns:
-        score = np.array(calibrated_df[colname])[best_m].item()
-        avg_scores[colname] = [score]
-        final_scores.append(score)
-    final_scores = np.array(final_scores)
-    
-    prediction_df = pd.DataFrame(avg_scores, index = [0])
+    return pd.DataFrame(avg_scores, index = [0])
+
+def log_top_scores(
+    scores: np.ndarray,
+    class_names: List[str],
+    top: Optional[int] = 3,
+):
 
-    top3 = final_scores.argsort(-1)[::-1][:3]
-    for i, t in enumerate(top3):
+    top_classes = scores.argsort(-1)[::-1][:top]
+    for i, t in enumerate(top_classes):
         logging.info('Top {0}: {1:30s} ({2:4.3f})'.format(
-            i+1, calibrated_df.columns[t], final_scores[t]
+            i+1, class_names[t], scores[t]
         ))
-
-    return prediction_df
-
-            
\ No newline at end of file
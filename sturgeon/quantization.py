@@ -0,0 +1,250 @@
+import os
+import time
+import zipfile
+import logging
+import tempfile
+from typing import Optional, List
+
+import numpy as np
+
+from sturgeon.utils import load_bed_file
+from sturgeon.prediction import (
+    load_model,
+    bed_to_numpy,
+    model_forward_batch,
+    postprocess_scores,
+    class_aggregation_matrix,
+    ProbeIndex,
+)
+
+QUANTIZATION_MODES = ['dynamic', 'static', 'fp16']
+
+
+class BedCalibrationReader():
+    """Feeds bed files as model inputs to the static quantization calibration
+
+    Args:
+        bed_files (list): bed files used as calibration samples
+        probes_df (pd.DataFrame): dataframe with the probes of the model
+        input_name (str): name of the model input
+    """
+
+    def __init__(self, bed_files: List[str], probes_df, input_name: str):
+
+        self.bed_files = bed_files
+        self.probe_index = ProbeIndex(probes_df['ID_REF'])
+        self.input_name = input_name
+        self.rewind()
+
+    def get_next(self) -> Optional[dict]:
+
+        bed_file = next(self._bed_files, None)
+        if bed_file is None:
+            return None
+
+        x = bed_to_numpy(
+            bed_df = load_bed_file(bed_file),
+            probe_index = self.probe_index,
+        )
+        return {self.input_name: x}
+
+    def rewind(self):
+        self._bed_files = iter(self.bed_files)
+
+
+def quantize_onnx(
+    input_file: str,
+    output_file: str,
+    mode: Optional[str] = 'dynamic',
+    calibration_reader: Optional[BedCalibrationReader] = None,
+):
+    """Quantize an onnx model file
+
+    Args:
+        input_file (str): onnx model to be quantized
+        output_file (str): path where to save the quantized onnx model
+        mode (str): 'dynamic' for int8 weights with activations quantized at
+            runtime, 'static' for int8 weights and activations calibrated with
+            calibration_reader, 'fp16' for float16 weights
+        calibration_reader (BedCalibrationReader): calibration samples, only
+            needed for 'static'
+    """
+
+    # onnx and the quantization tools are only needed here
+    try:
+        import onnx
+        from onnxruntime import quantization
+    except ImportError as e:
+        err_msg = '''
+        Quantization requires the onnx package, install it with: pip install onnx
+        ({})
+        '''.format(e)
+        logging.error(err_msg)
+        raise ImportError(err_msg)
+
+    if mode == 'dynamic':
+        quantization.quantize_dynamic(
+            input_file,
+            output_file,
+            weight_type = quantization.QuantType.QInt8,
+        )
+    elif mode == 'static':
+        if calibration_reader is None:
+            err_msg = "Static quantization needs calibration samples"
+            logging.error(err_msg)
+            raise ValueError(err_msg)
+        quantization.quantize_static(
+            input_file,
+            output_file,
+            calibration_reader,
+            quant_format = quantization.QuantFormat.QDQ,
+            activation_type = quantization.QuantType.QInt8,
+            weight_type = quantization.QuantType.QInt8,
+        )
+    elif mode == 'fp16':
+        from onnxruntime.transformers.float16 import convert_float_to_float16
+        model = convert_float_to_float16(
+            onnx.load(input_file),
+            keep_io_types = True,
+        )
+        onnx.save(model, output_file)
+    else:
+        err_msg = '''
+        Unknown quantization mode: {}, available: {}
+        '''.format(mode, QUANTIZATION_MODES)
+        logging.error(err_msg)
+        raise ValueError(err_msg)
+
+def quantize_model_file(
+    model_file: str,
+    output_file: str,
+    mode: Optional[str] = 'dynamic',
+    bed_files: Optional[List[str]] = None,
+):
+    """Make a copy of a model zip file with a quantized model.onnx, all other
+    files in the zip are copied as they are
+
+    Args:
+        model_file (str): model zip file
+        output_file (str): path where to save the quantized model zip file
+        mode (str): quantization mode, one of QUANTIZATION_MODES
+        bed_files (list): calibration samples for static quantization
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        input_onnx = os.path.join(tmp_dir, 'model.onnx')
+        output_onnx = os.path.join(tmp_dir, 'model_quantized.onnx')
+
+        with zipfile.ZipFile(model_file, 'r') as zipf:
+            with open(input_onnx, 'wb') as handle:
+                handle.write(zipf.read('model.onnx'))
+
+        calibration_reader = None
+        if mode == 'static':
+            inference_session, probes_df, _, _, _ = load_model(model_file)
+            calibration_reader = BedCalibrationReader(
+                bed_files = bed_files if bed_files is not None else list(),
+                probes_df = probes_df,
+                input_name = inference_session.get_inputs()[0].name,
+            )
+
+        logging.info("Quantizing ({}): {}".format(mode, model_file))
+        quantize_onnx(
+            input_file = input_onnx,
+            output_file = output_onnx,
+            mode = mode,
+            calibration_reader = calibration_reader,
+        )
+
+        with zipfile.ZipFile(model_file, 'r') as zipf_in:
+            with zipfile.ZipFile(
+                output_file, 'w', compression = zipfile.ZIP_DEFLATED
+            ) as zipf_out:
+                for item in zipf_in.infolist():
+                    if item.filename == 'model.onnx':
+                        zipf_out.write(output_onnx, 'model.onnx')
+                    else:
+                        zipf_out.writestr(item, zipf_in.read(item.filename))
+
+    logging.info("Saved quantized model: {}".format(output_file))
+
+def compare_model_files(
+    original_file: str,
+    quantized_file: str,
+    bed_files: List[str],
+) -> dict:
+    """Compare the calibrated scores and speed of a quantized model against
+    the original model
+
+    Each bed file is predicted on its own, as in live prediction, so the
+    timings are the latency of a single sample.
+
+    Args:
+        original_file (str): original model zip file
+        quantized_file (str): quantized model zip file
+        bed_files (list): samples to be compared
+
+    Returns a dict with the number of samples, the fraction of samples with
+    the same top class, the maximum absolute score difference, the average
+    inference time of each model and the speed up
+    """
+
+    models = [load_model(original_file), load_model(quantized_file)]
+    probe_index = ProbeIndex(models[0][1]['ID_REF'])
+    aggregations = [
+        class_aggregation_matrix(model[2], model[4]) for model in models
+    ]
+
+    # the first run of a session is slower, keep it out of the timings
+    for model in models:
+        model_forward_batch(
+            np.zeros((1, len(probe_index)), dtype = np.float32), model[0]
+        )
+
+    timings = [0.0, 0.0]
+    final_scores = [list(), list()]
+    for bed_file in bed_files:
+
+        logging.debug("Comparing on: {}".format(bed_file))
+        x = bed_to_numpy(
+            bed_df = load_bed_file(bed_file),
+            probe_index = probe_index,
+        )
+
+        for i, model in enumerate(models):
+            inference_session, _, decoding_dict, temperatures, merge_dict = model
+
+            st = time.perf_counter()
+            scores = model_forward_batch(x, inference_session)
+            timings[i] += time.perf_counter() - st
+
+            scores, _ = postprocess_scores(
+                scores = scores,
+                decoding_dict = decoding_dict,
+                temperatures = temperatures,
+                merge_dict = merge_dict,
+                class_aggregation = aggregations[i],
+            )
+            final_scores[i].append(scores[0])
+
+    original_scores = np.stack(final_scores[0]).astype(np.float64)
+    quantized_scores = np.stack(final_scores[1]).astype(np.float64)
+
+    num_samples = len(bed_files)
+    report = {
+        'samples': num_samples,
+        'top_class_agreement': float(np.mean(
+            original_scores.argmax(-1) == quantized_scores.argmax(-1)
+        )),
+        'max_score_deviation': float(np.abs(
+            original_scores - quantized_scores
+        ).max()),
+        'original_time_ms': 1000 * timings[0] / num_samples,
+        'quantized_time_ms': 1000 * timings[1] / num_samples,
+        'speed_up': timings[0] / timings[1],
+        'original_size_mb': os.path.getsize(original_file) / 1e6,
+        'quantized_size_mb': os.path.getsize(quantized_file) / 1e6,
+    }
+
+    return report
@@ -0,0 +1,482 @@
+import os
+import json
+import zipfile
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Optional, List
+
+import numpy as np
+import pandas as pd
+
+from sturgeon.utils import validate_model_file, get_model_path, load_bed_file
+from sturgeon.prediction import (
+    load_model, 
+    bed_to_numpy,
+    model_forward_batch,
+    class_aggregation_matrix,
+    postprocess_scores,
+    ProbeIndex, 
+    IOBinding,
+    load_session_config,
+    save_session_config,
+    tune_session_config,
+    scores_to_dataframe,
+    log_top_scores,
+)
+from sturgeon.constants import SESSION_CONFIG_FILE, NOMEASURE_VALUE
+from sturgeon.tracing import traced
+
+
+class ModelBundle():
+    """Everything that is needed to predict with a model, loaded once
+
+    Args:
+        model_file (str): path to the model zip file
+        key (tuple): (size, mtime) of the zip file when it was loaded
+        session_config (dict): onnxruntime session settings
+    """
+
+    @traced
+    def __init__(
+        self, 
+        model_file: str, 
+        key: tuple, 
+        session_config: Optional[dict] = None,
+    ):
+
+        self.model_file = model_file
+        self.name = Path(model_file).stem
+        self.key = key
+
+        (
+            self.inference_session,
+            self.probes_df,
+            self.decoding_dict,
+            self.temperatures,
+            self.merge_dict,
+        ) = load_model(model_file, session_config)
+
+        with zipfile.ZipFile(model_file, 'r') as zipf:
+            logging.debug("Loading colors dict")
+            try:
+                self.color_dict = json.load(zipf.open('colors.json'))
+            except KeyError:
+                logging.debug("No colors dict in zip file")
+                self.color_dict = None
+
+        self.checksum = file_checksum(model_file)
+
+        self.probe_index = ProbeIndex(self.probes_df['ID_REF'])
+        # the first inference happens here, which also warms up the session
+        self.io_binding = IOBinding(
+            self.inference_session, len(self.probe_index)
+        )
+        self.input_buffer = self.io_binding.input_buffer
+        # columns of this model in the registry union probe index
+        self.union_columns = None
+
+        self.class_aggregation = class_aggregation_matrix(
+            self.decoding_dict, self.merge_dict
+        )
+        self.class_names = self.class_aggregation[1]
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        """Predict samples already converted to the model input
+
+        Args:
+            x (np.ndarray): input with shape [samples, number_probes]
+
+        Returns a np.ndarray with the final scores with shape [samples, 
+        classes], classes are in the order of `class_names`
+        """
+
+        scores = model_forward_batch(x, self.inference_session, self.io_binding)
+        final_scores, _ = postprocess_scores(
+            scores = scores,
+            decoding_dict = self.decoding_dict,
+            temperatures = self.temperatures,
+            merge_dict = self.merge_dict,
+            class_aggregation = self.class_aggregation,
+        )
+        return final_scores
+
+    def input_from_union(self, x_union: np.ndarray) -> np.ndarray:
+        """Gather the model input from a sample encoded on the union index
+
+        Args:
+            x_union (np.ndarray): sample with shape [union_probes]
+
+        Returns a np.ndarray with shape [1, number_probes], this is the bundle
+        input buffer, it will be overwritten by the next call
+        """
+
+        np.take(x_union, self.union_columns, out = self.input_buffer[0])
+        return self.input_buffer
+
+
+class ModelRegistry():
+    """Keeps loaded models in memory and hands them out on request
+
+    Models are identified by their path, and reloaded if the zip file changes
+    on disk. When more than max_models are loaded the least recently used one
+    is dropped.
+
+    The registry also keeps a union index of the probes of all the models it 
+    has loaded, so that a sample can be encoded once and then gathered into
+    the input of each model.
+
+    Args:
+        max_models (int): maximum number of models kept in memory
+        session_config (dict): onnxruntime session settings for all models
+    """
+
+    def __init__(
+        self, 
+        max_models: Optional[int] = 8,
+        session_config: Optional[dict] = None,
+    ):
+
+        self.max_models = max_models
+        self.session_config = session_config
+        self._bundles = OrderedDict()
+        self._lock = threading.RLock()
+        self.probe_index = ProbeIndex()
+
+    def get(self, model: str) -> Optional[ModelBundle]:
+        """Get a loaded model
+
+        Args:
+            model (str): path to a model zip file or name of a built-in model
+
+        Returns a ModelBundle, or None if the model did not pass validation
+        """
+
+        model_file = os.path.abspath(get_model_path(model))
+        key = file_key(model_file)
+
+        with self._lock:
+
+            bundle = self._bundles.get(model_file)
+            if bundle is not None:
+                if bundle.key == key:
+                    self._bundles.move_to_end(model_file)
+                    return bundle
+                logging.info(
+                    "Model file changed on disk, reloading: {}".format(model_file)
+                )
+                del self._bundles[model_file]
+
+            logging.info("Validating model: {}".format(model_file))
+            if validate_model_file(model_file):
+                logging.info("Successful model validation")
+            else:
+                logging.error("Model did no pass validation, it will be skipped")
+                return None
+
+            bundle = ModelBundle(model_file, key, self.session_config)
+            bundle.union_columns = self.probe_index.add(
+                bundle.probe_index.probe_ids
+            )
+
+            self._bundles[model_file] = bundle
+            while len(self._bundles) > self.max_models:
+                evicted_file, _ = self._bundles.popitem(last = False)
+                logging.debug("Unloading model: {}".format(evicted_file))
+
+        return bundle
+
+    def set_session_config(self, session_config: Optional[dict]):
+        """Change the session settings, loaded models are dropped so that they
+        are reloaded with the new settings
+        """
+
+        with self._lock:
+            if session_config != self.session_config:
+                self.session_config = session_config
+                self._bundles.clear()
+
+    def clear(self):
+
+        with self._lock:
+            self._bundles.clear()
+
+
+class PredictionMemo():
+    """Remembers predictions so that unchanged inputs are not predicted again
+
+    Predictions are keyed by the checksum of the model and a hash of its input,
+    an identical input returns the stored result without running the model.
+    Optionally, if fewer than max_changed_probes probes changed since the last
+    prediction of a model, that prediction is reused as well.
+
+    Args:
+        max_entries (int): maximum number of predictions remembered
+        max_changed_probes (int): reuse the last prediction of a model if fewer
+            probes than this changed, 0 only reuses identical inputs
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = 64,
+        max_changed_probes: Optional[int] = 0,
+    ):
+
+        self.max_entries = max_entries
+        self.max_changed_probes = max_changed_probes
+        self._results = OrderedDict()
+        self._last = dict()
+        self._lock = threading.Lock()
+
+    def get(self, bundle: ModelBundle, x: np.ndarray) -> Optional[tuple]:
+        """Get a remembered prediction for this input
+
+        Returns a tuple with the number of measured probes and the final 
+        scores, or None if the model has to be run
+        """
+
+        key = (bundle.checksum, input_digest(x))
+        with self._lock:
+
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                logging.info(
+                    "Input unchanged, reusing prediction of: {}".format(bundle.name)
+                )
+                return result
+
+            last = self._last.get(bundle.checksum)
+            if self.max_changed_probes > 0 and last is not None:
+                last_x, result = last
+                if last_x.shape == x.shape:
+                    changed = np.count_nonzero(last_x != x)
+                    if changed < self.max_changed_probes:
+                        logging.info(
+                            "Only {} probes changed, reusing prediction of: {}".format(
+                                changed, bundle.name
+                            )
+                        )
+                        return np.sum(x != NOMEASURE_VALUE, axis = 1), result[1]
+
+        return None
+
+    def put(self, bundle: ModelBundle, x: np.ndarray, result: tuple):
+        """Remember the prediction of an input"""
+
+        key = (bundle.checksum, input_digest(x))
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last = False)
+            if self.max_changed_probes > 0:
+                self._last[bundle.checksum] = (x.copy(), result)
+
+    def clear(self):
+
+        with self._lock:
+            self._results.clear()
+            self._last.clear()
+
+
+def file_key(path: str) -> tuple:
+    """Cheap identity of a file to detect changes on disk"""
+
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def file_checksum(path: str, chunk_size: Optional[int] = 1 << 20) -> str:
+    """sha1 of the contents of a file"""
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def input_digest(x: np.ndarray) -> bytes:
+    """Hash of a model input"""
+
+    return hashlib.blake2b(
+        np.ascontiguousarray(x).view(np.uint8), digest_size = 16
+    ).digest()
+
+
+_model_registry = None
+
+def get_model_registry() -> ModelRegistry:
+    """Process-wide model registry"""
+
+    global _model_registry
+    if _model_registry is None:
+        _model_registry = ModelRegistry()
+    return _model_registry
+
+def configure_sessions(
+    model_files: List[str],
+    session_config: Optional[dict] = None,
+    tune: Optional[bool] = False,
+    session_config_file: Optional[str] = SESSION_CONFIG_FILE,
+) -> dict:
+    """Set the onnxruntime session settings of the process-wide registry
+
+    Settings previously saved in session_config_file are used as a base, and
+    the given session_config values override them. If tune is set the fastest
+    settings for this machine are searched with the first model and saved to
+    session_config_file.
+
+    Args:
+        model_files (list): models that will be used
+        session_config (dict): explicitly requested settings
+        tune (bool): whether to benchmark and save the fastest settings
+        session_config_file (str): where tuned settings are saved
+
+    Returns a dict with the settings in use
+    """
+
+    config = dict()
+    if tune:
+        model_file = get_model_path(model_files[0])
+        logging.info("Tuning session settings with: {}".format(model_file))
+        config = tune_session_config(model_file)
+        save_session_config(config, session_config_file)
+        logging.info("Saved session settings to: {}".format(session_config_file))
+    elif session_config_file is not None and os.path.isfile(session_config_file):
+        logging.info("Loading session settings: {}".format(session_config_file))
+        config = load_session_config(session_config_file)
+
+    if session_config is not None:
+        config.update(session_config)
+
+    logging.info("Session settings: {}".format(config))
+    get_model_registry().set_session_config(config)
+
+    return config
+
+@traced
+def predict_bundles(
+    x_union: np.ndarray,
+    bundles: List[ModelBundle],
+    executor: Optional[Executor] = None,
+    memo: Optional[PredictionMemo] = None,
+) -> List[tuple]:
+    """Predict the same samples with several models
+
+    The samples are encoded once on the registry union probe index, the input
+    of each model is gathered from it. If an executor is given the models run
+    at the same time, onnxruntime releases the GIL during inference.
+
+    Args:
+        x_union (np.ndarray): samples with shape [samples, union_probes]
+        bundles (list): loaded models, from the process-wide registry
+        executor (concurrent.futures.Executor): thread pool to run the models
+        memo (PredictionMemo): remembered predictions, models are not run for
+            inputs that it already knows
+
+    Returns a list with, for each bundle, a tuple with the number of measured
+    probes [samples], the final scores [samples, classes] and whether the 
+    prediction was reused from the memo
+    """
+
+    def predict_bundle(bundle):
+        x = np.take(x_union, bundle.union_columns, axis = 1)
+        if memo is not None:
+            result = memo.get(bundle, x)
+            if result is not None:
+                return result + (True, )
+        result = (np.sum(x != NOMEASURE_VALUE, axis = 1), bundle.predict(x))
+        if memo is not None:
+            memo.put(bundle, x, result)
+        return result + (False, )
+
+    if executor is None:
+        return [predict_bundle(bundle) for bundle in bundles]
+    return list(executor.map(predict_bundle, bundles))
+
+@traced
+def predict_sample_bundles(
+    bed_file: Optional[str],
+    bundles: List[ModelBundle],
+    executor: Optional[Executor] = None,
+    memo: Optional[PredictionMemo] = None,
+    bed_df: Optional[pd.DataFrame] = None,
+) -> List[pd.DataFrame]:
+    """Predict a bed file with several models, the bed file is read and 
+    encoded only once
+
+    Args:
+        bed_file (str): path to the bed file to be predicted
+        bundles (list): loaded models, from the process-wide registry
+        executor (concurrent.futures.Executor): thread pool to run the models
+        memo (PredictionMemo): remembered predictions, if it reuses predictions
+            of changed inputs the dataframes get a `reused` column
+        bed_df (pd.DataFrame): contents of the bed file, if given the bed 
+            file is not read. A `probe_idx` column is taken as the positions
+            in the registry probe index.
+
+    Returns a list with a pd.DataFrame with the scores of each model, in the
+    same order as bundles
+    """
+
+    if bed_df is None:
+        logging.info("Loading bed file: {}".format(bed_file))
+        bed_df = load_bed_file(bed_file)
+
+    x_union = bed_to_numpy(
+        bed_df = bed_df,
+        probe_index = get_model_registry().probe_index,
+    )
+
+    prediction_dfs = list()
+    results = predict_bundles(x_union, bundles, executor, memo)
+    for bundle, (number_probes, final_scores, reused) in zip(bundles, results):
+        logging.info("Prediction of model: {}".format(bundle.name))
+        log_top_scores(final_scores[0], bundle.class_names)
+        prediction_df = scores_to_dataframe(
+            number_probes[0], final_scores[0], bundle.class_names
+        )
+        if memo is not None and memo.max_changed_probes > 0:
+            prediction_df['reused'] = reused
+        prediction_dfs.append(prediction_df)
+
+    return prediction_dfs
+
+@traced
+def predict_samples_bundles(
+    bed_dfs: List[pd.DataFrame],
+    bundles: List[ModelBundle],
+    executor: Optional[Executor] = None,
+) -> List[pd.DataFrame]:
+    """Predict several samples at once with several models, as a batch
+
+    Args:
+        bed_dfs (list): contents of the bed file of each sample, a 
+            `probe_idx` column is taken as the positions in the registry 
+            probe index
+        bundles (list): loaded models, from the process-wide registry
+        executor (concurrent.futures.Executor): thread pool to run the models
+
+    Returns a list with a pd.DataFrame with the scores of each model, a row
+    for each sample, in the same order as bundles
+    """
+
+    probe_index = get_model_registry().probe_index
+    x_union = np.empty((len(bed_dfs), len(probe_index)), dtype = np.float32)
+    for i, bed_df in enumerate(bed_dfs):
+        bed_to_numpy(bed_df = bed_df, probe_index = probe_index, out = x_union[i])
+
+    prediction_dfs = list()
+    results = predict_bundles(x_union, bundles, executor)
+    for bundle, (number_probes, final_scores, _) in zip(bundles, results):
+        prediction_dfs.append(pd.concat(
+            [
+                scores_to_dataframe(n, scores, bundle.class_names)
+                for n, scores in zip(number_probes, final_scores)
+            ],
+            ignore_index = True,
+        ))
+
+    return prediction_dfs
@@ -0,0 +1,213 @@
+"""
+Lightweight tracing of the pipeline stages
+
+Spans record wall time, cpu time and the peak memory of the process, and are
+exported in the Chrome trace format, which can be opened in chrome://tracing
+or https://ui.perfetto.dev. Tracing is off unless `enable_tracing` is called,
+then spans cost a single check.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is not recorded
+    resource = None
+
+_tracer = None
+_null_span = nullcontext()
+
+
+class Tracer():
+    """Collects the spans of the process
+
+    Args:
+        trace_file (str): json file where the trace is saved
+        profile_onnx (bool): whether to also include the onnxruntime profiler
+            events of the inference sessions
+    """
+
+    def __init__(self, trace_file: str, profile_onnx: Optional[bool] = False):
+
+        self.trace_file = trace_file
+        self.profile_onnx = profile_onnx
+        self.start_time = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = list()
+        self.sessions = list()
+        self.last_save = time.monotonic()
+        self._lock = threading.Lock()
+        if profile_onnx:
+            self.profile_dir = tempfile.mkdtemp(prefix = 'sturgeon_onnx_profile_')
+
+    def timestamp(self) -> float:
+        """Microseconds since the tracer started"""
+
+        return (time.perf_counter() - self.start_time) * 1e6
+
+    @contextmanager
+    def span(self, name: str, category: Optional[str] = 'sturgeon', **args):
+
+        st = self.timestamp()
+        cpu_st = time.process_time()
+        try:
+            yield
+        finally:
+            nd = self.timestamp()
+            args['cpu_time_ms'] = round((time.process_time() - cpu_st) * 1e3, 3)
+            if resource is not None:
+                args['peak_rss_mb'] = round(peak_rss_mb(), 1)
+            self.add_event({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': st,
+                'dur': nd - st,
+                'pid': self.pid,
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    def add_event(self, event: dict):
+
+        with self._lock:
+            self.events.append(event)
+
+    def register_session(self, inference_session):
+        """Keep a session to collect its onnxruntime profile when saving"""
+
+        with self._lock:
+            self.sessions.append((inference_session, self.timestamp()))
+
+    def onnx_events(self) -> list:
+        """Stop the onnxruntime profiling of the registered sessions and get
+        their events, shifted to the time of the tracer
+        """
+
+        events = list()
+        with self._lock:
+            sessions, self.sessions = self.sessions, list()
+
+        for inference_session, session_ts in sessions:
+            try:
+                profile_file = inference_session.end_profiling()
+                with open(profile_file, 'r') as handle:
+                    session_events = json.load(handle)
+            except (OSError, ValueError) as e:
+                logging.debug("Could not read onnxruntime profile: {}".format(e))
+                continue
+
+            for event in session_events:
+                event['ts'] = event.get('ts', 0) + session_ts
+                event['pid'] = 'onnxruntime'
+                events.append(event)
+
+        return events
+
+    def save(self, include_onnx: Optional[bool] = True):
+        """Save the trace
+
+        Args:
+            include_onnx (bool): whether to collect the onnxruntime profiles,
+                this stops the profiling of the sessions, so it should only
+                be done at the end
+        """
+
+        with self._lock:
+            events = list(self.events)
+        if self.profile_onnx and include_onnx:
+            onnx_events = self.onnx_events()
+            with self._lock:
+                self.events.extend(onnx_events)
+            events.extend(onnx_events)
+
+        trace = {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'command': ' '.join(sys.argv),
+            },
+        }
+
+        tmp_file = self.trace_file + '.tmp'
+        with open(tmp_file, 'w') as handle:
+            json.dump(trace, handle)
+        os.replace(tmp_file, self.trace_file)
+        self.last_save = time.monotonic()
+        logging.debug("Saved trace to: {}".format(self.trace_file))
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of the process in MB"""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    if sys.platform == 'darwin':
+        return peak / 1e6
+    return peak / 1e3
+
+def enable_tracing(trace_file: str, profile_onnx: Optional[bool] = False):
+    """Start recording spans, these are saved to trace_file by `save_trace`"""
+
+    global _tracer
+    _tracer = Tracer(trace_file, profile_onnx)
+    logging.info("Tracing to: {}".format(trace_file))
+
+def get_tracer() -> Optional[Tracer]:
+
+    return _tracer
+
+def trace_span(name: str, category: Optional[str] = 'sturgeon', **args):
+    """Context manager that records a span if tracing is enabled
+
+    Args:
+        name (str): name of the span
+        category (str): category of the span, used to filter in the viewer
+        **args: extra information shown with the span
+    """
+
+    if _tracer is None:
+        return _null_span
+    return _tracer.span(name, category, **args)
+
+def traced(func):
+    """Decorator that records a span for each call if tracing is enabled"""
+
+    name = func.__qualname__
+    category = func.__module__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return func(*args, **kwargs)
+        with _tracer.span(name, category):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+def save_trace(
+    include_onnx: Optional[bool] = True, 
+    interval: Optional[float] = None,
+):
+    """Save the trace recorded so far, does nothing if tracing is disabled
+
+    Args:
+        include_onnx (bool): see `Tracer.save`
+        interval (float): only save if this many seconds passed since the
+            last save, the whole trace is written each time
+    """
+
+    if _tracer is None:
+        return
+    if interval is not None and time.monotonic() - _tracer.last_save < interval:
+        return
+    _tracer.save(include_onnx)
@@ -1,16 +1,15 @@
 import zipfile
 import logging
 import os
-from pathlib import Path
 import platform
-
-import pandas as pd
-import numpy as np
+from contextlib import contextmanager
 
 from sturgeon.constants import (
     UNMETHYL_VALUE,
     NOMEASURE_VALUE,
 )
+from sturgeon.catalog import get_available_models, get_model_path
+from sturgeon.tracing import traced
 
 def validate_model_file(zip_file: str):
     """Validate the contents of a zip file
@@ -56,6 +55,7 @@ def validate_model_file(zip_file: str):
 
     return True
 
+@traced
 def load_bed_file(bed_file: str):
     """Read the contents of a bed file
 
@@ -65,6 +65,8 @@ def load_bed_file(bed_file: str):
     Returns a pandas.DataFrame with the contents of the bed file
     """
 
+    import pandas as pd
+
     bed_df =  pd.read_csv(
         bed_file, 
         header = 0, 
@@ -73,8 +75,11 @@ def load_bed_file(bed_file: str):
     )
     return bed_df
 
+@traced
 def read_probes_file(probes_file: str):
 
+    import pandas as pd
+
     samtools_bed_file = False
     with open(probes_file, 'r') as handle:
         for line in handle:
@@ -172,7 +177,34 @@ def validate_modkit_file(modkit_file):
 
     return True, None
 
-def validate_bed_file(bed_df: pd.DataFrame, probes_df: pd.DataFrame):
+# empty bgzf block that ends a complete bam file
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000'
+)
+
+def validate_bam_file(bam_file):
+    """Check that a bam file is complete, that it was not caught while it
+    is still being written, by looking for the bgzf end of file block.
+
+    Args:
+        bam_file (str): path to the file to be validated
+
+    Returns:
+        (bool, str): True, None if it passes the validation; False, error message
+        if it failes.
+    """
+
+    if os.path.getsize(bam_file) < len(BGZF_EOF):
+        return False, "bam file is empty or incomplete"
+
+    with open(bam_file, 'rb') as f:
+        f.seek(-len(BGZF_EOF), os.SEEK_END)
+        if f.read() != BGZF_EOF:
+            return False, "end of file block missing in bam file"
+
+    return True, None
+
+def validate_bed_file(bed_df: 'pd.DataFrame', probes_df: 'pd.DataFrame'):
     """Validate the contents of a bed file
 
     Args:
@@ -183,6 +215,8 @@ def validate_bed_file(bed_df: pd.DataFrame, probes_df: pd.DataFrame):
     non-critical components are missing.
     """
 
+    import numpy as np
+
     mandatory_columns = ["methylation_call", "probe_id"]
     for mc in mandatory_columns:
         err_msg = "{} column missing in bed file".format(mc)
@@ -201,35 +235,6 @@ def validate_bed_file(bed_df: pd.DataFrame, probes_df: pd.DataFrame):
 
     return True
 
-def get_available_models(print_str = False):
-
-    model_dir = os.path.join(os.path.dirname(__file__), 'include/models')
-
-    available_models = list()
-    for model in os.listdir(model_dir):
-        if not model.endswith('.zip'):
-            continue
-        available_models.append(Path(model).stem)
-    
-    if print_str:
-        available_models = "\n"+"\n".join(available_models)
-
-    return available_models
-
-def get_model_path(model_name):
-
-    if os.path.isfile(model_name):
-        return model_name
-
-    model_dir = os.path.join(os.path.dirname(__file__), 'include/models')
-    if model_name not in get_available_models():
-        err_msg = """
-        The following model could not be found in {}
-        """.format(model_dir)
-        raise ValueError(err_msg)
-
-    return os.path.join(model_dir, model_name + '.zip')
-
 def creation_date(path_to_file):
     """
     Try to get the date that a file was created, falling back to when it was
@@ -247,40 +252,34 @@ def creation_date(path_to_file):
             # so we'll settle for when its content was last modified.
             return stat.st_mtime
 
-def softmax(x):
-    c = x.max()
-    logsumexp = np.log(np.exp(x - c).sum())
-    return x - c - logsumexp
-
-def merge_predictions(prediction_df, decoding_dict, merge_dict):
+@contextmanager
+def atomic_write(path: str, mode: str = 'w'):
+    """Open a file to be written as a whole, or not at all
 
-    old_class_columns = list(decoding_dict.values())
-    non_class_columns = np.array(prediction_df.columns[~np.isin(prediction_df.columns, old_class_columns)])
-   
-    rev_merge_dict = dict()
-    for k, v in merge_dict.items():
-        for c in v:
-            rev_merge_dict[c] = k
-    for v in decoding_dict.values():
-        try:
-            rev_merge_dict[v]
-        except KeyError:
-            rev_merge_dict[v] = v
-    
-    for k, v in merge_dict.items():
-        prediction_df[k] = 0
-        for c in v:
-            prediction_df[k] += prediction_df[c]
-            prediction_df = prediction_df.drop(c, axis=1)
+    The contents are written to a temporary file next to it, flushed to disk
+    and then renamed over the file, so a crash never leaves it half written.
 
-    new_class_columns = np.array(prediction_df.columns[~np.isin(prediction_df.columns, non_class_columns)])
+    Args:
+        path (str): file to be written
+        mode (str): 'w' for text or 'wb' for binary contents
+    """
 
-    new_class_columns = np.sort(new_class_columns)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, mode) as handle:
+            yield handle
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-    new_decoding_dict = dict()
-    for i, c in enumerate(new_class_columns):
-        new_decoding_dict[i] = c
+def softmax(x, axis = -1):
 
-    final_column_order = non_class_columns.tolist() + new_class_columns.tolist()
+    import numpy as np
 
-    return prediction_df[final_column_order], new_decoding_dict
\ No newline at end of file
+    c = x.max(axis = axis, keepdims = True)
+    logsumexp = np.log(np.exp(x - c).sum(axis = axis, keepdims = True))
+    return x - c - logsumexp
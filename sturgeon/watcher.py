@@ -0,0 +1,247 @@
+"""
+Discovery of the files written into the input folder of a live run
+
+On linux the folder is watched with inotify, new files are picked up as
+soon as they are closed after writing or moved into the folder. Otherwise
+the folder is listed at an interval that shortens while files keep coming
+and grows up to the cooldown while none do.
+"""
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import logging
+import ctypes
+import ctypes.util
+from typing import Optional, Callable, List, Tuple
+
+from sturgeon.utils import creation_date
+
+# inotify events, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+# wd, mask, cookie and length of the name of each inotify event
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# shortest interval in between listing the folder, in seconds
+MIN_POLL_INTERVAL = 0.5
+
+
+class Inotify():
+    """Minimal inotify watch of a single folder, through the libc functions
+
+    Args:
+        path (str): folder to be watched
+        mask (int): events to be watched
+
+    Raises OSError if inotify is not available
+    """
+
+    def __init__(self, path: str, mask: int):
+
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on linux')
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e))
+
+    def read(self, timeout: float) -> Optional[List[str]]:
+        """Wait up to timeout seconds for events
+
+        Returns the names of the files of the events, None if events were
+        lost and the folder has to be listed again
+        """
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return list()
+
+        names = list()
+        overflow = False
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                name = buffer[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif name:
+                    names.append(os.fsdecode(name))
+
+        if overflow:
+            return None
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher():
+    """New files with a suffix in a folder, in the order they were written
+
+    Each file is stat'ed and validated once, when it is first seen. Files
+    stay pending until they are marked as done, so a file that could not be
+    processed yet is given again on the next call of `pending_files`.
+
+    Args:
+        input_path (str): folder to be watched
+        suffix (str): only files with this suffix are considered
+        cooldown (float): longest time in seconds in between looking for new
+            files
+        validate (callable): called with the path of each new file, returns
+            (bool, str) as `validate_megalodon_file`. Files that do not pass
+            are validated again only once they change.
+        use_inotify (bool): watch the folder with inotify if available,
+            otherwise list the folder at an adaptive interval
+    """
+
+    def __init__(
+        self,
+        input_path: str,
+        suffix: str,
+        cooldown: float,
+        validate: Optional[Callable] = None,
+        use_inotify: Optional[bool] = True,
+    ):
+
+        self.input_path = input_path
+        self.suffix = suffix
+        self.cooldown = cooldown
+        self.validate = validate
+        self.interval = min(MIN_POLL_INTERVAL, cooldown)
+
+        # creation time of files waiting to be processed
+        self.pending = dict()
+        self.done = set()
+        # (size, modification time) of files that did not pass validation
+        self.invalid = dict()
+        self.discovered = 0
+
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify(input_path, IN_CLOSE_WRITE | IN_MOVED_TO)
+            except (OSError, AttributeError, TypeError) as e:
+                logging.info('Inotify not available: {}'.format(e))
+
+        if self.inotify is not None:
+            logging.info('Watching for new files with inotify')
+        else:
+            logging.info(
+                'Looking for new files every {} to {} seconds'.format(
+                    self.interval, cooldown
+                )
+            )
+
+        self.scan()
+
+    def check(self, name: str) -> bool:
+        """Stat and validate a file seen for the first time, returns whether
+        it is a new pending file
+        """
+
+        if not name.endswith(self.suffix):
+            return False
+        path = os.path.join(self.input_path, name)
+        if path in self.done or path in self.pending:
+            return False
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+
+        if self.validate is not None:
+            if self.invalid.get(path) == (stat.st_size, stat.st_mtime_ns):
+                return False
+            success, msg = self.validate(path)
+            if not success:
+                logging.info(
+                    '''
+                    File {}, did not pass validation. Reason: {}.
+                    '''.format(path, msg)
+                )
+                self.invalid[path] = (stat.st_size, stat.st_mtime_ns)
+                return False
+            self.invalid.pop(path, None)
+
+        self.pending[path] = creation_date(path)
+        self.discovered += 1
+        return True
+
+    def scan(self) -> int:
+        """List the folder, only files not seen before are checked"""
+
+        found = 0
+        with os.scandir(self.input_path) as entries:
+            for entry in entries:
+                if self.check(entry.name):
+                    found += 1
+        return found
+
+    def pending_files(self) -> List[Tuple[str, float]]:
+        """Files waiting to be processed and their creation time, oldest
+        first
+        """
+
+        return sorted(self.pending.items(), key = lambda x: x[1])
+
+    def mark_done(self, path: str):
+        """Do not give this file again"""
+
+        self.pending.pop(path, None)
+        self.done.add(path)
+
+    def wait(self):
+        """Wait for new files, up to the cooldown with inotify and for the
+        current polling interval otherwise
+        """
+
+        if self.inotify is not None:
+            names = self.inotify.read(self.cooldown)
+            if names is None:
+                logging.warning('Inotify events lost, listing the input folder')
+                self.scan()
+                return
+            for name in names:
+                self.check(name)
+            # files that failed validation or could not be processed yet
+            # are looked at again once the cooldown passed
+            if len(names) == 0:
+                self.scan()
+            return
+
+        time.sleep(self.interval)
+        if self.scan() > 0:
+            self.interval = min(MIN_POLL_INTERVAL, self.cooldown)
+        else:
+            self.interval = min(self.interval * 2, self.cooldown)
+
+    def close(self):
+
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+pytest.importorskip('onnxruntime')
+
+from sturgeon.benchmark import run_benchmarks, compare_benchmarks, BENCH_MODEL
+from sturgeon.cli.bench import bench
+
+STAGES = {
+    'cli_startup',
+    'load_bed_file',
+    'bed_to_numpy',
+    'model_forward',
+    'postprocess_scores',
+    'map_methyl_calls_to_probes_chr',
+    'merge_probes_methyl_calls',
+    'probes_methyl_calls_to_bed',
+}
+STATS = {'min', 'max', 'mean', 'median', 'stddev', 'rounds'}
+
+
+@pytest.fixture(scope = 'module')
+def results():
+    """Each benchmark run once on the bundled benchmark model"""
+
+    return run_benchmarks(
+        model_files = [BENCH_MODEL],
+        coverages = (0.05, 1.0),
+        num_probes = 500,
+        rounds = 1,
+        plot = False,
+    )
+
+
+def test_run_benchmarks_schema(results):
+
+    # results are saved as json
+    results = json.loads(json.dumps(results))
+
+    assert set(results) == {
+        'sturgeon_version', 'datetime', 'machine', 'settings', 'benchmarks',
+    }
+    assert results['settings']['model_files'] == [BENCH_MODEL]
+    assert results['settings']['rounds'] == 1
+
+    names = [b['name'] for b in results['benchmarks']]
+    assert len(names) == len(set(names))
+    assert {b['stage'] for b in results['benchmarks']} == STAGES
+
+    for b in results['benchmarks']:
+        assert set(b) == {'name', 'stage', 'params', 'stats'}
+        assert set(b['stats']) == STATS
+        assert b['stats']['rounds'] == 1
+        assert 0 <= b['stats']['min'] <= b['stats']['median'] <= b['stats']['max']
+
+
+def test_compare_benchmarks(results):
+
+    comparison = compare_benchmarks(results, results, threshold = 0.1)
+    assert len(comparison) == len(results['benchmarks'])
+    assert not any(c['regression'] for c in comparison)
+
+    slower = json.loads(json.dumps(results))
+    slower['benchmarks'][0]['stats']['median'] *= 2
+    comparison = compare_benchmarks(results, slower, threshold = 0.1)
+    regressions = [c['name'] for c in comparison if c['regression']]
+    assert regressions == [results['benchmarks'][0]['name']]
+
+
+def test_bench_compare_output(results, tmp_path, capsys):
+
+    baseline_file = tmp_path / 'baseline.json'
+    baseline_file.write_text(json.dumps(results))
+    slower = json.loads(json.dumps(results))
+    slower['benchmarks'][0]['stats']['median'] *= 2
+    slower_file = tmp_path / 'slower.json'
+    slower_file.write_text(json.dumps(slower))
+
+    # the same results, no regressions
+    bench(
+        output_file = str(tmp_path / 'unused.json'),
+        compare = [str(baseline_file), str(baseline_file)],
+    )
+    output = capsys.readouterr().out
+    assert 'Ratio' in output
+    assert 'REGRESSION' not in output
+    for b in results['benchmarks']:
+        assert b['name'] in output
+
+    # a slower benchmark is flagged and the program exits with an error
+    with pytest.raises(SystemExit) as exit_info:
+        bench(
+            output_file = str(tmp_path / 'unused.json'),
+            compare = [str(baseline_file), str(slower_file)],
+        )
+    assert exit_info.value.code == 1
+    output = capsys.readouterr().out
+    assert output.count('REGRESSION') == 1
@@ -0,0 +1,87 @@
+from array import array
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pysam = pytest.importorskip('pysam')
+
+from sturgeon.callmapping import (
+    CallsBuffer, 
+    add_read_methyl_calls, 
+    bam_to_calls,
+)
+
+HEADER = {'HD': {'VN': '1.6'}, 'SQ': [{'SN': 'chr1', 'LN': 10000}]}
+
+
+def make_read(header):
+    """Read with 5mC and 5hmC calls on its first two Cs, at reference 
+    positions 101 and 105
+    """
+
+    read = pysam.AlignedSegment(header)
+    read.query_name = 'read_1'
+    read.query_sequence = 'ACGTACGTACGT'
+    read.flag = 0
+    read.reference_id = 0
+    read.reference_start = 100
+    read.mapping_quality = 60
+    read.cigarstring = '12M'
+    read.set_tag('MM', 'C+m,0,0;C+h,0,0;')
+    read.set_tag('ML', array('B', [200, 180, 10, 5]))
+    return read
+
+
+@pytest.mark.parametrize('fivemc_code, expected', [
+    (None, [(101, 200), (105, 180), (101, 10), (105, 5)]),
+    ('m', [(101, 200), (105, 180)]),
+    ('h', [(101, 10), (105, 5)]),
+])
+def test_add_read_methyl_calls_c_modifications(fivemc_code, expected):
+
+    header = pysam.AlignmentHeader.from_dict(HEADER)
+    calls_buffer = CallsBuffer()
+    add_read_methyl_calls(
+        calls_buffer, make_read(header), fivemc_code = fivemc_code,
+    )
+
+    calls = list(zip(
+        calls_buffer.positions.tolist(), calls_buffer.scores.tolist()
+    ))
+    assert sorted(calls) == sorted(expected)
+
+
+def test_bam_to_calls_counts_5hmc_by_default(tmp_path):
+    """As with modbampy, 5hmC calls vote for the probes unless only the 5mC
+    calls are asked for: here the unmethylated 5hmC call ties with the 
+    methylated 5mC call
+    """
+
+    bam_file = str(tmp_path / 'reads.bam')
+    header = pysam.AlignmentHeader.from_dict(HEADER)
+    with pysam.AlignmentFile(bam_file, 'wb', header = header) as bam:
+        bam.write(make_read(header))
+
+    probes_df = pd.DataFrame({
+        'chr': [1], 'start': [101], 'end': [102], 'ID_REF': ['cg00000001'],
+    })
+
+    calls = dict()
+    for fivemc_code in (None, 'm'):
+        calls_per_probe, calls_per_read = bam_to_calls(
+            bam_file = bam_file,
+            probes_df = probes_df.copy(),
+            margin = 0,
+            neg_threshold = 0.3,
+            pos_threshold = 0.7,
+            index_free = True,
+            fivemc_code = fivemc_code,
+        )
+        calls[fivemc_code] = (
+            len(calls_per_read),
+            calls_per_probe['methylation_calls'].item(),
+            calls_per_probe['unmethylation_calls'].item(),
+        )
+
+    assert calls == {None: (2, 0, 0), 'm': (1, 1, 0)}
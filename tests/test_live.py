@@ -0,0 +1,157 @@
+import time
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('onnxruntime')
+
+import sturgeon
+from sturgeon.callmapping import ProbeCallCounts
+from sturgeon.cli.live import LiveSnapshot, LivePipeline
+from sturgeon.registry import get_model_registry
+from sturgeon.utils import read_probes_file
+
+BENCH_MODEL = str(
+    Path(sturgeon.__file__).parent / 'include' / 'bench' / 'bench_model.zip'
+)
+NUM_FILES = 6
+
+
+@pytest.fixture
+def probes_df(tmp_path):
+
+    with zipfile.ZipFile(BENCH_MODEL) as handle:
+        with handle.open('probes.csv') as probes_csv:
+            probe_ids = pd.read_csv(probes_csv)['ID_REF']
+
+    probes_file = tmp_path / 'probes.bed'
+    pd.DataFrame({
+        'chr': 1,
+        'start': np.arange(len(probe_ids)) * 1000,
+        'end': np.arange(len(probe_ids)) * 1000 + 1,
+        'ID_REF': probe_ids,
+    }).to_csv(probes_file, sep = ' ', index = False)
+    return read_probes_file(str(probes_file))
+
+
+@pytest.fixture
+def input_files(tmp_path, probes_df):
+    """Calls per probe of each input file, by path"""
+
+    rng = np.random.default_rng(0)
+    input_path = tmp_path / 'input'
+    input_path.mkdir()
+
+    calls = dict()
+    for i in range(NUM_FILES):
+        file_path = input_path / 'file_{}.txt'.format(i)
+        file_path.write_bytes(rng.bytes(64))
+        probe_ids = rng.choice(probes_df['ID_REF'], size = 200, replace = False)
+        calls[str(file_path)] = pd.DataFrame({
+            'ID_REF': probe_ids,
+            'methylation_calls': rng.integers(0, 2, size = len(probe_ids)),
+            'unmethylation_calls': rng.integers(0, 2, size = len(probe_ids)),
+        })
+    return calls
+
+
+def wait_for(condition, timeout = 30):
+
+    start = time.monotonic()
+    while not condition():
+        assert time.monotonic() - start < timeout
+        time.sleep(0.05)
+
+
+def run_live(
+    output_path, 
+    probes_df, 
+    input_files, 
+    coalesce, 
+    resume = False, 
+    backfill = True,
+):
+    """Send the input files through a live pipeline and wait until they are
+    predicted, without backfill the run stops as if it crashed while earlier
+    files were still waiting to be predicted
+    """
+
+    # as in `live`, the models are loaded before any file arrives
+    get_model_registry().get(BENCH_MODEL)
+
+    output_path.mkdir(exist_ok = True)
+    probe_counts = ProbeCallCounts(probes_df)
+    snapshot = LiveSnapshot(probe_counts, str(output_path), interval = 3600)
+    if resume:
+        assert snapshot.load()
+        input_files = dict()
+
+    pipeline = LivePipeline(
+        extract = input_files.get,
+        output_path = str(output_path),
+        model_files = [BENCH_MODEL],
+        probe_counts = probe_counts,
+        snapshot = snapshot,
+        plot_results = False,
+        coalesce = coalesce,
+    )
+    if not backfill:
+        pipeline._backfill = lambda: None
+
+    try:
+        for i, file_path in enumerate(input_files):
+            pipeline.submit(
+                file_path, float(i), more = i < len(input_files) - 1,
+            )
+        wait_for(lambda: pipeline.in_flight == 0)
+        if backfill:
+            wait_for(lambda: len(snapshot.pending_backfill()) == 0)
+        pipeline.check()
+    finally:
+        pipeline.close()
+    snapshot.save()
+    return snapshot
+
+
+def read_predictions(output_path):
+
+    output_csv, = output_path.glob('predictions_*.csv')
+    prediction_df = pd.read_csv(output_csv)
+    return prediction_df.drop(columns = ['reused'], errors = 'ignore')
+
+
+def test_resume_backfills_pending_files(tmp_path, probes_df, input_files):
+
+    # every file predicted as it comes
+    expected_path = tmp_path / 'expected'
+    run_live(expected_path, probes_df, input_files, coalesce = False)
+    expected = read_predictions(expected_path)
+    assert len(expected) == NUM_FILES
+
+    # all files added up, only the newest predicted before the crash
+    output_path = tmp_path / 'output'
+    snapshot = run_live(
+        output_path, probes_df, input_files, coalesce = True, backfill = False,
+    )
+    assert len(snapshot.pending_backfill()) == 1
+    assert len(read_predictions(output_path)) == 1
+
+    # the earlier files are predicted after resuming, without new files
+    snapshot = run_live(
+        output_path, probes_df, input_files, coalesce = True, resume = True,
+    )
+    assert snapshot.probe_counts.num_files == NUM_FILES
+    predictions = read_predictions(output_path)
+    assert predictions['timestamp'].tolist() == expected['timestamp'].tolist()
+    pd.testing.assert_frame_equal(predictions, expected, check_exact = False)
+
+    # nothing is left to predict in the checkpoint
+    snapshot = LiveSnapshot(
+        ProbeCallCounts(probes_df), str(output_path), interval = 3600,
+    )
+    assert snapshot.load()
+    assert len(snapshot.pending_backfill()) == 0
+    assert snapshot.unpredicted() is None
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+onnx = pytest.importorskip('onnx')
+onnxruntime = pytest.importorskip('onnxruntime')
+from onnx import helper, numpy_helper, TensorProto
+
+from sturgeon.prediction import (
+    model_forward_batch, 
+    predict_sample, 
+    predict_samples,
+)
+
+NUM_PROBES = 8
+HEADS = 2
+CLASSES = 3
+
+
+def make_session(batch_size):
+    """Linear model with a fixed (int) or dynamic (str) batch dimension"""
+
+    weights = np.random.default_rng(0).normal(
+        size = (NUM_PROBES, HEADS * CLASSES)
+    ).astype(np.float32)
+    graph = helper.make_graph(
+        [
+            helper.make_node('MatMul', ['input', 'W'], ['mm']),
+            helper.make_node('Reshape', ['mm', 'shape'], ['predictions']),
+        ],
+        'linear',
+        [helper.make_tensor_value_info(
+            'input', TensorProto.FLOAT, [batch_size, NUM_PROBES]
+        )],
+        [helper.make_tensor_value_info(
+            'predictions', TensorProto.FLOAT, [batch_size, HEADS, CLASSES]
+        )],
+        [
+            numpy_helper.from_array(weights, 'W'),
+            numpy_helper.from_array(
+                np.array([-1, HEADS, CLASSES], dtype = np.int64), 'shape'
+            ),
+        ],
+    )
+    model = helper.make_model(
+        graph, opset_imports = [helper.make_opsetid('', 13)]
+    )
+    model.ir_version = 8
+    return onnxruntime.InferenceSession(
+        model.SerializeToString(), providers = ['CPUExecutionProvider']
+    )
+
+
+@pytest.mark.parametrize('num_samples', [1, 3, 4, 10])
+def test_model_forward_batch_fixed_batch_size(num_samples):
+
+    x = np.random.default_rng(1).random(
+        (num_samples, NUM_PROBES)
+    ).astype(np.float32)
+
+    fixed = model_forward_batch(x, make_session(4))
+    dynamic = model_forward_batch(x, make_session('N'))
+
+    assert fixed.shape == (num_samples, HEADS, CLASSES)
+    np.testing.assert_allclose(fixed, dynamic, rtol = 1e-6)
+
+
+def write_bed_files(tmp_path, num_samples):
+    """Bed files that measure a random subset of the probes each"""
+
+    rng = np.random.default_rng(2)
+    probe_ids = ['cg{:08d}'.format(i) for i in range(NUM_PROBES)]
+    bed_files = list()
+    for i in range(num_samples):
+        measured = rng.random(NUM_PROBES) < 0.6
+        bed_df = pd.DataFrame({
+            'chrom': 1,
+            'chromStart': np.arange(NUM_PROBES)[measured],
+            'chromEnd': np.arange(NUM_PROBES)[measured] + 1,
+            'methylation_call': rng.integers(0, 2, NUM_PROBES)[measured],
+            'probe_id': np.array(probe_ids)[measured],
+        })
+        bed_file = str(tmp_path / 'sample_{}.bed'.format(i))
+        bed_df.to_csv(bed_file, sep = ' ', index = False)
+        bed_files.append(bed_file)
+    return bed_files, pd.DataFrame({'ID_REF': probe_ids})
+
+
+@pytest.mark.parametrize('model_batch_size', [4, 'N'])
+@pytest.mark.parametrize('batch_size', [3, 4])
+@pytest.mark.parametrize('merge_dict', [None, {'ab': ['a', 'b']}])
+def test_predict_samples_matches_predict_sample(
+    tmp_path, model_batch_size, batch_size, merge_dict,
+):
+
+    bed_files, probes_df = write_bed_files(tmp_path, 7)
+    session = make_session(model_batch_size)
+    kwargs = dict(
+        inference_session = session,
+        decoding_dict = {0: 'c', 1: 'a', 2: 'b'},
+        probes_df = probes_df,
+        temperatures = np.array([1.0, 2.0], dtype = np.float32),
+        merge_dict = merge_dict,
+    )
+
+    batched = predict_samples(
+        bed_files = bed_files, batch_size = batch_size, **kwargs,
+    )
+
+    assert len(batched) == len(bed_files)
+    for bed_file, prediction_df in zip(bed_files, batched):
+        single = predict_sample(bed_file = bed_file, **kwargs)
+        pd.testing.assert_frame_equal(prediction_df, single, rtol = 1e-6)